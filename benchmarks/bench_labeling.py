@@ -0,0 +1,42 @@
+"""Benchmarks for the per-pixel statistics used in outlier labeling
+
+Run with `asv run` (or `asv continuous master HEAD` to compare commits).
+"""
+import numpy as np
+
+from trodi import core
+
+
+def _nanmedian_median_mad(stack, scale=1.4826):
+    """Median/MAD using two separate `np.nanmedian` calls (the previous `core.mad`)"""
+    stack_abs = np.abs(stack)
+    med = np.nanmedian(stack_abs, axis=0)
+    return med, scale * np.nanmedian(np.abs(stack_abs - med), axis=0)
+
+
+class MedianMad:
+    """Fused `core.median_mad` versus separate `np.nanmedian` passes"""
+
+    # (ndates, rows, cols) for a short and a long stack
+    params = ([(30, 512, 512), (200, 128, 128)], [0.0, 0.01])
+    param_names = ["shape", "nan_fraction"]
+
+    def setup(self, shape, nan_fraction):
+        rng = np.random.default_rng(0)
+        self.stack = np.abs(rng.normal(size=shape)).astype(np.float32)
+        self.stack[rng.random(shape) < nan_fraction] = np.nan
+
+    def time_median_mad(self, shape, nan_fraction):
+        core.median_mad(self.stack)
+
+    def time_nanmedian_median_mad(self, shape, nan_fraction):
+        _nanmedian_median_mad(self.stack)
+
+    def time_label(self, shape, nan_fraction):
+        core.label(self.stack)
+
+    def peakmem_median_mad(self, shape, nan_fraction):
+        core.median_mad(self.stack)
+
+    def peakmem_nanmedian_median_mad(self, shape, nan_fraction):
+        _nanmedian_median_mad(self.stack)
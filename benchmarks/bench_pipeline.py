@@ -0,0 +1,151 @@
+"""Wall time and peak memory of each stage of the pipeline, on synthetic stacks
+
+Run with `asv run` (or `asv continuous master HEAD` to compare commits).
+The stacks are made by `trodi.synthetic.make_stack` at a few scales.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from trodi import core, synthetic
+from trodi.deramp import remove_ramp
+
+from .check_allocations import measure
+
+# (rows, cols, dates) of the synthetic stacks
+SCALES = [(256, 256, 10), (1024, 1024, 20)]
+
+
+def _make_stack(scale):
+    rows, cols, ndates = scale
+    outdir = tempfile.mkdtemp()
+    stack = synthetic.make_stack(
+        outdir, shape=(rows, cols), ndates=ndates, connectivity=3, nan_fraction=0.01
+    )
+    return outdir, stack
+
+
+class CreateAverages:
+    """`core.create_averages` with each averaging engine"""
+
+    params = (SCALES, ["serial", "single_pass"], [0, 4])
+    param_names = ["scale", "engine", "prefetch_depth"]
+    timeout = 600
+
+    def setup(self, scale, engine, prefetch_depth):
+        self.outdir, self.stack = _make_stack(scale)
+        self.avg_file = os.path.join(self.outdir, "average_ifgs.nc")
+        self.kwargs = dict(
+            search_path=self.outdir,
+            rsc_file=self.stack.rsc_file,
+            avg_file=self.avg_file,
+            overwrite=True,
+            single_pass=engine == "single_pass",
+            prefetch_depth=prefetch_depth,
+        )
+
+    def teardown(self, scale, engine, prefetch_depth):
+        shutil.rmtree(self.outdir)
+
+    def time_create_averages(self, scale, engine, prefetch_depth):
+        core.create_averages(**self.kwargs)
+
+    def peakmem_create_averages(self, scale, engine, prefetch_depth):
+        core.create_averages(**self.kwargs)
+
+
+class AverageAllocations:
+    """Allocations of `core._average_date`, traced by `check_allocations.measure`"""
+
+    timeout = 600
+
+    def setup_cache(self):
+        return measure()
+
+    def track_allocs_per_igram(self, results):
+        """Image-sized allocations while adding each igram to the average"""
+        return results[0]
+
+    track_allocs_per_igram.unit = "allocations"
+
+    def track_peak_images(self, results):
+        """Peak memory while averaging one date, in images"""
+        return results[1]
+
+    track_peak_images.unit = "images"
+
+
+class RemoveRamp:
+    """Fitting and removing the ramp of one image"""
+
+    params = ([(256, 256), (2048, 2048)], [1, 2])
+    param_names = ["shape", "deramp_order"]
+
+    def setup(self, shape, deramp_order):
+        rng = np.random.default_rng(0)
+        yy, xx = np.mgrid[: shape[0], : shape[1]]
+        self.image = (rng.normal(size=shape) + 1e-3 * (yy + xx)).astype(np.float32)
+        self.mask = rng.random(shape) < 0.1
+
+    # `copy`, since the ramp is otherwise removed from `self.image` in place,
+    # changing the input of the following repeats
+    def time_remove_ramp(self, shape, deramp_order):
+        remove_ramp(self.image, deramp_order=deramp_order, mask=self.mask, copy=True)
+
+    def peakmem_remove_ramp(self, shape, deramp_order):
+        remove_ramp(self.image, deramp_order=deramp_order, mask=self.mask, copy=True)
+
+
+class Mad:
+    """`core.mad` of a stack"""
+
+    params = [(20, 256, 256), (100, 512, 512)]
+    param_names = ["shape"]
+
+    def setup(self, shape):
+        rng = np.random.default_rng(0)
+        self.stack = rng.normal(size=shape).astype(np.float32)
+
+    def time_mad(self, shape):
+        core.mad(self.stack)
+
+    def peakmem_mad(self, shape):
+        core.mad(self.stack)
+
+
+class LabelOutliers:
+    """Pixel level `core.label_outliers` from an averages file"""
+
+    params = (SCALES, ["exact", "sketch"])
+    param_names = ["scale", "method"]
+    timeout = 600
+
+    def setup(self, scale, method):
+        self.outdir, stack = _make_stack(scale)
+        self.avg_file = core.create_averages(
+            search_path=self.outdir,
+            rsc_file=stack.rsc_file,
+            avg_file=os.path.join(self.outdir, "average_ifgs.nc"),
+            single_pass=True,
+        )
+        self.outfile = os.path.join(self.outdir, "labels.nc")
+
+    def teardown(self, scale, method):
+        shutil.rmtree(self.outdir)
+
+    def time_label_outliers(self, scale, method):
+        core.label_outliers(
+            fname=self.avg_file, outfile=self.outfile, level="pixel", method=method
+        )
+
+    def peakmem_label_outliers(self, scale, method):
+        core.label_outliers(
+            fname=self.avg_file, outfile=self.outfile, level="pixel", method=method
+        )
+
+
+def timeraw_import_cli():
+    """Startup time of the command line entry point, in a new interpreter"""
+    return "import trodi.cli"
@@ -0,0 +1,121 @@
+"""Check that averaging a date makes no image-sized arrays per interferogram
+
+`core._average_date` runs under `tracemalloc` (which sees numpy's array memory)
+on a synthetic stack, reusing its output array like the serial engine does.
+For each igram after the first, the memory allocated while adding it to the
+average is recorded. Any image-sized allocation there is a per-igram temporary.
+The peak memory of the whole date (read buffer, deramping) is also checked.
+Run with `make check-allocations` (also run by `make test`, through `test_checks.py`).
+"""
+import collections
+import logging
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from trodi import core, synthetic, utils
+
+SHAPE = (1024, 1024)
+NDATES = 12
+# Peak memory above the output array for one date, in images of SHAPE:
+# the read buffer, plus the deramp's masks and fit sums
+PEAK_BUDGET = 5
+
+
+class _TracedImages:
+    """Wrap a `sario.prefetch` iterator, recording the allocations between images"""
+
+    def __init__(self, images):
+        self.images = images
+        self.allocated = []
+        self.base = None
+        # Keep the last images alive, so freeing an unused image (without
+        # reused buffers) can't hide an allocation in the same interval
+        self.held = collections.deque(maxlen=2)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.base is not None:
+            self.allocated.append(tracemalloc.get_traced_memory()[1] - self.base)
+        item = next(self.images)
+        self.held.append(item)
+        tracemalloc.reset_peak()
+        self.base = tracemalloc.get_traced_memory()[0]
+        return item
+
+
+def measure(shape=SHAPE, ndates=NDATES):
+    """Average the date with the most igrams of a synthetic stack, under tracemalloc
+
+    Returns
+    -------
+    allocs_per_igram : float
+        image-sized allocations while adding each igram (after the first)
+    peak_images : float
+        peak memory while averaging the date, beyond its output array, in images
+    """
+    from trodi import sario
+
+    outdir = tempfile.mkdtemp()
+    try:
+        stack = synthetic.make_stack(
+            outdir, shape=shape, ndates=ndates, connectivity=3, nan_fraction=0.01
+        )
+        index = utils.IgramIndex(stack.unw_file_list)
+        date_idx = max(
+            range(len(index.sar_date_list)), key=lambda idx: len(index.date_igrams(idx))
+        )
+        cur_date, cur_unws = index.sar_date_list[date_idx], index.date_igrams(date_idx)
+        mask = np.zeros(shape, dtype=bool)
+        kwargs = dict(rsc_file=stack.rsc_file, deramp_order=2, mask=mask)
+        image_bytes = np.empty(shape, dtype=np.float32).nbytes
+        out = np.empty(shape, dtype=np.float32)
+
+        def images():
+            # Serial reads, so only the accumulation happens between two images
+            return sario.prefetch(
+                [unwf for (unwf, _) in cur_unws],
+                depth=0,
+                rsc_file=stack.rsc_file,
+                reuse_buffers=True,
+            )
+
+        # Warm the caches (file headers, ramp fit) so only steady state is measured
+        core._average_date(cur_date, cur_unws, images=images(), out=out, **kwargs)
+
+        traced = _TracedImages(images())
+        tracemalloc.start()
+        try:
+            core._average_date(cur_date, cur_unws, images=traced, out=out, **kwargs)
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            core._average_date(cur_date, cur_unws, images=images(), out=out, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+    finally:
+        shutil.rmtree(outdir)
+    allocs = sum(nbytes // image_bytes for nbytes in traced.allocated)
+    return allocs / len(traced.allocated), peak / image_bytes
+
+
+def main():
+    logging.disable(logging.INFO)
+    allocs_per_igram, peak_images = measure()
+    print(
+        "Image-sized allocations per igram: {:.2f}, peak: {:.2f} images "
+        "(budget {})".format(allocs_per_igram, peak_images, PEAK_BUDGET)
+    )
+    if allocs_per_igram > 0:
+        sys.exit("Averaging allocates image-sized arrays for each igram")
+    if peak_images > PEAK_BUDGET:
+        sys.exit("Averaging one date peaked at {:.2f} images".format(peak_images))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Check that `import trodi.cli` is fast and skips the heavy I/O libraries
+
+Each import is timed in a fresh interpreter (taking the best of a few runs),
+so `trodi --help` and argument errors stay cheap for array jobs launching trodi
+many times. Run with `make check-startup` (also run by `make test`, through
+`test_checks.py`).
+"""
+import json
+import os
+import subprocess
+import sys
+
+# Seconds for `import trodi.cli`, including numpy
+BUDGET = 0.5
+# Only imported when reading or writing files
+LAZY_MODULES = ["cftime", "dask", "h5netcdf", "h5py", "osgeo", "xarray"]
+NUM_RUNS = 5
+# Run from the repository, so `trodi` imports without being installed
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CODE = """
+import json, sys, time
+t0 = time.perf_counter()
+import trodi.cli
+elapsed = time.perf_counter() - t0
+print(json.dumps([elapsed, [m for m in {} if m in sys.modules]]))
+""".format(LAZY_MODULES)
+
+
+def import_time():
+    """Seconds to `import trodi.cli` in a new interpreter, and lazy modules loaded"""
+    out = subprocess.run(
+        [sys.executable, "-c", CODE],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=REPO_DIR,
+    )
+    return json.loads(out.stdout)
+
+
+def measure(num_runs=NUM_RUNS):
+    """Best time to `import trodi.cli` of `num_runs`, and all lazy modules it loaded"""
+    results = [import_time() for _ in range(num_runs)]
+    elapsed = min(r[0] for r in results)
+    loaded = sorted(set(m for r in results for m in r[1]))
+    return elapsed, loaded
+
+
+def main():
+    elapsed, loaded = measure()
+    print("import trodi.cli: {:.3f} s (budget {} s)".format(elapsed, BUDGET))
+    if loaded:
+        sys.exit("`import trodi.cli` loaded {}".format(", ".join(loaded)))
+    if elapsed > BUDGET:
+        sys.exit("`import trodi.cli` took {:.3f} s".format(elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""The startup time and allocation checks, collected by pytest in `make test`"""
+from . import check_allocations, check_startup
+
+
+def test_import_cli_is_fast_and_lazy():
+    elapsed, loaded = check_startup.measure()
+    assert not loaded, "`import trodi.cli` loaded {}".format(", ".join(loaded))
+    assert elapsed <= check_startup.BUDGET
+
+
+def test_averaging_allocations():
+    allocs_per_igram, peak_images = check_allocations.measure()
+    assert allocs_per_igram == 0, "Averaging allocates image-sized arrays per igram"
+    assert peak_images <= check_allocations.PEAK_BUDGET
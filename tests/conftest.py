@@ -0,0 +1,59 @@
+"""Shared helpers for the tests: synthetic igram stacks, and averages stacks
+written straight from arrays"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from trodi import backends, core, synthetic
+
+
+@pytest.fixture
+def write_stack(tmp_path):
+    """Write a (dates, rows, cols) array as an averages file in `tmp_path`
+
+    Returns the filename. The extension of `name` picks the backend.
+    """
+
+    def _write(data, name="average_ifgs.nc"):
+        ndates, rows, cols = data.shape
+        ds = xr.Dataset(
+            {"stack": (("date", "lat", "lon"), data.astype(np.float32))},
+            coords={
+                "date": pd.date_range("2015-01-01", periods=ndates, freq="12D"),
+                "lat": np.linspace(30, 29, rows),
+                "lon": np.linspace(-100, -99, cols),
+            },
+        )
+        fname = str(tmp_path / name)
+        backends.save_xarray(ds, fname)
+        return fname
+
+    return _write
+
+
+@pytest.fixture
+def igram_stack(tmp_path):
+    """A small synthetic stack of .unw interferograms (see `synthetic.make_stack`)"""
+    return synthetic.make_stack(
+        str(tmp_path / "igrams"), shape=(40, 30), ndates=6, connectivity=2, seed=1
+    )
+
+
+@pytest.fixture
+def average(igram_stack):
+    """Run `core.create_averages` on `igram_stack`, returning the loaded averages"""
+
+    def _average(avg_file, **kwargs):
+        core.create_averages(
+            search_path=os.path.dirname(igram_stack.rsc_file),
+            rsc_file=igram_stack.rsc_file,
+            avg_file=avg_file,
+            **kwargs,
+        )
+        with backends.open_dataarray(avg_file) as avgs:
+            return avgs.load()
+
+    return _average
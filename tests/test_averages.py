@@ -0,0 +1,28 @@
+import os
+
+import numpy as np
+import pytest
+
+ENGINES = {
+    "serial": {},
+    "workers": {"workers": 2},
+    "single_pass": {"single_pass": True},
+    "tiled": {"tile_shape": (16, 30)},
+    "dask": {"scheduler": "threads", "workers": 1},
+}
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+@pytest.mark.parametrize("deramp_order", [0, 2])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_date_without_igrams_is_nan(
+    igram_stack, average, tmp_path, engine, deramp_order
+):
+    # Only the first date's igram to the third date is left: too long to use
+    os.remove(igram_stack.unw_file_list[0])
+    kwargs = dict(max_temporal_baseline=12, deramp_order=deramp_order)
+    expected = average(str(tmp_path / "serial.nc"), **kwargs)
+    avgs = average(str(tmp_path / "avg.nc"), **kwargs, **ENGINES[engine])
+    assert np.isnan(avgs[0]).all()
+    assert not np.isnan(avgs[1:]).all(axis=(1, 2)).any()
+    np.testing.assert_allclose(avgs, expected, atol=1e-5)
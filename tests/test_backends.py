@@ -0,0 +1,131 @@
+import os
+
+import numpy as np
+import pytest
+
+from trodi import backends, core, labelio
+
+
+@pytest.fixture(params=[".nc", ".zarr", ".bin"])
+def ext(request):
+    """File extension picking each backend"""
+    if request.param == ".zarr":
+        pytest.importorskip("zarr")
+    return request.param
+
+
+def test_variables_round_trip(tmp_path, ext):
+    fname = str(tmp_path / ("test" + ext))
+    data = np.arange(24, dtype=np.float32).reshape((2, 3, 4))
+    with backends.open_dataset(fname, "w") as f:
+        f.setncattr("title", "round trip")
+        f.createDimension("date", None)
+        f.createDimension("lat", 3)
+        f.createDimension("lon", 4)
+        var = f.createVariable("stack", "f4", ("date", "lat", "lon"))
+        var.setncattr("units", "rad")
+        f.resize_dimension("date", 2)
+        var[:] = data
+        group = f.createGroup("inputs")
+        group.createVariable("fingerprint", str, ("date",))
+        group["fingerprint"][0] = "abc"
+
+    with backends.open_dataset(fname, "r") as f:
+        assert f.getncattr("title") == "round trip"
+        assert f.dimensions["date"].isunlimited()
+        assert f["stack"].getncattr("units") == "rad"
+        np.testing.assert_array_equal(f["stack"][:], data)
+        np.testing.assert_array_equal(f["stack"][1, 1:, :2], data[1, 1:, :2])
+        assert f.groups["inputs"]["fingerprint"][0] == "abc"
+
+    # Append a date, as updates do
+    with backends.open_dataset(fname, "r+") as f:
+        f.resize_dimension("date", 3)
+        f["stack"][2] = -1
+    with backends.open_dataset(fname, "r") as f:
+        assert f["stack"].shape == (3, 3, 4)
+        np.testing.assert_array_equal(f["stack"][:2], data)
+        np.testing.assert_array_equal(f["stack"][2], -1)
+
+
+def test_save_xarray_round_trip(write_stack, ext):
+    data = np.random.default_rng(0).normal(size=(4, 5, 6))
+    data[1, 2, 3] = np.nan
+    expected = backends.open_dataarray(write_stack(data, "stack.nc")).load()
+    with backends.open_dataarray(write_stack(data, "stack" + ext)) as stack:
+        assert stack.identical(expected)
+
+
+def test_create_averages_round_trip(average, tmp_path, ext):
+    expected = average(str(tmp_path / "expected.nc"))
+    avgs = average(str(tmp_path / ("avg" + ext)))
+    np.testing.assert_array_equal(avgs, expected)
+    np.testing.assert_array_equal(avgs["date"], expected["date"])
+
+
+def test_create_averages_appends_dates(igram_stack, average, tmp_path, caplog, ext):
+    avg_file = str(tmp_path / ("avg" + ext))
+    # Hold back the igrams of the last date
+    held = igram_stack.unw_file_list[-2:]
+    for fname in held:
+        os.rename(fname, fname + ".held")
+    average(avg_file)
+    for fname in held:
+        os.rename(fname + ".held", fname)
+
+    caplog.clear()
+    avgs = average(avg_file, update=True)
+    assert "1 new date(s)" in caplog.text
+    np.testing.assert_array_equal(avgs, average(str(tmp_path / "expected.nc")))
+
+
+def _labels(outfile):
+    with labelio.open_labels(outfile) as ds:
+        return ds.load()
+
+
+@pytest.mark.parametrize("label_encoding", labelio.LABEL_ENCODINGS)
+@pytest.mark.parametrize("method", ["exact", "sketch"])
+def test_label_outliers_round_trip(write_stack, tmp_path, ext, label_encoding, method):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(10, 8, 6))
+    data[rng.random(data.shape) < 0.02] = 50
+    kwargs = dict(method=method, label_encoding=label_encoding)
+    expected = str(tmp_path / "expected.nc")
+    core.label_outliers(write_stack(data, "avg.nc"), outfile=expected, **kwargs)
+    outfile = str(tmp_path / ("labels" + ext))
+    labels, threshold = core.label_outliers(
+        write_stack(data, "avg" + ext), outfile=outfile, **kwargs
+    )
+
+    got, want = _labels(outfile), _labels(expected)
+    assert got["labels"].values.any()
+    names = ["labels", "threshold"]
+    names += ["outlier_data"] if label_encoding == "sparse" else ["data"]
+    for name in names:
+        np.testing.assert_array_equal(got[name], want[name])
+    np.testing.assert_array_equal(labels, want["labels"])
+    np.testing.assert_array_equal(labels, labelio.read_labels(outfile))
+
+
+@pytest.mark.parametrize("label_encoding", ["dense", "packed"])
+def test_label_outliers_appends_dates(
+    write_stack, tmp_path, caplog, ext, label_encoding
+):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(10, 8, 6))
+    data[rng.random(data.shape) < 0.02] = 50
+    outfile = str(tmp_path / ("labels" + ext))
+    kwargs = dict(label_encoding=label_encoding)
+    core.label_outliers(write_stack(data[:7], "old" + ext), outfile=outfile, **kwargs)
+    fname = write_stack(data, "new" + ext)
+    caplog.clear()
+    core.label_outliers(fname, outfile=outfile, update=True, **kwargs)
+    assert "Adding 3 dates to the stack" in caplog.text
+
+    expected = str(tmp_path / "expected.nc")
+    core.label_outliers(fname, outfile=expected, **kwargs)
+    got, want = _labels(outfile), _labels(expected)
+    for name in ["labels", "data", "threshold"]:
+        np.testing.assert_array_equal(got[name], want[name])
+    np.testing.assert_array_equal(got["date"], want["date"])
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from trodi import core, labelio
+
+
+@pytest.mark.parametrize("label_encoding", labelio.LABEL_ENCODINGS)
+@pytest.mark.parametrize(
+    "kwargs", [{}, {"method": "sketch"}, {"scheduler": "threads", "workers": 1}]
+)
+def test_label_outliers_twice_to_same_outfile(
+    write_stack, tmp_path, label_encoding, kwargs
+):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(9, 6, 7))
+    data[4, 2, 3] = 100.0
+    fname = write_stack(data)
+    outfile = str(tmp_path / "labels.nc")
+    for _ in range(2):
+        labels, threshold = core.label_outliers(
+            fname, outfile=outfile, label_encoding=label_encoding, **kwargs
+        )
+    assert labels.dtype == bool
+    assert labels.values[4, 2, 3]
+    np.testing.assert_array_equal(labels.values, labelio.read_labels(outfile))
+    assert threshold.shape == (6, 7)
@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pytest
+
+from trodi import core, labelio
+
+
+class _Stop(Exception):
+    """Stands in for the process being killed partway through a run"""
+
+
+def _record_calls(monkeypatch, name, stop_after=None):
+    """Record the arguments of calls to `core.<name>`, raising `_Stop` after
+    `stop_after` calls (if given)"""
+    real = getattr(core, name)
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        if len(calls) == stop_after:
+            raise _Stop
+        calls.append(args)
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(core, name, wrapper)
+    return calls
+
+
+def _stopped_averages(monkeypatch, average, avg_file, ndone=3):
+    """Start averaging into `avg_file`, stopping after `ndone` dates"""
+    with monkeypatch.context() as patch:
+        _record_calls(patch, "_average_date", stop_after=ndone)
+        with pytest.raises(_Stop):
+            average(avg_file, prefetch_depth=0)
+
+
+def _touch(fname):
+    """Change the contents and modification time of an igram"""
+    data = np.fromfile(fname, dtype=np.float32)
+    (2 * data).tofile(fname)
+    stat = os.stat(fname)
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_resume_averages_matches_fresh_run(
+    igram_stack, monkeypatch, average, tmp_path, caplog
+):
+    avg_file = str(tmp_path / "avg.nc")
+    _stopped_averages(monkeypatch, average, avg_file)
+
+    caplog.clear()
+    with monkeypatch.context() as patch:
+        calls = _record_calls(patch, "_average_date")
+        avgs = average(avg_file)
+    assert "Resuming {}: 3 unfinished date(s)".format(avg_file) in caplog.text
+    assert [args[0] for args in calls] == igram_stack.date_list[3:]
+    np.testing.assert_array_equal(avgs, average(str(tmp_path / "fresh.nc")))
+
+
+def test_resume_recomputes_layers_with_changed_igrams(
+    igram_stack, monkeypatch, average, tmp_path
+):
+    avg_file = str(tmp_path / "avg.nc")
+    _stopped_averages(monkeypatch, average, avg_file)
+    # The igram between the 2nd and 3rd dates, which were finished
+    _touch(igram_stack.unw_file_list[2])
+
+    with monkeypatch.context() as patch:
+        calls = _record_calls(patch, "_average_date")
+        avgs = average(avg_file)
+    dates = igram_stack.date_list
+    assert [args[0] for args in calls] == dates[1:3] + dates[3:]
+    np.testing.assert_array_equal(avgs, average(str(tmp_path / "fresh.nc")))
+
+
+def test_resume_with_changed_parameters_rebuilds(
+    igram_stack, monkeypatch, average, tmp_path
+):
+    avg_file = str(tmp_path / "avg.nc")
+    _stopped_averages(monkeypatch, average, avg_file)
+
+    with monkeypatch.context() as patch:
+        calls = _record_calls(patch, "_average_date")
+        avgs = average(avg_file, deramp_order=1)
+    assert [args[0] for args in calls] == igram_stack.date_list
+    expected = average(str(tmp_path / "fresh.nc"), deramp_order=1)
+    np.testing.assert_array_equal(avgs, expected)
+
+
+@pytest.mark.parametrize("label_encoding", ["dense", "packed"])
+def test_resume_labels_with_update(
+    write_stack, monkeypatch, tmp_path, caplog, label_encoding
+):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(12, 20, 16))
+    data[rng.random(data.shape) < 0.01] = 50
+    fname = write_stack(data)
+    kwargs = dict(tile_shape=(10, 8), label_encoding=label_encoding)
+    outfile = str(tmp_path / "labels.nc")
+    with monkeypatch.context() as patch:
+        _record_calls(patch, "_write_label_tile", stop_after=2)
+        with pytest.raises(_Stop):
+            core.label_outliers(fname, outfile=outfile, **kwargs)
+
+    # The finished tiles match, so only the other two are written
+    caplog.clear()
+    core.label_outliers(fname, outfile=outfile, update=True, **kwargs)
+    assert "Updated 2 out of 4 tile(s)" in caplog.text
+    fresh = str(tmp_path / "fresh.nc")
+    core.label_outliers(fname, outfile=fresh, **kwargs)
+    with labelio.open_labels(outfile) as resumed, labelio.open_labels(
+        fresh
+    ) as expected:
+        for name in ["labels", "data", "threshold"]:
+            np.testing.assert_array_equal(resumed[name], expected[name])
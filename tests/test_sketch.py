@@ -0,0 +1,41 @@
+import numpy as np
+
+from trodi import core
+from trodi.sketch import HistogramSketch
+
+
+def test_update_skips_all_nan_first_layer():
+    sketch = HistogramSketch((2, 2), nbins=16)
+    sketch.update(np.full((2, 2), np.nan))
+    assert sketch.max_value is None
+    for val in [1.0, 2.0, 3.0]:
+        sketch.update(np.full((2, 2), val))
+    med, _ = sketch.median_mad()
+    np.testing.assert_allclose(med, 2.0, atol=sketch.bin_width)
+
+
+def test_median_mad_warns_past_max_value(caplog):
+    sketch = HistogramSketch((1, 2), nbins=16, max_value=10.0)
+    for val in [1.0, 50.0, 51.0, 52.0]:
+        sketch.update(np.array([[val, 1.0]]))
+    med, _ = sketch.median_mad()
+    assert med[0, 0] == 10.0
+    assert "1 pixel(s) have a median or MAD past" in caplog.text
+
+
+def test_label_sketch_uses_range_of_all_dates(write_stack, tmp_path):
+    rng = np.random.default_rng(0)
+    data = 50 + rng.normal(size=(30, 10, 12))
+    # No igrams for the first date, and smaller values in the second
+    data[0] = np.nan
+    data[1] = 1.0
+    fname = write_stack(data)
+
+    _, threshold = core.label_outliers(
+        fname, outfile=str(tmp_path / "sketch.nc"), method="sketch", sketch_bins=64
+    )
+    _, exact = core.label_outliers(fname, outfile=str(tmp_path / "exact.nc"))
+    # Medians within a bin, MADs within two bins, scaled into the threshold
+    bin_width = np.nanmax(data) / 64
+    atol = bin_width + 5 * 1.4826 * 2 * bin_width
+    np.testing.assert_allclose(threshold.values, exact.values, atol=atol)
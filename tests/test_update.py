@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import pytest
+
+from trodi import core, labelio
+
+
+def _hold_back(fnames):
+    """Hide `fnames` from the igram search, returning a function to restore them"""
+    for fname in fnames:
+        os.rename(fname, fname + ".held")
+
+    def restore():
+        for fname in fnames:
+            os.rename(fname + ".held", fname)
+
+    return restore
+
+
+def test_update_averages_appends_new_dates(igram_stack, average, tmp_path, caplog):
+    avg_file = str(tmp_path / "avg.nc")
+    last_date = igram_stack.date_list[-1].strftime("%Y%m%d")
+    restore = _hold_back(
+        [f for f in igram_stack.unw_file_list if f.endswith(last_date + ".unw")]
+    )
+    old = average(avg_file)
+    restore()
+
+    caplog.clear()
+    avgs = average(avg_file, update=True)
+    # The held back igrams also belong to the two dates before the last
+    assert "2 changed date(s), 1 new date(s)" in caplog.text
+    assert len(avgs) == len(old) + 1
+    np.testing.assert_array_equal(avgs[:-3], old[:-2])
+    np.testing.assert_array_equal(avgs, average(str(tmp_path / "fresh.nc")))
+
+
+def test_update_averages_recomputes_changed_igram(
+    igram_stack, average, tmp_path, caplog
+):
+    avg_file = str(tmp_path / "avg.nc")
+    old = average(avg_file)
+    # The igram between the 2nd and 3rd dates
+    fname = igram_stack.unw_file_list[2]
+    data = np.fromfile(fname, dtype=np.float32)
+    (2 * data).tofile(fname)
+    stat = os.stat(fname)
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    caplog.clear()
+    avgs = average(avg_file, update=True)
+    assert "2 changed date(s), 0 new date(s)" in caplog.text
+    changed = ~np.all((avgs == old) | (np.isnan(avgs) & np.isnan(old)), axis=(1, 2))
+    assert np.flatnonzero(changed).tolist() == [1, 2]
+    np.testing.assert_array_equal(avgs, average(str(tmp_path / "fresh.nc")))
+
+
+def _read_outfile(outfile):
+    with labelio.open_labels(outfile) as ds:
+        return ds.load()
+
+
+@pytest.mark.parametrize("label_encoding", ["dense", "packed"])
+def test_update_labels_matches_fresh_labels(write_stack, tmp_path, label_encoding):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(12, 20, 16))
+    data[rng.random(data.shape) < 0.01] = 50
+    kwargs = dict(tile_shape=(10, 8), label_encoding=label_encoding)
+    outfile = str(tmp_path / "labels.nc")
+    core.label_outliers(write_stack(data[:9], "old.nc"), outfile=outfile, **kwargs)
+
+    # New dates appended, and one changed layer
+    data[4] *= 3
+    fname = write_stack(data, "new.nc")
+    core.label_outliers(fname, outfile=outfile, update=True, **kwargs)
+    fresh = str(tmp_path / "fresh.nc")
+    core.label_outliers(fname, outfile=fresh, **kwargs)
+    updated, expected = _read_outfile(outfile), _read_outfile(fresh)
+    for name in ["labels", "data", "threshold"]:
+        np.testing.assert_array_equal(updated[name], expected[name])
+
+
+def test_update_labels_only_rewrites_moved_tiles(write_stack, tmp_path, caplog):
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(12, 20, 16))
+    kwargs = dict(tile_shape=(10, 8))
+    outfile = str(tmp_path / "labels.nc")
+    core.label_outliers(write_stack(data, "old.nc"), outfile=outfile, **kwargs)
+    old = _read_outfile(outfile)
+
+    # Move the statistics of only the top left tile
+    data[:, :10, :8] *= 10
+    caplog.clear()
+    core.label_outliers(
+        write_stack(data, "new.nc"), outfile=outfile, update=True, **kwargs
+    )
+    assert "Updated 1 out of 4 tile(s)" in caplog.text
+    new = _read_outfile(outfile)
+    moved = new["threshold"].values != old["threshold"].values
+    assert moved[:10, :8].all()
+    assert not moved[10:].any() and not moved[:, 8:].any()
+    np.testing.assert_array_equal(new["labels"][:, 10:], old["labels"][:, 10:])
+    np.testing.assert_array_equal(new["labels"][:, :, 8:], old["labels"][:, :, 8:])
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"method": "sketch"}, {"level": "scene"}, {"outfile": None}]
+)
+def test_update_warns_where_unsupported(write_stack, tmp_path, caplog, kwargs):
+    fname = write_stack(np.random.default_rng(0).normal(size=(6, 5, 4)))
+    kwargs = dict(dict(outfile=str(tmp_path / "labels.nc")), **kwargs)
+    core.label_outliers(fname, update=True, **kwargs)
+    assert "`update` only applies to exact pixel level labels" in caplog.text
@@ -0,0 +1,686 @@
+"""
+Storage backends for the averaged stacks and the labels
+
+All files are read and written through the part of the netCDF4 interface
+(`h5netcdf.legacyapi`) which trodi uses: dimensions (which can grow, for
+appending dates), variables with attributes, and groups.
+The backend is picked from the file extension:
+
+    ".zarr": a Zarr (v3) directory store. Each chunk is a separate file, so
+        processes can write to different chunks at once. Needs `pip install zarr`
+    ".bin": a directory holding each variable as a flat, uncompressed binary file
+        "<name>.bin" with an ENVI header "<name>.hdr" (which GDAL can read), plus
+        "metadata.json" for the dimensions and attributes. The files are
+        memory-mapped, so reading them doesn't copy them into memory first
+    anything else: NetCDF4/HDF5, with h5netcdf
+
+Chunking and compression (see `utils.storage_options`) are translated for Zarr,
+and ignored for the flat binary files.
+"""
+import functools
+import json
+import os
+import shutil
+
+import numpy as np
+
+BACKENDS = ("netcdf", "zarr", "binary")
+EXTENSIONS = {".nc": "netcdf", ".zarr": "zarr", ".bin": "binary"}
+METADATA_FILE = "metadata.json"
+# ENVI "data type" codes of numpy dtypes. int8 is stored as a byte
+ENVI_DATA_TYPES = {
+    "u1": 1,
+    "i1": 1,
+    "i2": 2,
+    "i4": 3,
+    "f4": 4,
+    "f8": 5,
+    "u2": 12,
+    "u4": 13,
+    "i8": 14,
+    "u8": 15,
+}
+
+
+def get_backend(fname):
+    """Name of the backend used for `fname`, from its extension
+
+    Examples
+    --------
+    >>> get_backend("average_ifgs.zarr/"), get_backend("labels.bin")
+    ('zarr', 'binary')
+    >>> get_backend("labels.nc"), get_backend("labels.h5")
+    ('netcdf', 'netcdf')
+    """
+    ext = os.path.splitext(os.fspath(fname).rstrip("/"))[1]
+    return EXTENSIONS.get(ext, "netcdf")
+
+
+def open_dataset(fname, mode="r"):
+    """Open `fname` as a netCDF4-like dataset, with the backend for its extension
+
+    Parameters
+    ----------
+    fname : str
+        file (or directory, for Zarr and flat binary) to open
+    mode : str
+        "r" to read, "r+" to edit, "w" to create (clobbering any existing one)
+        or "x" to create a new one (Default value = "r")
+
+    Returns
+    -------
+    h5netcdf.legacyapi.Dataset, ZarrDataset or BinaryDataset
+    """
+    backend = get_backend(fname)
+    if backend == "zarr":
+        return ZarrDataset(fname, mode)
+    elif backend == "binary":
+        return BinaryDataset(fname, mode)
+    return _netcdf_dataset_class()(fname, mode)
+
+
+def open_xarray(fname):
+    """Open `fname` as a lazy xr.Dataset, decoding the dates and fill values
+
+    Flat binary variables are backed by read-only memory maps.
+    """
+    import xarray as xr
+
+    backend = get_backend(fname)
+    if backend == "zarr":
+        _import_zarr()
+        return xr.open_dataset(fname, engine="zarr", consolidated=False)
+    elif backend == "binary":
+        with BinaryDataset(fname, "r") as f:
+            variables = {
+                name: xr.Variable(var.dimensions, var._values(), var.attrs)
+                for (name, var) in f.variables.items()
+            }
+            ds = xr.Dataset(variables, attrs=f.attrs)
+        return xr.decode_cf(ds)
+    return xr.open_dataset(fname, engine="h5netcdf")
+
+
+def open_dataarray(fname):
+    """Open the only data variable of `fname` (like `xr.open_dataarray`)"""
+    ds = open_xarray(fname)
+    if len(ds.data_vars) != 1:
+        raise ValueError(
+            "{} has {} data variables, expected one".format(fname, len(ds.data_vars))
+        )
+    return ds[list(ds.data_vars)[0]]
+
+
+def save_xarray(ds, fname, encoding=None):
+    """Write the xr.Dataset `ds` to `fname`, with the backend for its extension
+
+    `encoding` holds `to_netcdf`-style chunking/compression keywords
+    for each variable.
+    """
+    if get_backend(fname) == "netcdf":
+        ds.to_netcdf(fname, engine="h5netcdf", encoding=encoding)
+        return
+    from xarray import conventions
+
+    encoding = encoding or {}
+    variables, attrs = conventions.cf_encoder(ds.variables, ds.attrs)
+    with open_dataset(fname, "w") as f:
+        for (key, val) in attrs.items():
+            f.setncattr(key, val)
+        for var in variables.values():
+            for dim, size in zip(var.dims, var.shape):
+                if dim not in f.dimensions:
+                    f.createDimension(dim, size)
+        for (name, var) in variables.items():
+            opts = dict(encoding.get(name, {}))
+            var_attrs = dict(var.attrs)
+            out = f.create_variable(
+                name,
+                var.dims,
+                var.dtype,
+                fillvalue=var_attrs.pop("_FillValue", None),
+                chunks=opts.pop("chunksizes", None),
+                **opts,
+            )
+            out[...] = var.values
+            for (key, val) in var_attrs.items():
+                out.setncattr(key, val)
+
+
+@functools.lru_cache()
+def _netcdf_dataset_class():
+    import h5netcdf.legacyapi as nc
+
+    class NetCDFDataset(nc.Dataset):
+        def flush(self):
+            super().flush()
+            # h5netcdf's flush doesn't flush the HDF5 file itself
+            self._h5file.flush()
+
+    return NetCDFDataset
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ValueError("Need to `pip install zarr` to use .zarr files")
+    return zarr
+
+
+def _to_json(value):
+    """Attribute value as a JSON-able python object"""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+class Dimension:
+    """Size of a dimension of a `ZarrDataset` or `BinaryDataset`"""
+
+    def __init__(self, root, name):
+        self._root = root
+        self.name = name
+
+    @property
+    def size(self):
+        return self._root._dims[self.name][0]
+
+    def isunlimited(self):
+        return self._root._dims[self.name][1]
+
+
+class _Group:
+    """The netCDF4-like methods shared by the Zarr and flat binary backends
+
+    The dimensions are shared by all groups, and kept by the root (the dataset).
+    Subclasses make, resize and persist the variables.
+    """
+
+    def __init__(self, root, name):
+        self._root = self if root is None else root
+        self.name = name
+        self._variables = {}
+        self._groups = {}
+
+    @property
+    def variables(self):
+        return dict(self._variables)
+
+    @property
+    def groups(self):
+        return dict(self._groups)
+
+    @property
+    def dimensions(self):
+        return {name: Dimension(self._root, name) for name in self._root._dims}
+
+    def __getitem__(self, name):
+        if name in self._variables:
+            return self._variables[name]
+        return self._groups[name]
+
+    def __contains__(self, name):
+        return name in self._variables or name in self._groups
+
+    def getncattr(self, name):
+        return self.attrs[name]
+
+    def ncattrs(self):
+        return list(self.attrs)
+
+    def createDimension(self, name, size=None):
+        self._root._dims[name] = [size or 0, size is None]
+        return Dimension(self._root, name)
+
+    def resize_dimension(self, name, size):
+        """Resize the dimension `name`, and all variables (in any group) using it"""
+        self._root._dims[name][0] = size
+        for var in self._root._all_variables():
+            if name in var.dimensions:
+                var._resize(tuple(self._root._dims[d][0] for d in var.dimensions))
+
+    def createVariable(
+        self,
+        varname,
+        datatype,
+        dimensions=(),
+        zlib=False,
+        complevel=4,
+        shuffle=True,
+        chunksizes=None,
+        fill_value=None,
+        **kwargs,
+    ):
+        return self.create_variable(
+            varname,
+            dimensions,
+            datatype,
+            fillvalue=fill_value,
+            chunks=chunksizes,
+            compression="gzip" if zlib else None,
+            compression_opts=complevel if zlib else None,
+            shuffle=zlib and shuffle,
+        )
+
+    def create_variable(
+        self,
+        name,
+        dimensions=(),
+        dtype=None,
+        fillvalue=None,
+        chunks=None,
+        compression=None,
+        compression_opts=None,
+        shuffle=False,
+        **kwargs,
+    ):
+        """Make a new variable, with the h5py-style chunking/compression keywords"""
+        dimensions = tuple(dimensions)
+        shape = tuple(self._root._dims[dim][0] for dim in dimensions)
+        dtype = np.dtype(object) if dtype is str else np.dtype(dtype)
+        var = self._create_variable(
+            name,
+            dimensions,
+            shape,
+            dtype,
+            fillvalue,
+            chunks,
+            dict(compression=compression, compression_opts=compression_opts),
+            shuffle,
+        )
+        self._variables[name] = var
+        return var
+
+    def _all_variables(self):
+        for var in self._variables.values():
+            yield var
+        for group in self._groups.values():
+            yield from group._all_variables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Variable:
+    """The netCDF4-like methods shared by the Zarr and flat binary variables"""
+
+    @property
+    def ndim(self):
+        return len(self.dimensions)
+
+    def getncattr(self, name):
+        return self.attrs[name]
+
+    def ncattrs(self):
+        return list(self.attrs)
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class ZarrDataset(_Group):
+    """Zarr (v3) directory store, with the netCDF4-like interface of `open_dataset`
+
+    The dimensions of each array are its `dimension_names`, and fill values are
+    also saved as "_FillValue" attributes, as xarray writes them.
+    All dimensions can grow.
+    """
+
+    def __init__(self, fname, mode="r", _root=None, _group=None):
+        zarr = _import_zarr()
+        super().__init__(_root, os.path.basename(os.fspath(fname).rstrip("/")))
+        if _group is None:
+            zarr_mode = {"x": "w-"}.get(mode, mode)
+            _group = zarr.open_group(fname, mode=zarr_mode, zarr_format=3)
+            self._dims = {}
+        self._group = _group
+        for (name, array) in _group.arrays():
+            var = ZarrVariable(self, array)
+            self._variables[name] = var
+            for dim, size in zip(var.dimensions, array.shape):
+                self._root._dims[dim] = [size, True]
+        for (name, group) in _group.groups():
+            self._groups[name] = ZarrDataset(name, mode, self._root, group)
+
+    @property
+    def attrs(self):
+        return dict(self._group.attrs)
+
+    def setncattr(self, name, value):
+        self._group.attrs[name] = _to_json(value)
+
+    def createDimension(self, name, size=None):
+        # Any zarr array can be resized
+        self._root._dims[name] = [size or 0, True]
+        return Dimension(self._root, name)
+
+    def createGroup(self, name):
+        group = ZarrDataset(name, None, self._root, self._group.create_group(name))
+        self._groups[name] = group
+        return group
+
+    def _create_variable(
+        self, name, dimensions, shape, dtype, fillvalue, chunks, compression, shuffle
+    ):
+        if dtype == object:
+            dtype = str
+        if chunks is None:
+            # Empty dimensions will grow, so leave room for them
+            chunks = tuple(size or 1024 for size in shape)
+        array = self._group.create_array(
+            name,
+            shape=shape,
+            dtype=dtype,
+            chunks=chunks,
+            fill_value=fillvalue,
+            compressors=_zarr_compressors(shuffle=shuffle, **compression),
+            dimension_names=dimensions or None,
+        )
+        if fillvalue is not None:
+            from xarray.backends.zarr import FillValueCoder
+
+            array.attrs["_FillValue"] = FillValueCoder.encode(fillvalue, array.dtype)
+        return ZarrVariable(self, array)
+
+    def flush(self):
+        # Each write goes straight to the store
+        pass
+
+    def close(self):
+        pass
+
+
+class ZarrVariable(_Variable):
+    """One array of a `ZarrDataset`"""
+
+    def __init__(self, group, array):
+        self._group = group
+        self._array = array
+        self.name = array.basename
+        self.dimensions = tuple(array.metadata.dimension_names or ())
+
+    @property
+    def shape(self):
+        return self._array.shape
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    @property
+    def attrs(self):
+        attrs = dict(self._array.attrs)
+        if "_FillValue" in attrs:
+            from xarray.backends.zarr import FillValueCoder
+
+            attrs["_FillValue"] = FillValueCoder.decode(
+                attrs["_FillValue"], self._array.dtype
+            )
+        return attrs
+
+    def setncattr(self, name, value):
+        self._array.attrs[name] = _to_json(value)
+
+    def __getitem__(self, key):
+        return self._array[key]
+
+    def __setitem__(self, key, value):
+        self._array[key] = value
+
+    def _resize(self, shape):
+        self._array.resize(shape)
+
+
+def _zarr_compressors(compression=None, compression_opts=None, shuffle=False):
+    """Zarr codecs matching the h5py `compression` of `utils.storage_options`
+
+    zlib is saved with gzip (or within blosc, to shuffle first), and lzf
+    (which zarr doesn't have) is replaced by blosc's lz4.
+    """
+    from zarr.codecs import BloscCodec, GzipCodec
+
+    blosc_shuffle = "shuffle" if shuffle else "noshuffle"
+    if compression is None:
+        return None
+    elif compression == "gzip" and shuffle:
+        return BloscCodec(cname="zlib", clevel=compression_opts, shuffle=blosc_shuffle)
+    elif compression == "gzip":
+        return GzipCodec(level=compression_opts)
+    elif compression == "lzf":
+        return BloscCodec(cname="lz4", clevel=5, shuffle=blosc_shuffle)
+    elif compression == 32001:
+        # hdf5plugin.Blosc: the level and shuffle are the 5th and 6th options
+        clevel, shuffle = compression_opts[4:6]
+        return BloscCodec(
+            cname="lz4", clevel=clevel, shuffle="shuffle" if shuffle else "noshuffle"
+        )
+    raise ValueError("Unknown compression for zarr: {}".format(compression))
+
+
+class BinaryDataset(_Group):
+    """Directory of flat binary files, with the netCDF4-like interface of `open_dataset`
+
+    Each numeric variable is a C-ordered (band sequential) raw file
+    "<name>.bin", described by an ENVI header "<name>.hdr" which is rewritten on
+    `flush`/`close`. String variables, the dimensions and all attributes are kept
+    in "metadata.json". Groups are subdirectories.
+    Variables can only grow along their first dimension, and new values are 0
+    (not the fill value) until written.
+    """
+
+    def __init__(self, fname, mode="r", _root=None, _meta=None):
+        super().__init__(_root, os.path.basename(os.fspath(fname).rstrip("/")))
+        self.path = os.fspath(fname)
+        if _root is None:
+            self.mode = mode
+            self._dims = {}
+            _meta = self._open(mode)
+            self._dims = {name: list(dim) for (name, dim) in _meta["dimensions"].items()}
+        self._meta = _meta
+        for name in _meta["variables"]:
+            self._variables[name] = BinaryVariable(self, name)
+        for name, group_meta in _meta["groups"].items():
+            group_path = os.path.join(self.path, name)
+            self._groups[name] = BinaryDataset(group_path, mode, self._root, group_meta)
+
+    def _open(self, mode):
+        """Load (or for "w"/"x", make) the metadata of the store"""
+        meta_file = os.path.join(self.path, METADATA_FILE)
+        if mode in ("r", "r+", "a") and os.path.exists(meta_file):
+            with open(meta_file) as f:
+                return json.load(f)
+        if mode in ("r", "r+"):
+            raise FileNotFoundError("{} is not a trodi binary store".format(self.path))
+        if os.path.exists(self.path):
+            if mode == "x":
+                raise FileExistsError(self.path)
+            if os.listdir(self.path) and not os.path.exists(meta_file):
+                raise ValueError(
+                    "Not overwriting {}: it isn't a trodi binary store".format(self.path)
+                )
+            if mode == "w":
+                shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+        meta = dict(dimensions={}, attrs={}, variables={}, groups={})
+        self._meta = meta
+        self._write_metadata()
+        return meta
+
+    @property
+    def attrs(self):
+        return dict(self._meta["attrs"])
+
+    def setncattr(self, name, value):
+        self._meta["attrs"][name] = _to_json(value)
+
+    def createGroup(self, name):
+        group_meta = dict(attrs={}, variables={}, groups={})
+        self._meta["groups"][name] = group_meta
+        group_path = os.path.join(self.path, name)
+        os.makedirs(group_path, exist_ok=True)
+        group = BinaryDataset(group_path, None, self._root, group_meta)
+        self._groups[name] = group
+        return group
+
+    def _create_variable(
+        self, name, dimensions, shape, dtype, fillvalue, chunks, compression, shuffle
+    ):
+        # The first dimension is the only one which can grow
+        for dim in dimensions[1:]:
+            if self._root._dims[dim][1]:
+                raise ValueError(
+                    "Only the first dimension of {} can be unlimited".format(name)
+                )
+        var_meta = dict(dimensions=list(dimensions), attrs={})
+        if dtype == object:
+            var_meta.update(dtype="str", values=[""] * int(np.prod(shape)))
+        else:
+            var_meta["dtype"] = dtype.newbyteorder("<").str
+            with open(os.path.join(self.path, name + ".bin"), "wb") as f:
+                f.truncate(int(np.prod(shape)) * dtype.itemsize)
+        if fillvalue is not None:
+            var_meta["attrs"]["_FillValue"] = _to_json(fillvalue)
+        self._meta["variables"][name] = var_meta
+        return BinaryVariable(self, name)
+
+    def flush(self):
+        """Write the memory maps, the ENVI headers and the metadata to disk"""
+        if self._root.mode == "r":
+            return
+        for var in self._root._all_variables():
+            var._flush()
+        self._root._write_metadata()
+
+    def _write_metadata(self):
+        meta = dict(self._meta, dimensions=self._dims)
+        # Write a new file, then replace, so an interrupted write doesn't lose it
+        meta_file = os.path.join(self.path, METADATA_FILE)
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump(meta, f, indent=1)
+        os.replace(meta_file + ".tmp", meta_file)
+
+    def close(self):
+        self.flush()
+        for var in self._root._all_variables():
+            var._mmap = None
+
+
+class BinaryVariable(_Variable):
+    """One flat binary (or string) variable of a `BinaryDataset`"""
+
+    def __init__(self, group, name):
+        self._group = group
+        self._meta = group._meta["variables"][name]
+        self.name = name
+        self.dimensions = tuple(self._meta["dimensions"])
+        self.filename = os.path.join(group.path, name + ".bin")
+        self._mmap = None
+
+    @property
+    def shape(self):
+        return tuple(self._group._root._dims[dim][0] for dim in self.dimensions)
+
+    @property
+    def dtype(self):
+        if self._meta["dtype"] == "str":
+            return np.dtype(object)
+        return np.dtype(self._meta["dtype"])
+
+    @property
+    def attrs(self):
+        return dict(self._meta["attrs"])
+
+    def setncattr(self, name, value):
+        self._meta["attrs"][name] = _to_json(value)
+
+    def _values(self):
+        """The memory map of the file (or an array of the strings)"""
+        if self._meta["dtype"] == "str":
+            return np.array(self._meta["values"], dtype=object).reshape(self.shape)
+        if self._mmap is None:
+            if 0 in self.shape:
+                # Empty files can't be memory-mapped
+                return np.empty(self.shape, dtype=self.dtype)
+            mode = "r" if self._group._root.mode == "r" else "r+"
+            self._mmap = np.memmap(
+                self.filename, dtype=self.dtype, mode=mode, shape=self.shape
+            )
+        return self._mmap
+
+    def __getitem__(self, key):
+        # Copy, so the caller gets an array it can modify (like h5py)
+        return np.array(self._values()[key])
+
+    def __setitem__(self, key, value):
+        if self._meta["dtype"] == "str":
+            values = self._values()
+            values[key] = value
+            self._meta["values"] = values.ravel().tolist()
+            return
+        self._values()[key] = value
+
+    def _resize(self, shape):
+        if self._meta["dtype"] == "str":
+            values = self._meta["values"]
+            size = int(np.prod(shape))
+            self._meta["values"] = (values + [""] * size)[:size]
+            return
+        self._flush()
+        self._mmap = None
+        with open(self.filename, "r+b") as f:
+            f.truncate(int(np.prod(shape)) * self.dtype.itemsize)
+
+    def _flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+        if self._meta["dtype"] != "str":
+            self._write_header()
+
+    def _write_header(self):
+        """Write the ENVI header describing the file as (bands, lines, samples)"""
+        shape = (1,) * (3 - self.ndim) + self.shape[-3:]
+        bands, lines, samples = shape
+        fields = [
+            ("description", "{{trodi {}}}".format(self.name)),
+            ("samples", samples),
+            ("lines", lines),
+            ("bands", bands),
+            ("header offset", 0),
+            ("file type", "ENVI Standard"),
+            ("data type", ENVI_DATA_TYPES[self.dtype.str[1:]]),
+            ("interleave", "bsq"),
+            ("byte order", 0),
+        ]
+        group = self._group
+        fill_value = self.attrs.get("_FillValue")
+        if fill_value is not None and np.isfinite(fill_value):
+            fields.append(("data ignore value", fill_value))
+        stack_dim = self.dimensions[0] if self.ndim == 3 else None
+        if stack_dim in group.variables and "units" in group[stack_dim].attrs:
+            from .utils import get_nc_dates
+
+            dates = get_nc_dates(group, stack_dim)
+            fields.append(("band names", "{{{}}}".format(", ".join(map(str, dates)))))
+        has_coords = "lat" in group.variables and "lon" in group.variables
+        if self.dimensions[-2:] == ("lat", "lon") and has_coords and lines * samples:
+            lat, lon = group["lat"][:].astype(float), group["lon"][:].astype(float)
+            lat_step = (lat[-1] - lat[0]) / max(lines - 1, 1)
+            lon_step = (lon[-1] - lon[0]) / max(samples - 1, 1)
+            # (1.5, 1.5) is the center of the first pixel
+            map_info = "{{Geographic Lat/Lon, 1.5, 1.5, {}, {}, {}, {}, WGS-84}}"
+            fields.append(
+                ("map info", map_info.format(lon[0], lat[0], lon_step, abs(lat_step)))
+            )
+        hdr_file = os.path.splitext(self.filename)[0] + ".hdr"
+        with open(hdr_file, "w") as f:
+            f.write("ENVI\n")
+            for key, val in fields:
+                f.write("{} = {}\n".format(key, val))
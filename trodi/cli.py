@@ -1,6 +1,7 @@
 import argparse
 
-from . import core
+from . import core, utils
+from .logger import profiler
 
 description = """
 '--level pixel' means individual pixels for each SAR date are labeled (good for larger scenes).
@@ -41,7 +42,8 @@ def get_cli_args():
         "--outfile",
         "-o",
         default="labels.nc",
-        help="Location to save final labels (default=%(default)s)",
+        help="Location to save final labels. Like `--avg-file`, the extension picks "
+        "the format (default=%(default)s)",
     )
     p.add_argument(
         "--level",
@@ -49,17 +51,59 @@ def get_cli_args():
         choices=["pixel", "scene"],
         help=("Level at which to label outliers. (default=%(default)s).\n"),
     )
+    p.add_argument(
+        "--label-method",
+        default="exact",
+        choices=["exact", "sketch"],
+        help="For `--level pixel`, compute exact per-pixel medians, or approximate them"
+        " with a fixed-size histogram per pixel (uses memory independent of the number "
+        "of dates) (default=%(default)s)",
+    )
+    p.add_argument(
+        "--label-encoding",
+        default="dense",
+        choices=["dense", "packed", "sparse"],
+        help="Storage of `--level pixel` labels: a byte per pixel per date, packed "
+        "8 dates per byte, or sparse coordinates of only the outliers (read with "
+        "`trodi.labelio.open_labels`) (default=%(default)s)",
+    )
+    p.add_argument(
+        "--sketch-bins",
+        default=64,
+        type=int,
+        help="Number of histogram bins per pixel for `--label-method sketch`. "
+        "Medians are accurate to (value range / bins) (default=%(default)s)",
+    )
     p.add_argument(
         "--avg-file",
         default="average_ifgs.nc",
-        help="Location to save stack of averaged igrams (default=%(default)s)",
+        help="Location to save stack of averaged igrams. The extension picks the "
+        "format: .nc for NetCDF, .zarr for a Zarr directory (needs `pip install "
+        "zarr`), or .bin for a directory of flat binary files with ENVI headers, which"
+        " can be memory-mapped (default=%(default)s)",
     )
     p.add_argument(
         "--deramp-order",
         default=2,
         type=int,
         help="Specify order of surface to remove from phase when averaging. "
-        " 1 = linear ramp, 2 = quadratic surface, 0 = no ramp adjustment (default=%(default)s)",
+        " 1 = linear ramp, 2 = quadratic surface, 0 = no ramp adjustment."
+        " Higher orders fit a polynomial surface of that degree (default=%(default)s)",
+    )
+    p.add_argument(
+        "--deramp-subsample",
+        default=1,
+        type=int,
+        help="Fit the deramping surface using 1 out of every N**2 pixels, then "
+        "evaluate it at full resolution. The fit difference versus using all pixels is "
+        "logged for the first date (default=%(default)s)",
+    )
+    p.add_argument(
+        "--deramp-sample",
+        default="stride",
+        choices=["stride", "random"],
+        help="How to subsample pixels for `--deramp-subsample`: a regular grid, "
+        "or a random sample with a fixed seed (default=%(default)s)",
     )
     p.add_argument(
         "--nsigma",
@@ -77,7 +121,15 @@ def get_cli_args():
     p.add_argument(
         "--overwrite",
         action="store_true",
-        help="Overwrite existing averaged files (default=%(default)s)",
+        help="Overwrite existing averaged files. Otherwise, an unfinished averaged file "
+        "is resumed from its last finished date (default=%(default)s)",
+    )
+    p.add_argument(
+        "--update",
+        action="store_true",
+        help="Update an existing averaged file: only recompute dates whose interferograms"
+        " changed, and append new dates. Pixel level labels are only rewritten where "
+        "they changed (default=%(default)s)",
     )
     p.add_argument(
         "--max-temporal-baseline",
@@ -113,16 +165,147 @@ def get_cli_args():
         " Skipping for interferograms will make averages including long term deformation, "
         "but is useful for, e.g., averaging correlation images.",
     )
+    p.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="Read each interferogram once, adding it to the averages of both its dates"
+        " (uses more memory, see `--max-memory`).",
+    )
+    p.add_argument(
+        "--max-memory",
+        type=float,
+        default=4.0,
+        help="Memory budget (in GB) for `--single-pass` averaging and pixel level "
+        "labeling. Larger stacks are processed in blocks of rows (default=%(default)s)",
+    )
+    p.add_argument(
+        "--tile-shape",
+        type=int,
+        nargs=2,
+        metavar=("ROWS", "COLS"),
+        help="Average the stack one tile at a time (out of core), reading only this "
+        "window of each interferogram (implies `--single-pass`). Also used to stream "
+        "tiles of the averages for pixel level labeling.",
+    )
+    p.add_argument(
+        "--storage-preset",
+        choices=list(utils.STORAGE_PRESETS),
+        help="Chunking/compression layout of the averaged stack and pixel level labels."
+        " 'write-optimized' chunks one date at a time with fast compression, "
+        "'time-series-read-optimized' chunks many dates of small windows together "
+        "(default: zlib compressed chunks of one date for the averages, "
+        "uncompressed labels)",
+    )
+    p.add_argument(
+        "--chunks",
+        type=int,
+        nargs=3,
+        metavar=("DATES", "ROWS", "COLS"),
+        help="Chunk shape of the output stacks (overrides `--storage-preset`)",
+    )
+    p.add_argument(
+        "--codec",
+        choices=["zlib", "lzf", "blosc", "none"],
+        help="Compression of the output stacks (overrides `--storage-preset`). "
+        "blosc needs `hdf5plugin`. Only zlib can be read by the netCDF-C library.",
+    )
+    p.add_argument(
+        "--complevel",
+        type=int,
+        help="Compression level for zlib (0-9) or blosc (overrides `--storage-preset`)",
+    )
+    p.add_argument(
+        "--shuffle",
+        action=argparse.BooleanOptionalAction,
+        help="Byte-shuffle the data before compressing (overrides `--storage-preset`)",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to use when computing averages (default=%(default)s)",
+    )
+    p.add_argument(
+        "--scheduler",
+        choices=["threads", "processes", "cluster"],
+        help="Compute the averages and pixel level labels as a lazy dask graph on the "
+        "local threaded or multiprocess scheduler, or a dask LocalCluster, with "
+        "`--workers` workers. Needs `pip install trodi[dask]`",
+    )
+    p.add_argument(
+        "--prefetch-depth",
+        type=int,
+        default=4,
+        help="Number of interferograms to read ahead in background threads while "
+        "averaging, so reads overlap the accumulation. 0 reads each one when needed "
+        "(default=%(default)s)",
+    )
+    p.add_argument(
+        "--prefetch-memory",
+        type=float,
+        default=1.0,
+        help="Memory cap (in GB) for the interferograms read ahead, which lowers "
+        "`--prefetch-depth` for large images (default=%(default)s)",
+    )
+    p.add_argument(
+        "--progress-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between progress lines (igrams/s, MB/s read and ETA) while "
+        "averaging. On a terminal, one status line is updated instead "
+        "(default=%(default)s)",
+    )
+    p.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Save the time, bytes read/written and peak memory of each stage (I/O, "
+        "accumulating, deramping, writing, labeling) of the run to FILE",
+    )
+    p.add_argument(
+        "--profile-format",
+        default="jsonl",
+        choices=["jsonl", "chrome"],
+        help="Format of `--profile`: one JSON object per line, or a Chrome trace "
+        "(for chrome://tracing or https://ui.perfetto.dev) (default=%(default)s)",
+    )
     return p.parse_args()
 
 
+def get_storage(args):
+    """Storage options for `utils.storage_options` from the command line args"""
+    storage = dict(
+        preset=args.storage_preset,
+        chunks=args.chunks,
+        codec=args.codec,
+        complevel=args.complevel,
+        shuffle=args.shuffle,
+    )
+    if all(val is None for val in storage.values()):
+        return None
+    return storage
+
+
 def average_and_label():
     """ """
     args = get_cli_args()
-    core.create_averages(**vars(args))
+    storage = get_storage(args)
+    profiler.enabled = args.profile is not None
+    core.create_averages(storage=storage, **vars(args))
     core.label_outliers(
         fname=args.avg_file,
         outfile=args.outfile,
         nsigma=args.nsigma,
         level=args.level,
+        tile_shape=args.tile_shape,
+        max_memory=args.max_memory,
+        method=args.label_method,
+        sketch_bins=args.sketch_bins,
+        update=args.update,
+        storage=storage,
+        label_encoding=args.label_encoding,
+        scheduler=args.scheduler,
+        workers=args.workers,
     )
+    if args.profile:
+        profiler.summary()
+        profiler.write(args.profile, fmt=args.profile_format)
@@ -4,17 +4,33 @@ Create labels of outlier interferogram pixels.
 
 Uses the averaged unwrapped igrams per date.
 """
+import functools
+import hashlib
+import itertools
+import json
 import os
+import warnings
 
 import numpy as np
 
-from . import sario, utils
-from .deramp import remove_ramp
-from .logger import get_log, log_runtime
+from . import backends, sario, utils
+from .deramp import (
+    RAMP_BLOCK_ROWS,
+    ramp_moments,
+    remove_ramp,
+    remove_ramps,
+    solve_ramp,
+    subsample_error,
+    subtract_ramp,
+)
+from .logger import Progress, get_log, log_runtime, profiled, profiler
 
 log = get_log()
+# Group of the averages file recording what each date layer was built from
+INPUTS_GROUP = "inputs"
 
 
+@log_runtime
 def label_outliers(
     fname=None,
     stack=None,
@@ -22,6 +38,15 @@ def label_outliers(
     nsigma=5,
     level="pixel",
     min_spread=0.5,
+    tile_shape=None,
+    max_memory=4.0,
+    method="exact",
+    sketch_bins=64,
+    update=False,
+    storage=None,
+    label_encoding="dense",
+    scheduler=None,
+    workers=None,
 ):
     """
 
@@ -32,7 +57,8 @@ def label_outliers(
     stack : xr.Dataset
         xr.Dataset containing the average, alternative to `fname` (Default value = None)
     outfile : str
-        Name of output file to save (Default value = "labels.nc")
+        Name of output file to save. Like the averages file, the extension picks
+        the format (see `backends`) (Default value = "labels.nc")
     nsigma : int
         Cutoff level to label outliers (Default value = 5)
     level : str
@@ -42,15 +68,99 @@ def label_outliers(
             (Default value = "pixel")
     min_spread : float
         minimum value to use for calculating variances (Default value = 0.5)
+    tile_shape : tuple[int, int]
+        For pixel level labels from `fname`, (rows, cols) of the tiles to stream
+        from `fname`, so only one tile of the stack is in memory at once
+        (Default value = None, picks blocks of rows to fit in `max_memory`)
+    max_memory : float
+        Memory budget (in GB) used to pick `tile_shape`, or for the sketch's
+        median and MAD blocks (Default value = 4.0)
+    method : str
+        For pixel level labels from `fname`, "exact" computes the median and MAD
+        from all dates of each pixel. "sketch" approximates them with a
+        `sketch_bins`-bin histogram per pixel, reading one date at a time, so memory
+        doesn't depend on the number of dates. See `sketch.HistogramSketch` for
+        the error bounds (Default value = "exact")
+    sketch_bins : int
+        Number of histogram bins per pixel for `method` = "sketch" (Default value = 64)
+    update : bool
+        For exact pixel level labels from `fname`, if `outfile` was made from an
+        earlier version of `fname` (the same dates, possibly with new dates
+        appended), only rewrite the tiles whose data or thresholds changed.
+        Otherwise, a warning is logged and all labels are recomputed
+        (Default value = False)
+    storage : str or dict
+        Chunking and compression for the pixel level labels and data, see
+        `utils.storage_options` (Default value = None, uncompressed)
+    label_encoding : str
+        How pixel level labels are stored in `outfile`. "dense" uses a byte per
+        pixel per date, "packed" packs 8 dates per byte (1/8 the size), and
+        "sparse" only saves the coordinates, data and threshold of the outliers
+        (not the full data cube). Use `labelio.open_labels` or
+        `labelio.read_labels` to load any of them (Default value = "dense")
+    scheduler : str
+        For exact pixel level labels from `fname` (without `update`), compute them
+        with a lazy dask graph on this scheduler, "threads", "processes" or
+        "cluster" (a `dask.distributed.LocalCluster`). See `lazy.label_pixels`
+        (Default value = None, tiles are labeled one at a time in this process)
+    workers : int
+        Number of dask workers for `scheduler` (Default value = None, one per core)
 
     Returns
     -------
         labels, threshold: The labeled xr.Dataset and the threshold used to label outliers
     """
-    if stack is None:
-        import xarray as xr
+    if label_encoding not in ("dense", "packed", "sparse"):
+        raise ValueError("`label_encoding` must be 'dense', 'packed' or 'sparse'")
+    utils.load_filter_plugins()
+    # Pixel level labels streamed from `fname` to `outfile`
+    from_file = level == "pixel" and stack is None and bool(outfile)
+    if update and (not from_file or method == "sketch"):
+        log.warning(
+            "`update` only applies to exact pixel level labels from `fname`, "
+            "so all labels are recomputed"
+        )
+    if from_file and method == "sketch":
+        return _label_pixels_sketch(
+            fname,
+            outfile,
+            nsigma=nsigma,
+            min_spread=min_spread,
+            sketch_bins=sketch_bins,
+            max_memory=max_memory,
+            storage=storage,
+            label_encoding=label_encoding,
+        )
+    elif from_file and scheduler and not update:
+        from . import lazy
 
-        stack = xr.open_dataarray(fname, engine="h5netcdf")
+        return lazy.label_pixels(
+            fname,
+            outfile,
+            nsigma=nsigma,
+            min_spread=min_spread,
+            tile_shape=tile_shape,
+            max_memory=max_memory,
+            scheduler=scheduler,
+            workers=workers,
+            storage=storage,
+            label_encoding=label_encoding,
+        )
+    elif from_file:
+        return _label_pixels_tiled(
+            fname,
+            outfile,
+            nsigma=nsigma,
+            min_spread=min_spread,
+            tile_shape=tile_shape,
+            max_memory=max_memory,
+            update=update,
+            storage=storage,
+            label_encoding=label_encoding,
+        )
+
+    if stack is None:
+        stack = backends.open_dataarray(fname)
     log.info("Computing {} sigma outlier labels at {} level.".format(nsigma, level))
 
     if level == "pixel":
@@ -73,15 +183,389 @@ def label_outliers(
     stack_data = stack_data.rename("data")
     threshold = threshold.rename("threshold")
     if outfile:
-        log.info("Saving outlier labels to {}:/labels".format(outfile))
-        labels.to_netcdf(outfile, engine="h5netcdf")
-        log.info("Saving data to {}:/data".format(outfile))
-        stack_data.to_netcdf(outfile, mode="a", engine="h5netcdf")
-        log.info("Saving threshold to {}:/threshold".format(outfile))
-        threshold.to_netcdf(outfile, mode="a", engine="h5netcdf")
+        log.info("Saving outlier labels, data and threshold to {}".format(outfile))
+        _save_labels(outfile, labels, stack_data, threshold, storage, label_encoding)
     return labels, threshold
 
 
+def _save_labels(
+    outfile, labels, data, threshold, storage=None, label_encoding="dense"
+):
+    """Write the labels, data and threshold to `outfile` in one session"""
+    import xarray as xr
+
+    from . import labelio
+
+    encoding = {}
+    if storage is not None and labels.ndim == 3:
+        opts = utils.storage_options(labels.shape[1:], storage)
+        encoding = dict(chunksizes=opts.pop("chunks"), **opts)
+    out = {}
+    if label_encoding == "packed" and labels.ndim == 3:
+        out[labelio.PACKED_NAME] = xr.DataArray(
+            labelio.pack_labels(labels.values),
+            dims=(labelio.PACKED_DIM,) + labels.dims[1:],
+            attrs={"stack_dim": labels.dims[0]},
+        )
+        if encoding:
+            chunks = encoding["chunksizes"]
+            packed_chunks = (labelio.packed_size(chunks[0]),) + chunks[1:]
+            encoding = {
+                labelio.PACKED_NAME: dict(encoding, chunksizes=packed_chunks),
+                "data": encoding,
+            }
+    elif label_encoding == "sparse" and labels.ndim == 3:
+        outliers = labelio.sparse_outliers(labels.values, data.values, threshold.values)
+        for name, values in outliers.items():
+            out[name] = xr.DataArray(values, dims=(labelio.OUTLIER_DIM,))
+        out["outlier_date"].attrs["stack_dim"] = labels.dims[0]
+        out["outlier_pixel"].attrs["shape"] = list(labels.shape[1:])
+        encoding = {}
+    else:
+        out["labels"] = labels
+        encoding = {"labels": encoding, "data": encoding} if encoding else {}
+    if label_encoding == "sparse" and labels.ndim == 3:
+        # Only the coordinates are kept from the full (date, lat, lon) data
+        ds = xr.Dataset(out, coords=data.coords)
+    else:
+        ds = xr.Dataset(dict(out, data=data))
+    ds["threshold"] = threshold
+    backends.save_xarray(ds, outfile, encoding=encoding)
+
+
+def _label_pixels_tiled(
+    fname,
+    outfile,
+    nsigma=5,
+    min_spread=0.5,
+    tile_shape=None,
+    max_memory=4.0,
+    update=False,
+    storage=None,
+    label_encoding="dense",
+):
+    """Label each pixel of the average stack in `fname`, one tile at a time
+
+    Each tile holds all dates for a window of pixels. The median, MAD, threshold
+    and labels for the tile are written to `outfile` before the next is read.
+
+    With `update`, an existing `outfile` is kept if its dates start the stack's
+    dates. A tile is then only rewritten where the data or threshold moved.
+    (Sparse labels have no data to compare, so they are always rewritten.)
+    """
+    from . import labelio
+
+    nold = _updatable_labels(fname, outfile, label_encoding) if update else None
+    with backends.open_dataset(fname, "r") as f_in, backends.open_dataset(
+        outfile, "w" if nold is None else "r+"
+    ) as f_out:
+        stack = _get_stack_var(f_in)
+        ndates, rows, cols = stack.shape
+        if tile_shape is None:
+            tile_shape = _label_tile_shape(stack.shape, stack.dtype, max_memory)
+        windows = utils.block_windows((rows, cols), tile_shape)
+        if nold is None:
+            out_vars = _create_label_vars(f_in, f_out, stack, storage, label_encoding)
+        else:
+            utils.append_nc_dates(f_out, utils.get_nc_dates(f_in))
+            if label_encoding == "packed":
+                f_out.resize_dimension(labelio.PACKED_DIM, labelio.packed_size(ndates))
+                out_labels = f_out[labelio.PACKED_NAME]
+            else:
+                out_labels = f_out["labels"]
+            out_data, out_threshold = f_out["data"], f_out["threshold"]
+        packed = label_encoding == "packed"
+
+        log.info(
+            "Saving outlier labels, data and threshold to {} in {} tile(s)".format(
+                outfile, len(windows)
+            )
+        )
+        nwritten = 0
+        for window in windows:
+            (row_start, row_stop), (col_start, col_stop) = window
+            tile_key = np.s_[row_start:row_stop, col_start:col_stop]
+            tile = _read_stack(stack, np.s_[:, row_start:row_stop, col_start:col_stop])
+            # Use all pixel absolute values here, shape: (ndates, rows, cols)
+            tile_data = np.abs(tile, out=tile)
+            with profiler.stage("label"):
+                tile_labels, tile_threshold = label(
+                    tile_data, nsigma=nsigma, min_spread=min_spread
+                )
+            if nold is None:
+                _write_label_tile(
+                    out_vars, window, tile_labels, tile_data, tile_threshold
+                )
+                continue
+
+            if packed:
+                tile_labels = labelio.pack_labels(tile_labels)
+            old_data = out_data[(slice(None, nold),) + tile_key]
+            changed = [
+                idx
+                for idx in range(ndates)
+                if idx >= nold
+                or not np.array_equal(old_data[idx], tile_data[idx], equal_nan=True)
+            ]
+            moved = not np.array_equal(
+                out_threshold[tile_key],
+                tile_threshold.astype(np.float32),
+                equal_nan=True,
+            )
+            if moved or (packed and changed):
+                # With a new threshold, any label in the tile could have flipped.
+                # (Packed dates share bytes, so all are rewritten)
+                out_labels[(slice(None),) + tile_key] = tile_labels
+            if moved:
+                out_threshold[tile_key] = tile_threshold
+            for idx in changed:
+                if not moved and not packed:
+                    out_labels[(idx,) + tile_key] = tile_labels[idx]
+                out_data[(idx,) + tile_key] = tile_data[idx]
+            nwritten += moved or bool(changed)
+        if nold is not None:
+            log.info("Updated {} out of {} tile(s)".format(nwritten, len(windows)))
+
+    return _load_labels(outfile)
+
+
+def _load_labels(outfile):
+    """Load the labels and threshold saved in `outfile`, then close it
+
+    Only the labels (a byte per pixel per date) and threshold are read, not the
+    full data stack. Nothing keeps `outfile` open, so it can be rewritten.
+    """
+    from . import labelio
+
+    with labelio.open_labels(outfile) as ds:
+        return ds["labels"].load(), ds["threshold"].load()
+
+
+def _label_tile_shape(shape, dtype, max_memory=4.0):
+    """Blocks of rows (with all dates) of a `shape` stack which fit in `max_memory`"""
+    ndates, rows, cols = shape
+    # Leave room for the temporaries made during the median/MAD
+    bytes_per_row = 4 * ndates * cols * np.dtype(dtype).itemsize
+    return (int(max(1, min(rows, max_memory * 1e9 // bytes_per_row))), cols)
+
+
+def _write_label_tile(out_vars, window, labels, data, threshold):
+    """Write all dates of one tile to the new variables from `_create_label_vars`"""
+    from . import labelio
+
+    out_labels, out_data, out_threshold = out_vars
+    (row_start, row_stop), (col_start, col_stop) = window
+    tile_key = np.s_[row_start:row_stop, col_start:col_stop]
+    with profiler.stage("write", bytes_written=threshold.nbytes) as stage:
+        out_threshold[tile_key] = threshold
+        if out_data is None:
+            # Sparse labels only keep the data of the outliers
+            out_labels.add(labels, data, threshold, window=window)
+            return
+        if out_labels.dimensions[0] == labelio.PACKED_DIM:
+            labels = labelio.pack_labels(labels)
+        out_labels[(slice(None),) + tile_key] = labels
+        out_data[(slice(None),) + tile_key] = data
+        stage["bytes_written"] += labels.nbytes + data.nbytes
+
+
+def _updatable_labels(fname, outfile, label_encoding="dense"):
+    """Number of dates in the labels `outfile` made from an earlier `fname`
+
+    Returns None if `outfile` is missing, or doesn't match `fname`
+    (different pixels or label encoding, or dates which don't start the
+    dates in `fname`), or for sparse labels
+    """
+    from .labelio import PACKED_NAME
+
+    if label_encoding == "sparse" or not os.path.exists(outfile):
+        return None
+    with backends.open_dataset(fname, "r") as f_in, backends.open_dataset(
+        outfile, "r"
+    ) as f_out:
+        dims = _get_stack_var(f_in).dimensions
+        if "threshold" not in f_out.variables or f_out["data"].dimensions != dims:
+            return None
+        if (PACKED_NAME in f_out.variables) != (label_encoding == "packed"):
+            return None
+        if not f_out.dimensions[dims[0]].isunlimited():
+            return None
+        if any(f_out[dim].shape != f_in[dim].shape for dim in dims[1:]):
+            return None
+        old_dates = utils.get_nc_dates(f_out, dims[0])
+        if utils.get_nc_dates(f_in, dims[0])[: len(old_dates)] != old_dates:
+            return None
+        return len(old_dates)
+
+
+def _label_pixels_sketch(
+    fname,
+    outfile,
+    nsigma=5,
+    min_spread=0.5,
+    sketch_bins=64,
+    max_memory=4.0,
+    storage=None,
+    label_encoding="dense",
+):
+    """Label each pixel using approximate medians from per-pixel histograms
+
+    Only one date layer of the stack is in memory at a time. The first pass over
+    the layers finds the largest value, which sets the histograms' range, the
+    second fills a `HistogramSketch`, and the third labels each layer. The
+    medians and MADs are computed in blocks of rows within `max_memory` GB.
+    """
+    from .sketch import HistogramSketch
+
+    with backends.open_dataset(fname, "r") as f_in, backends.open_dataset(
+        outfile, "w"
+    ) as f_out:
+        stack = _get_stack_var(f_in)
+        ndates, rows, cols = stack.shape
+        max_value = np.nan
+        for idx in range(ndates):
+            layer = _read_stack(stack, idx)
+            # fmax skips nans, so all-nan layers (dates without igrams) are ignored
+            max_value = np.fmax(max_value, np.fmax.reduce(np.abs(layer), axis=None))
+        # Without any values, every bin stays empty, so any range works
+        max_value = float(np.nan_to_num(max_value)) or 1.0
+
+        sketch = HistogramSketch(
+            (rows, cols), nbins=sketch_bins, max_value=max_value, max_memory=max_memory
+        )
+        log.info(
+            "Building {}-bin histograms of [0, {:.3g}] for {} dates".format(
+                sketch_bins, max_value, ndates
+            )
+        )
+        for idx in range(ndates):
+            layer = np.abs(_read_stack(stack, idx))
+            with profiler.stage("label"):
+                sketch.update(layer)
+
+        with profiler.stage("label"):
+            med, spread = sketch.median_mad()
+        log.info(
+            "Approximate median is within {:.3g} (MAD within {:.3g})".format(
+                sketch.bin_width, 2 * sketch.bin_width
+            )
+        )
+        spread = np.maximum(min_spread, nsigma * spread)
+        threshold = (med + spread).astype(np.float32)
+
+        out_labels, out_data, out_threshold = _create_label_vars(
+            f_in, f_out, stack, storage, label_encoding
+        )
+        log.info("Saving outlier labels, data and threshold to {}".format(outfile))
+        out_threshold[:, :] = threshold
+        for idx in range(ndates):
+            layer = np.abs(_read_stack(stack, idx))
+            layer_labels = layer > threshold
+            if label_encoding == "sparse":
+                out_labels.add(
+                    layer_labels[None], layer[None], threshold, date_idxs=[idx]
+                )
+                continue
+            out_data[idx, :, :] = layer
+            if label_encoding == "dense":
+                out_labels[idx, :, :] = layer_labels
+                continue
+            # Collect the bits of 8 dates before writing their byte
+            bit = 7 - idx % 8
+            if bit == 7:
+                packed = np.zeros((rows, cols), dtype=np.uint8)
+            packed |= layer_labels.astype(np.uint8) << bit
+            if bit == 0 or idx == ndates - 1:
+                out_labels[idx // 8, :, :] = packed
+
+    return _load_labels(outfile)
+
+
+def _get_stack_var(f):
+    """Get the (date, lat, lon) variable from an opened averages file"""
+    return [v for v in f.variables.values() if v.ndim == 3][0]
+
+
+def _read_stack(stack, key):
+    """Read `stack[key]`, with fill values as nans (matching xarray's decoding)"""
+    with profiler.stage("io") as stage:
+        data = stack[key]
+        stage["bytes_read"] = data.nbytes
+    fill_value = stack.attrs.get("_FillValue")
+    if fill_value is not None:
+        data[data == fill_value] = np.nan
+    return data
+
+
+class _StackLayer:
+    """One layer of an opened averages stack, read only as rows are indexed"""
+
+    def __init__(self, stack, idx):
+        self.stack = stack
+        self.idx = idx
+        self.shape = stack.shape[1:]
+
+    def __getitem__(self, rows):
+        return _read_stack(self.stack, (self.idx, rows))
+
+
+def _create_label_vars(f_in, f_out, stack, storage=None, label_encoding="dense"):
+    """Copy the coordinates of `stack` into `f_out`, and make the label variables
+
+    `storage` is passed to `utils.storage_options` (None leaves them uncompressed).
+    For the "packed" `label_encoding`, the labels variable holds 8 dates per byte.
+    For "sparse", a `labelio.SparseLabelWriter` is returned instead of the labels
+    variable, and there is no data variable (None).
+    """
+    from . import labelio
+
+    stack_dim = stack.dimensions[0]
+    for dim in stack.dimensions:
+        size = f_in.dimensions[dim].size
+        # The stack dimension is unlimited, so labels can be updated for new dates
+        f_out.createDimension(dim, None if dim == stack_dim else size)
+        if dim == stack_dim:
+            f_out.resize_dimension(dim, size)
+        coord = f_in[dim]
+        out_coord = f_out.createVariable(dim, coord.dtype, (dim,))
+        out_coord[:] = coord[:]
+        for (key, val) in coord.attrs.items():
+            if not key.startswith("_") and key not in ("CLASS", "NAME"):
+                out_coord.setncattr(key, val)
+    opts = utils.storage_options(
+        stack.shape[1:], {"codec": "none"} if storage is None else storage
+    )
+    if label_encoding == "sparse":
+        out_labels = labelio.SparseLabelWriter(f_out, stack_dim, stack.shape[1:])
+        out_data = None
+    elif label_encoding == "packed":
+        f_out.createDimension(labelio.PACKED_DIM, None)
+        f_out.resize_dimension(labelio.PACKED_DIM, labelio.packed_size(stack.shape[0]))
+        chunks = opts["chunks"]
+        packed_opts = dict(opts, chunks=(labelio.packed_size(chunks[0]),) + chunks[1:])
+        out_labels = f_out.create_variable(
+            labelio.PACKED_NAME,
+            (labelio.PACKED_DIM,) + stack.dimensions[1:],
+            "u1",
+            **packed_opts,
+        )
+        out_labels.setncattr("stack_dim", stack_dim)
+    else:
+        # Bools are stored as int8, marked so xarray loads them as bools
+        out_labels = f_out.create_variable("labels", stack.dimensions, "i1", **opts)
+        out_labels.setncattr("dtype", "bool")
+    if label_encoding != "sparse":
+        out_data = f_out.create_variable(
+            "data", stack.dimensions, "f4", fillvalue=np.nan, **opts
+        )
+    # The threshold is one (rows, cols) layer
+    opts["chunks"] = opts["chunks"][1:]
+    out_threshold = f_out.create_variable(
+        "threshold", stack.dimensions[1:], "f4", fillvalue=np.nan, **opts
+    )
+    return out_labels, out_data, out_threshold
+
+
 def label(
     data,
     nsigma=5,
@@ -89,6 +573,9 @@ def label(
 ):
     """Label outliers using the average interferograms
 
+    The threshold is the median of `data` plus `nsigma` MADs (of `abs(data)`,
+    see `mad`), or `min_spread` if larger.
+
     Parameters
     ----------
     data : xr.DataArray (or np.ndarray)
@@ -103,10 +590,27 @@ def label(
     -------
     labels : xr.DataArray
     threshold : xr.DataArray
+
+    Examples
+    --------
+    >>> data = np.array([[-10.0], [-5.0], [-4.0], [1.0]])
+    >>> labels, threshold = label(data, nsigma=1)
+    >>> print(threshold)
+    [-1.5348]
     """
-    med = data.median(axis=0)
-    spread = np.maximum(min_spread, nsigma * mad(data, axis=0))
+    med, spread = median_mad(data, axis=0)
+    if np.fmin.reduce(np.asarray(data), axis=None) < 0:
+        # `median_mad` gives the median of the absolute values, so for signed
+        # data, the threshold is still centered on the median of `data` itself
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            med = np.nanmedian(np.asarray(data), axis=0)
+    spread = np.maximum(min_spread, nsigma * spread)
     threshold = med + spread
+    if not isinstance(data, np.ndarray):
+        # Keep the coordinates (besides the one reduced over) of the xarray input
+        template = data[0].drop_vars(data.dims[0], errors="ignore")
+        threshold = template.copy(data=threshold)
     return (data > threshold), threshold
 
 
@@ -126,9 +630,84 @@ def mad(stack, axis=0, scale=1.4826):
         Multiplier to use for std dev (Default value = 1.4826)
 
     """
-    stack_abs = np.abs(stack)
-    med = np.nanmedian(stack_abs, axis=axis)
-    return scale * np.nanmedian(np.abs(stack_abs - med), axis=axis)
+    return median_mad(stack, axis=axis, scale=scale)[1]
+
+
+def median_mad(stack, axis=0, scale=1.4826):
+    """Median and median absolute deviation of `abs(stack)`, in one pass
+
+    Uses one working copy of the absolute values, which is partitioned in place
+    for the median, then reused for the deviations and partitioned again.
+    Pixels with no nans skip the slower nan-aware median.
+    The dtype of `stack` is kept (float32 stays float32).
+
+    Parameters
+    ----------
+    stack : xr.DataArray, or np.ndarray
+
+    axis : int, optional
+        axis along which to compute the median and MAD (Default value = 0)
+    scale : float
+        Multiplier for the MAD to use for std dev (Default value = 1.4826)
+
+    Returns
+    -------
+    med : ndarray
+        median of `abs(stack)` along `axis`
+    mad : ndarray
+        `scale` * median(abs(abs(stack) - med)) along `axis`
+
+    Examples
+    --------
+    >>> med, mad = median_mad(np.array([[1.0], [-2.0], [3.0], [np.nan]]))
+    >>> print(med, mad)
+    [2.] [1.4826]
+    """
+    # The one working copy: (pixels, n), so each pixel's values are contiguous
+    data = np.moveaxis(np.asarray(stack), axis, -1)
+    out_shape = data.shape[:-1]
+    buf = np.empty((int(np.prod(out_shape)), data.shape[-1]), dtype=data.dtype)
+    np.abs(data.reshape(buf.shape), out=buf)
+
+    has_nan = np.isnan(buf).any(axis=1)
+    if not has_nan.any():
+        med, mad = _partition_median_mad(buf)
+    else:
+        med = np.empty(buf.shape[0], dtype=buf.dtype)
+        mad = np.empty(buf.shape[0], dtype=buf.dtype)
+        good = ~has_nan
+        med[good], mad[good] = _partition_median_mad(buf[good])
+        nan_buf = buf[has_nan]
+        with warnings.catch_warnings():
+            # All-nan pixels give nan outputs, same as `np.nanmedian`
+            warnings.simplefilter("ignore", RuntimeWarning)
+            med[has_nan] = np.nanmedian(nan_buf, axis=1)
+            np.abs(nan_buf - med[has_nan, np.newaxis], out=nan_buf)
+            mad[has_nan] = np.nanmedian(nan_buf, axis=1)
+    return med.reshape(out_shape), (scale * mad).reshape(out_shape)
+
+
+def _partition_median_mad(buf):
+    """Median and (unscaled) MAD along axis 1 of `buf`, which has no nans
+
+    `buf` is overwritten.
+    """
+    med = _partition_median(buf)
+    np.subtract(buf, med[:, np.newaxis], out=buf)
+    np.abs(buf, out=buf)
+    return med, _partition_median(buf)
+
+
+def _partition_median(buf):
+    """Median along axis 1, partially sorting `buf` in place (same result as np.median)"""
+    n = buf.shape[1]
+    half = n // 2
+    if n % 2:
+        buf.partition(half, axis=1)
+        return buf[:, half].copy()
+    # After one partition, the other middle value is the max of the lower half
+    buf.partition(half, axis=1)
+    return (buf[:, :half].max(axis=1) + buf[:, half]) / 2
 
 
 @log_runtime
@@ -146,9 +725,22 @@ def create_averages(
     mask=None,
     mask_files=[],
     mask_is_zero=False,
+    single_pass=False,
+    max_memory=4.0,
+    workers=1,
+    tile_shape=None,
+    deramp_subsample=1,
+    deramp_sample="stride",
+    update=False,
+    storage=None,
+    scheduler=None,
+    progress_interval=10.0,
+    input_files=None,
+    prefetch_depth=4,
+    prefetch_memory=1.0,
     **kwargs,
 ):
-    """Create a NetCDF stack of "average interferograms" for each date
+    """Create a stack of "average interferograms" for each date
 
     Parameters
     ----------
@@ -160,9 +752,11 @@ def create_averages(
         filename of .rsc resource file, if loading binary files like snaphu outputs (Default value = None)
     deramp_order : int
         remove a linear (or quadratic ramp) from unwrapped igrams
-        if `deramp_order` = 1 (or 2) (Default value = 2)
+        if `deramp_order` = 1 (or 2). Higher orders fit a polynomial surface (Default value = 2)
     avg_file : str
-        name of output file to save stack (Default value = "average_ifgs.nc")
+        name of output file to save stack. The extension picks the format:
+        .nc for NetCDF, .zarr for Zarr, .bin for flat binary files with ENVI
+        headers (see `backends`) (Default value = "average_ifgs.nc")
     overwrite : bool
         clobber current output file, if exists (Default value = False)
     band : int
@@ -180,37 +774,89 @@ def create_averages(
     mask_is_zero : bool
         If True, areas in the `mask_files` which are 0 are the places to ignore. (Default value = False.)
         Note that `mask_is_zero=False` means that True/1s are the mask areas (matching numpy masking defaults).
+    single_pass : bool
+        Read each interferogram only once, adding it into the averages of both
+        of its dates, instead of reloading it for each date (Default value = False)
+    max_memory : float
+        Memory budget (in GB) for the single-pass accumulators. If the averages for
+        all dates do not fit, they are accumulated in blocks of rows, and spilled
+        to `avg_file` before deramping (Default value = 4.0)
+    workers : int
+        Number of processes used to compute the averages for each date.
+        The output is identical to using one worker. Not used with `single_pass`.
+        (Default value = 1)
+    tile_shape : tuple[int, int]
+        (rows, cols) of tiles to use for out-of-core, single-pass averaging.
+        Only one tile of each igram is read at a time, while ramps are still
+        fit using the whole image. With a `scheduler`, the dask chunks of each
+        igram (Default value = None, uses `max_memory` to pick row blocks if
+        `single_pass` is set, or tiles of 512 x 512 with a `scheduler`)
+    deramp_subsample : int
+        Fit ramps using only 1 in `deramp_subsample`**2 pixels, then evaluate them
+        at full resolution. The difference from a full resolution fit is logged
+        for the first date (Default value = 1)
+    deramp_sample : str
+        "stride" (regular grid) or "random" (fixed seed) pixel sampling
+        for `deramp_subsample` (Default value = "stride")
+    update : bool
+        If `avg_file` exists, only recompute the date layers whose interferograms
+        (or averaging parameters) changed since it was made, and append any new
+        dates after the last one. If dates were added before the end of the
+        stack, or removed, the file is rebuilt (Default value = False)
+    storage : str or dict
+        Chunking and compression of a new `avg_file`, either the name of a preset
+        ("write-optimized" or "time-series-read-optimized"), or a dict of options.
+        See `utils.storage_options` (Default value = None, zlib compressed chunks
+        of one date)
+    scheduler : str
+        Compute the averages with a lazy dask graph on this scheduler: "threads",
+        "processes", or "cluster" (a `dask.distributed.LocalCluster`), using
+        `workers` workers. See `lazy.write_averages` (Default value = None)
+    progress_interval : float
+        Seconds between progress lines (igrams/s, MB/s and ETA) in the log.
+        On a terminal, a status line is updated in place instead (Default value = 10.0)
+    input_files : str
+        Text file listing the igram filenames (one per line) to use instead of
+        searching `search_path` (Default value = None)
+    prefetch_depth : int
+        Number of igrams to read ahead in background threads while the current
+        ones are accumulated (0 reads each one when needed). See `sario.prefetch`
+        (Default value = 4)
+    prefetch_memory : float
+        Cap (in GB) on the memory of the igrams read ahead, per process
+        (Default value = 1.0)
+
+    Each date layer is marked finished in `avg_file` (with a fingerprint of its
+    igrams' names, sizes and modification times, and the parameters) once it's
+    written. If a run is stopped, running it again without `overwrite` only
+    computes the unfinished layers, plus any finished ones whose igrams or
+    parameters changed since. (Tiled single-pass runs mark all dates at the
+    end, so they restart from the beginning.)
 
     Returns
     -------
     str: name of output file
     """
-    import h5netcdf.legacyapi as nc
-
-    if os.path.exists(avg_file) and not overwrite:
-        log.info("{} exists, not overwriting.".format(avg_file))
-        return avg_file
-
-    log.info("Searching for igrams in {} with extention {}".format(search_path, ext))
-    ifg_date_list = utils.find_igrams(directory=search_path, ext=ext)
-    unw_file_list = utils.find_igrams(directory=search_path, ext=ext, parse=False)
-    sar_date_list = utils.dates_from_igrams(ifg_date_list)
-
-    nigrams, ndates = len(ifg_date_list), len(sar_date_list)
-    log.info("Found {} igrams, {} unique SAR dates".format(nigrams, ndates))
-
-    utils.create_empty_nc_stack(
-        avg_file,
-        date_list=sar_date_list,
-        rsc_file=rsc_file,
-        gdal_file=unw_file_list[0],
-        stack_data_name=ds_name,
-        overwrite=overwrite,
+    utils.load_filter_plugins()
+    if input_files is not None:
+        log.info("Reading igram names from {}".format(input_files))
+    else:
+        log.info(
+            "Searching for igrams in {} with extention {}".format(search_path, ext)
+        )
+    index = utils.IgramIndex.from_directory(
+        search_path,
+        ext=ext,
+        filename=input_files,
+        max_temporal_baseline=max_temporal_baseline,
     )
+    unw_file_list = index.unw_file_list
+    sar_date_list = index.sar_date_list
 
-    f = nc.Dataset(avg_file, mode="r+")
-    ds = f[ds_name]
-    _, rows, cols = ds.shape
+    nigrams, ndates = len(unw_file_list), len(sar_date_list)
+    log.info("Found {} igrams, {} unique SAR dates".format(nigrams, ndates))
+    img_info = sario.get_info(unw_file_list[0], rsc_file=rsc_file, band=band)
+    rows, cols = img_info.shape
 
     # Get masks for deramping
     # mask_igram_date_list = utils.load_intlist_from_h5(mask_fname)
@@ -219,50 +865,648 @@ def create_averages(
     if mask_files:
         mask = np.logical_or(mask, sario.load_mask(mask_files, mask_is_zero=mask_is_zero))
 
-    for (idx, cur_date) in enumerate(sar_date_list):
-        cur_unws = [
-            (fname, date_pair)
-            for (date_pair, fname) in zip(ifg_date_list, unw_file_list)
-            if (
-                cur_date in date_pair
-                and _temp_baseline(date_pair) <= max_temporal_baseline
+    date_igrams = [index.date_igrams(idx) for idx in range(ndates)]
+    params = dict(
+        band=band,
+        deramp_order=deramp_order,
+        deramp_subsample=deramp_subsample,
+        deramp_sample=deramp_sample,
+        do_flip=do_flip,
+        max_temporal_baseline=max_temporal_baseline,
+        mask=hashlib.blake2b(np.packbits(mask).tobytes(), digest_size=8).hexdigest(),
+    )
+    layer_inputs = [
+        _layer_inputs(cur_date, cur_unws, do_flip)
+        for (cur_date, cur_unws) in zip(sar_date_list, date_igrams)
+    ]
+    fingerprints = [_fingerprint(inputs, params) for inputs in layer_inputs]
+
+    date_idxs = None
+    if os.path.exists(avg_file) and not overwrite:
+        date_idxs = _find_stale_layers(
+            avg_file, ds_name, sar_date_list, fingerprints, params, (rows, cols), update
+        )
+        if date_idxs is None and not update:
+            log.info("{} exists, not overwriting.".format(avg_file))
+            return avg_file
+    if date_idxs is None:
+        utils.create_empty_nc_stack(
+            avg_file,
+            date_list=sar_date_list,
+            rsc_file=rsc_file,
+            gdal_file=unw_file_list[0],
+            stack_data_name=ds_name,
+            overwrite=overwrite or update,
+            storage=storage,
+        )
+        date_idxs = list(range(ndates))
+
+    f = backends.open_dataset(avg_file, mode="r+")
+    utils.append_nc_dates(f, sar_date_list)
+    ds = f[ds_name]
+    if not date_idxs:
+        log.info("{} is up to date.".format(avg_file))
+        f.close()
+        return avg_file
+    # Called with the indices of layers once they're written
+    on_finish = functools.partial(
+        _save_layer_inputs, f, layer_inputs, fingerprints, params
+    )
+    on_finish([])
+
+    deramp_kwargs = dict(subsample=deramp_subsample, sample=deramp_sample)
+    prefetch_kwargs = dict(depth=prefetch_depth, max_memory=prefetch_memory)
+    progress = Progress(
+        sum(len(date_igrams[idx]) for idx in date_idxs),
+        item_nbytes=rows * cols * img_info.dtype.itemsize,
+        interval=progress_interval,
+    )
+    if scheduler is not None:
+        from . import lazy
+
+        lazy.write_averages(
+            ds,
+            sar_date_list,
+            date_igrams,
+            unw_file_list,
+            date_idxs,
+            on_finish,
+            progress=progress,
+            scheduler=scheduler,
+            workers=workers,
+            rsc_file=rsc_file,
+            band=band,
+            tile_shape=tile_shape,
+            do_flip=do_flip,
+            deramp_order=deramp_order,
+            mask=mask,
+            deramp_kwargs=deramp_kwargs,
+        )
+    elif single_pass or tile_shape is not None:
+        _average_single_pass(
+            ds,
+            sar_date_list,
+            index,
+            rsc_file=rsc_file,
+            band=band,
+            do_flip=do_flip,
+            deramp_order=deramp_order,
+            mask=mask,
+            max_memory=max_memory,
+            tile_shape=tile_shape,
+            deramp_kwargs=deramp_kwargs,
+            prefetch_kwargs=prefetch_kwargs,
+            date_idxs=date_idxs,
+            on_finish=on_finish,
+            progress=progress,
+        )
+    else:
+        avg_kwargs = dict(
+            rsc_file=rsc_file,
+            band=band,
+            do_flip=do_flip,
+            deramp_order=deramp_order,
+            mask=mask,
+            deramp_kwargs=deramp_kwargs,
+            prefetch_kwargs=prefetch_kwargs,
+            shape=ds.shape[1:],
+        )
+        if workers > 1:
+            _average_parallel(
+                ds,
+                sar_date_list,
+                date_igrams,
+                workers,
+                date_idxs,
+                on_finish,
+                progress=progress,
+                **avg_kwargs,
             )
-        ]
+        else:
+            # One stream of all dates' igrams, so the next date's reads also
+            # overlap with deramping the current one
+            images = sario.prefetch(
+                (unwf for idx in date_idxs for (unwf, _) in date_igrams[idx]),
+                rsc_file=rsc_file,
+                band=band,
+                reuse_buffers=True,
+                **prefetch_kwargs,
+            )
+            # Each layer is written before the next date reuses its array
+            layer = None
+            for count, idx in enumerate(date_idxs):
+                cur_date, cur_unws = sar_date_list[idx], date_igrams[idx]
+                log.info(
+                    "Averaging {} igrams for {} ({} out of {})".format(
+                        len(cur_unws), cur_date, count + 1, len(date_idxs)
+                    )
+                )
+                layer = _average_date(
+                    cur_date, cur_unws, images=images, out=layer, **avg_kwargs
+                )
+                # Write the single layer out
+                with profiler.stage("write", date=cur_date, bytes_written=layer.nbytes):
+                    ds[idx, :, :] = layer
+                on_finish([idx])
+                progress.update(len(cur_unws))
+    progress.close()
+
+    # Dates without igrams are all nan, with no surface to compare
+    fitted = [idx for idx in date_idxs if date_igrams[idx]]
+    if deramp_order > 0 and deramp_subsample > 1 and fitted:
+        # Any surface left in the output is what the subsampled fit missed.
+        # Read it in blocks of rows, to stay within the engines' memory use
+        first = fitted[0]
+        max_diff, rms_diff = subsample_error(
+            _StackLayer(ds, first),
+            deramp_order,
+            mask=mask,
+            block_rows=RAMP_BLOCK_ROWS,
+            **deramp_kwargs,
+        )
         log.info(
-            "Averaging {} igrams for {} ({} out of {})".format(
-                len(cur_unws), cur_date, idx + 1, len(sar_date_list)
+            "Subsampled ({}, factor {}) ramp fit for {} differs from the full "
+            "resolution fit by {:.3g} max, {:.3g} RMS".format(
+                deramp_sample,
+                deramp_subsample,
+                sar_date_list[first],
+                max_diff,
+                rms_diff,
             )
         )
 
-        # reset the matrix to all zeros
-        out = 0
-        for unwf, date_pair in cur_unws:
-            # Since each ifg of (date1, date2) was made by phase2 - phase1,
-            # flip ifg phase so that it's always positive: (other date, cur_date)
-            # otherwise the date's phase was negative in the interferogram
-            flip = -1 if do_flip and (cur_date == date_pair[0]) else 1
-            img = sario.load(unwf, rsc_file=rsc_file, band=band)
-            out += flip * img
+    # Close to save it
+    f.close()
+    return avg_file
+
+
+def _layer_inputs(cur_date, cur_unws, do_flip):
+    """Describe the igrams averaged for `cur_date`
+
+    One "<sign><filename> <size> <mtime (ns)>" line per igram
+    """
+    lines = []
+    for unwf, sign in cur_unws:
+        stat = os.stat(unwf)
+        lines.append(
+            "{}{} {} {}".format(
+                "-" if do_flip and sign < 0 else "+",
+                os.path.basename(unwf),
+                stat.st_size,
+                stat.st_mtime_ns,
+            )
+        )
+    return "\n".join(lines)
 
-            # mask_idx = mask_igram_date_list.index(date_pair)
-            # mask |= mask_stack[mask_idx]
 
-        out /= len(cur_unws)
+def _fingerprint(layer_inputs, params):
+    """Hash of everything that went into one date layer"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(layer_inputs.encode())
+    return digest.hexdigest()
 
-        if deramp_order > 0:
-            out = remove_ramp(out, deramp_order=deramp_order, mask=mask)
+
+def _find_stale_layers(
+    avg_file, ds_name, sar_date_list, fingerprints, params, shape, update=False
+):
+    """Find which date layers of `avg_file` need to be (re)computed
+
+    Layers without a fingerprint were never finished (e.g. the run was stopped),
+    so they are always included. When there are any (the run is resumed), or with
+    `update`, so are the layers whose fingerprint changed (their igrams or the
+    parameters). With `update`, so are the new dates.
+
+    Returns
+    -------
+    list[int] or None
+        indices into `sar_date_list`, or None if `avg_file` can't be continued
+    """
+    reason = None
+    with backends.open_dataset(avg_file, "r") as f:
+        if INPUTS_GROUP not in f.groups or ds_name not in f.variables:
+            reason = "has no record of its inputs"
+        elif f[ds_name].shape[1:] != tuple(shape):
+            reason = "has a different image shape"
+        elif not f.dimensions["date"].isunlimited():
+            reason = "can't have new dates added"
         else:
-            out -= np.nanmean(out)
-            out[mask] = np.nan
+            old_dates = utils.get_nc_dates(f)
+            group = f.groups[INPUTS_GROUP]
+            old_fingerprints = group["fingerprint"][:]
+            old_params = json.loads(group.getncattr("params"))
+            if sar_date_list[: len(old_dates)] != old_dates:
+                reason = "has dates which are removed, or after new dates"
+            elif not update and len(old_dates) != len(sar_date_list):
+                reason = "was made from other dates (see `update`)"
+            elif not update and old_params != params and all(old_fingerprints):
+                reason = "was made from other parameters (see `update`)"
+    if reason is not None:
+        log.info("{} {}.".format(avg_file, reason))
+        return None
 
-        # Write the single layer out
-        ds[idx, :, :] = out
+    nold = len(old_dates)
+    unfinished = [idx for idx in range(nold) if not old_fingerprints[idx]]
+    changed = [
+        idx
+        for idx in range(nold)
+        if old_fingerprints[idx] and fingerprints[idx] != old_fingerprints[idx]
+    ]
+    if unfinished:
+        log.info("Resuming {}: {} unfinished date(s)".format(avg_file, len(unfinished)))
+    if not update and not unfinished:
+        if changed:
+            log.warning(
+                "{} date(s) in {} have changed igrams. Use `update` to recompute "
+                "them".format(len(changed), avg_file)
+            )
+        return []
+    if not update:
+        # A resumed file should match a fresh run, so stale layers are redone too
+        if changed:
+            log.info(
+                "Recomputing {} finished date(s) with changed igrams or "
+                "parameters".format(len(changed))
+            )
+        return sorted(unfinished + changed)
 
-    # Close to save it
-    f.close()
-    return avg_file
+    log.info(
+        "Updating {}: {} changed date(s), {} new date(s)".format(
+            avg_file, len(changed), len(sar_date_list) - nold
+        )
+    )
+    return sorted(unfinished + changed) + list(range(nold, len(sar_date_list)))
+
+
+def _save_layer_inputs(f, layer_inputs, fingerprints, params, date_idxs):
+    """Mark the layers `date_idxs` of `f` as finished, recording their inputs
+
+    The fingerprint is what marks a layer as done, so this must only be called
+    after the layer is written. The file is flushed (see `backends.open_dataset`)
+    so the record survives the process being stopped.
+    """
+    if INPUTS_GROUP in f.groups:
+        group = f.groups[INPUTS_GROUP]
+    else:
+        group = f.createGroup(INPUTS_GROUP)
+        group.createVariable("igrams", str, ("date",))
+        group.createVariable("fingerprint", str, ("date",))
+    group.setncattr("params", json.dumps(params, sort_keys=True))
+    for idx in date_idxs:
+        group["igrams"][idx] = layer_inputs[idx]
+        group["fingerprint"][idx] = fingerprints[idx]
+    f.flush()
+
+
+def _average_date(
+    cur_date,
+    cur_unws,
+    rsc_file=None,
+    band=2,
+    do_flip=True,
+    deramp_order=2,
+    mask=None,
+    deramp_kwargs={},
+    prefetch_kwargs={},
+    images=None,
+    out=None,
+    shape=None,
+):
+    """Load and average all igrams in `cur_unws` for `cur_date`, then deramp
+
+    `cur_unws` lists the (filename, sign) of each igram, from `utils.IgramIndex`.
+    The igrams are read with `sario.prefetch(..., **prefetch_kwargs)`, unless
+    `images` is a `sario.prefetch` iterator already reading them (next, in order).
+
+    The igrams are summed in place into `out` (a new array if None), and the
+    average is deramped in place, so no image-sized arrays are made per igram.
+    Returns `out`. A date without igrams gets a layer of nans (of `shape`, if
+    `out` is None).
+    """
+    if not cur_unws:
+        log.warning("No igrams to average for {}".format(cur_date))
+        out = np.empty(shape, dtype=np.float32) if out is None else out
+        out.fill(np.nan)
+        return out
+    own_images = images is None
+    if own_images:
+        images = sario.prefetch(
+            [unwf for (unwf, _) in cur_unws],
+            rsc_file=rsc_file,
+            band=band,
+            reuse_buffers=True,
+            **prefetch_kwargs,
+        )
+    for (num, (unwf, sign)) in enumerate(cur_unws):
+        # Since each ifg of (date1, date2) was made by phase2 - phase1,
+        # flip ifg phase so that it's always positive: (other date, cur_date)
+        # otherwise the date's phase was negative in the interferogram
+        flip = sign if do_flip else 1
+        # With prefetching, this is the time spent waiting on the read
+        with profiler.stage("io", date=cur_date) as stage:
+            _, img = next(images)
+            stage["bytes_read"] = img.nbytes
+        with profiler.stage("accumulate", date=cur_date):
+            if num == 0:
+                # reset the matrix to all zeros
+                out = np.empty_like(img) if out is None else out
+                out.fill(0)
+            if flip < 0:
+                np.subtract(out, img, out=out)
+            else:
+                np.add(out, img, out=out)
+
+        # mask_idx = mask_igram_date_list.index(date_pair)
+        # mask |= mask_stack[mask_idx]
+
+    if own_images:
+        # Free the read buffers before deramping
+        images.close()
+    out /= len(cur_unws)
+    with profiler.stage("deramp", date=cur_date):
+        return _finish_average(out, deramp_order, mask, **deramp_kwargs)
+
+
+def _average_parallel(
+    ds,
+    sar_date_list,
+    date_igrams,
+    workers,
+    date_idxs,
+    on_finish,
+    progress=None,
+    **kwargs,
+):
+    """Compute the averages of the dates `date_idxs` in a pool of `workers` processes
+
+    The current process is the only one writing to `ds`, committing each layer
+    (then calling `on_finish([idx])`) as soon as it's finished.
+    At most 2 * `workers` layers are in flight at once.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    ndates = len(date_idxs)
+    log.info("Averaging {} dates using {} workers".format(ndates, workers))
+    todo = ((idx, (sar_date_list[idx], date_igrams[idx])) for idx in date_idxs)
+    pending = {}
+    nfinished = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for (idx, (cur_date, cur_unws)) in itertools.islice(
+                todo, 2 * workers - len(pending)
+            ):
+                if profiler.enabled:
+                    # Send back the worker's stages along with the result
+                    fut = pool.submit(
+                        profiled, _average_date, cur_date, cur_unws, **kwargs
+                    )
+                else:
+                    fut = pool.submit(_average_date, cur_date, cur_unws, **kwargs)
+                pending[fut] = idx
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx = pending.pop(fut)
+                layer = fut.result()
+                if profiler.enabled:
+                    layer, events = layer
+                    profiler.add(events)
+                with profiler.stage(
+                    "write", date=sar_date_list[idx], bytes_written=layer.nbytes
+                ):
+                    ds[idx, :, :] = layer
+                on_finish([idx])
+                if progress is not None:
+                    progress.update(len(date_igrams[idx]))
+                nfinished += 1
+                log.info(
+                    "Finished averaging {} igrams for {} ({} out of {})".format(
+                        len(date_igrams[idx]), sar_date_list[idx], nfinished, ndates
+                    )
+                )
+
+
+def _finish_average(out, deramp_order, mask, subsample=1, sample="stride"):
+    """Remove the ramp (or mean) from one average, then apply the mask"""
+    if deramp_order > 0:
+        out = remove_ramp(
+            out, deramp_order=deramp_order, mask=mask, subsample=subsample, sample=sample
+        )
+    else:
+        out -= np.nanmean(out)
+        out[mask] = np.nan
+    return out
+
+
+def _average_single_pass(
+    ds,
+    sar_date_list,
+    index,
+    rsc_file=None,
+    band=2,
+    do_flip=True,
+    deramp_order=2,
+    mask=None,
+    max_memory=4.0,
+    tile_shape=None,
+    deramp_kwargs={},
+    prefetch_kwargs={},
+    date_idxs=None,
+    on_finish=None,
+    progress=None,
+):
+    """Fill `ds` with all averages while reading each interferogram once
+
+    Each igram of (early, late) is subtracted from the `early` accumulator
+    (when `do_flip`) and added to the `late` one. If all accumulators do
+    not fit in `max_memory` GB (or `tile_shape` is given), the stack is built
+    one tile at a time, reading only that window of each igram.
+
+    For tiles, the ramp (or mean) is still fit to the whole image: the sums for
+    the fit are collected while each tile is written, then a second pass over
+    the tiles of `ds` subtracts the surface.
+
+    The igrams of each date, and their signs, come from `index` (a `utils.IgramIndex`).
+    Only the layers for `date_idxs` are computed, reading just the igrams which
+    contribute to them (Default value = None, all dates). `on_finish(date_idxs)`
+    is called once all layers are written. `progress` (a `logger.Progress`)
+    is updated as each igram window is read. The igram windows of each tile are
+    read with `sario.prefetch(..., **prefetch_kwargs)`.
+    """
+    _, rows, cols = ds.shape
+    if date_idxs is None:
+        date_idxs = range(len(sar_date_list))
+    date_idxs = list(date_idxs)
+    ndates = len(date_idxs)
+    # The (accumulator position, sign) of each igram used for the dates `date_idxs`
+    igram_entries = {}
+    for pos, idx in enumerate(date_idxs):
+        key = index.date_slice(idx)
+        for igram_idx, sign in zip(index.igram_idxs[key], index.signs[key]):
+            igram_entries.setdefault(igram_idx, []).append((pos, sign))
+    # Read in file order
+    cur_unws = [
+        (index.unw_file_list[igram_idx], igram_entries[igram_idx])
+        for igram_idx in sorted(igram_entries)
+    ]
+    counts = np.diff(index.offsets)[date_idxs]
+
+    img_dtype = sario.get_info(cur_unws[0][0], rsc_file=rsc_file, band=band).dtype
+    if tile_shape is None:
+        bytes_per_row = ndates * cols * img_dtype.itemsize
+        block_rows = int(max(1, min(rows, max_memory * 1e9 // bytes_per_row)))
+        tile_shape = (block_rows, cols)
+    windows = utils.block_windows((rows, cols), tile_shape)
+    log.info(
+        "Accumulating {} igrams into {} dates in {} tile(s) of shape {}".format(
+            len(cur_unws), ndates, len(windows), tuple(tile_shape)
+        )
+    )
+    if progress is not None:
+        # Each igram is read once per tile, instead of once per date
+        progress.total = len(cur_unws) * len(windows)
+
+    # Sums to fit the whole-image ramp (or mean) across all tiles
+    if deramp_order > 0:
+        nmom = 2 * deramp_order + 1
+        gram_moments = np.zeros((ndates, nmom, nmom))
+        rhs_moments = np.zeros((ndates, deramp_order + 1, deramp_order + 1))
+    else:
+        tile_sums = np.zeros(ndates)
+        tile_counts = np.zeros(ndates)
+
+    # The first window is the largest, so the other tiles reuse part of its array
+    (row_start, row_stop), (col_start, col_stop) = windows[0]
+    acc_buf = np.empty(
+        (ndates, row_stop - row_start, col_stop - col_start), dtype=img_dtype
+    )
+    for (tidx, window) in enumerate(windows):
+        (row_start, row_stop), (col_start, col_stop) = window
+        acc = acc_buf[:, : row_stop - row_start, : col_stop - col_start]
+        acc.fill(0)
+        images = sario.prefetch(
+            [unwf for (unwf, _) in cur_unws],
+            rsc_file=rsc_file,
+            band=band,
+            window=window,
+            reuse_buffers=True,
+            **prefetch_kwargs,
+        )
+        for unwf, entries in cur_unws:
+            with profiler.stage("io", igram=os.path.basename(unwf)) as stage:
+                _, img = next(images)
+                stage["bytes_read"] = img.nbytes
+            if progress is not None:
+                progress.update(1, img.nbytes)
+            with profiler.stage("accumulate"):
+                # The ifg is (late - early phase), so it's flipped for the early date
+                for pos, sign in entries:
+                    if do_flip and sign < 0:
+                        acc[pos] -= img
+                    else:
+                        acc[pos] += img
+
+        for idx in range(ndates):
+            if counts[idx] == 0:
+                if tidx == 0:
+                    log.warning(
+                        "No igrams to average for {}".format(
+                            sar_date_list[date_idxs[idx]]
+                        )
+                    )
+                acc[idx] = np.nan
+                continue
+            acc[idx] /= counts[idx]
+
+        if len(windows) == 1:
+            with profiler.stage("deramp"):
+                if deramp_order > 0:
+                    # All dates share the mask, so fit all the ramps with one solve
+                    acc = remove_ramps(
+                        acc, deramp_order=deramp_order, mask=mask, **deramp_kwargs
+                    )
+                else:
+                    # Dates with no igrams are already all nan
+                    for idx in np.flatnonzero(counts):
+                        acc[idx] = _finish_average(acc[idx], deramp_order, mask)
+            _write_layers(ds, date_idxs, acc)
+            if on_finish is not None:
+                on_finish(date_idxs)
+            return
+
+        tile_mask = mask[row_start:row_stop, col_start:col_stop]
+        with profiler.stage("deramp"):
+            for idx in range(ndates):
+                if deramp_order > 0:
+                    acc[idx][tile_mask] = np.nan
+                    gm, rm = ramp_moments(
+                        acc[idx], deramp_order, window, (rows, cols), **deramp_kwargs
+                    )
+                    gram_moments[idx] += gm
+                    rhs_moments[idx] += rm
+                else:
+                    tile_sums[idx] += np.nansum(acc[idx])
+                    tile_counts[idx] += np.count_nonzero(~np.isnan(acc[idx]))
+
+        log.info("Writing tile {} out of {}".format(tidx + 1, len(windows)))
+        _write_layers(ds, date_idxs, acc, window)
+
+    fit_name = "ramps" if deramp_order > 0 else "means"
+    log.info("Removing whole-image {} from all tiles".format(fit_name))
+    if deramp_order > 0:
+        coeffs = [
+            solve_ramp(gram_moments[idx], rhs_moments[idx], deramp_order)
+            for idx in range(ndates)
+        ]
+    else:
+        # Dates with no valid pixels (no igrams) stay all nan
+        means = np.divide(
+            tile_sums,
+            tile_counts,
+            out=np.full(ndates, np.nan),
+            where=tile_counts > 0,
+        )
+
+    for window in windows:
+        (row_start, row_stop), (col_start, col_stop) = window
+        out = _read_layers(ds, date_idxs, window)
+        with profiler.stage("deramp"):
+            for idx in range(ndates):
+                if deramp_order > 0:
+                    subtract_ramp(out[idx], coeffs[idx], (rows, cols), window)
+                else:
+                    out[idx] -= means[idx]
+                    out[idx][mask[row_start:row_stop, col_start:col_stop]] = np.nan
+        _write_layers(ds, date_idxs, out, window)
+    if on_finish is not None:
+        on_finish(date_idxs)
+
+
+def _read_layers(ds, date_idxs, window):
+    """Read the `window` of the layers `date_idxs` of `ds`"""
+    (row_start, row_stop), (col_start, col_stop) = window
+    with profiler.stage("io") as stage:
+        if date_idxs == list(range(ds.shape[0])):
+            out = ds[:, row_start:row_stop, col_start:col_stop]
+        else:
+            out = np.stack(
+                [ds[idx, row_start:row_stop, col_start:col_stop] for idx in date_idxs]
+            )
+        stage["bytes_read"] = out.nbytes
+    return out
 
 
-def _temp_baseline(date_pair):
-    """Calculate the temporal baseline of a date pair"""
-    return abs(date_pair[1] - date_pair[0]).days
+def _write_layers(ds, date_idxs, layers, window=None):
+    """Write `layers` into the layers `date_idxs` of `ds` (within `window`)"""
+    if window is None:
+        window = ((0, ds.shape[1]), (0, ds.shape[2]))
+    (row_start, row_stop), (col_start, col_stop) = window
+    with profiler.stage("write", bytes_written=layers.nbytes):
+        if date_idxs == list(range(ds.shape[0])):
+            ds[:, row_start:row_stop, col_start:col_stop] = layers
+            return
+        # Unlimited dimensions can't be written with a list of indices
+        for idx, layer in zip(date_idxs, layers):
+            ds[idx, row_start:row_stop, col_start:col_stop] = layer
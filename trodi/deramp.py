@@ -1,5 +1,13 @@
+import collections
+import functools
+import hashlib
+import threading
+
 import numpy as np
 
+# Rows of the surface `subtract_ramp` evaluates at once
+RAMP_BLOCK_ROWS = 256
+
 
 def matrix_indices(shape, flatten=True):
     """Returns a pair of vectors for all indices of a 2D array
@@ -29,7 +37,9 @@ def matrix_indices(shape, flatten=True):
         return row_block, col_block
 
 
-def remove_ramp(z, deramp_order=1, mask=np.ma.nomask, copy=False):
+def remove_ramp(
+    z, deramp_order=1, mask=np.ma.nomask, copy=False, subsample=1, sample="stride"
+):
     """Estimates a linear plane through data and subtracts to flatten
 
     Used to remove noise artifacts from unwrapped interferograms
@@ -43,8 +53,14 @@ def remove_ramp(z, deramp_order=1, mask=np.ma.nomask, copy=False):
         deramp_order = 1 removes linear ramp, deramp_order = 2 fits quadratic surface (Default value = 1)
     mask :
          (Default value = np.ma.nomask)
-    copy :
-         (Default value = False)
+    copy : bool
+        If False, `z` is overwritten with the result, with nans in the masked
+        pixels (Default value = False)
+    subsample : int
+        Fit the surface using only 1 in `subsample`**2 pixels (Default value = 1)
+    sample : str
+        "stride" or "random": how to pick the pixels when `subsample` > 1
+        (Default value = "stride")
 
     Returns
     -------
@@ -56,15 +72,98 @@ def remove_ramp(z, deramp_order=1, mask=np.ma.nomask, copy=False):
     # Make a version of the image with nans in masked places
     z_masked[mask] = np.nan
     # Use this constrained version to find the plane fit
-    z_fit = estimate_ramp(z_masked, deramp_order)
+    coeff_matrix = _fit_ramp(z_masked, deramp_order, subsample=subsample, sample=sample)
     # Then use the non-masked as return value
-    return z - z_fit
+    return subtract_ramp(z.copy() if copy else z, coeff_matrix)
+
+
+def remove_ramps(
+    stack, deramp_order=1, mask=np.ma.nomask, copy=False, subsample=1, sample="stride"
+):
+    """Estimate and subtract a surface from each layer of a stack of images
+
+    All layers are fit with one shared solve of the normal equations
+    (using the pixels not masked, and not nan in every layer).
+    Layers with extra nan pixels reuse the shared sums, removing only
+    the contribution of their missing pixels before solving.
+
+    Parameters
+    ----------
+    stack : ndarray
+        3D array, (ndates, rows, cols), each layer interpreted as heights
+    deramp_order : int
+        degree of surface estimation (Default value = 1)
+    mask : ndarray
+        2D boolean array, True for pixels to ignore in the fit (Default value = np.ma.nomask)
+    copy : bool
+        If False, `stack` is overwritten with the result (Default value = False)
+    subsample : int
+        Fit the surfaces using only 1 in `subsample`**2 pixels (Default value = 1)
+    sample : str
+        "stride" or "random": how to pick the pixels when `subsample` > 1
+        (Default value = "stride")
+
+    Returns
+    -------
+    ndarray
+        stack with each layer's estimated surface removed,
+        with nans in the masked pixels
+    """
+    stack = stack.copy() if copy else stack
+    ndates, rows, cols = stack.shape
+    if subsample > 1:
+        # Few enough pixels in the sample that each layer is cheap on its own
+        for layer in stack:
+            layer[mask] = np.nan
+            subtract_ramp(layer, _fit_ramp(layer, deramp_order, subsample, sample))
+        return stack
+    # Sum one layer at a time, so the temporaries (nan masks, float64 copies)
+    # are the size of one layer, not of the whole stack
+    # Pixels usable in at least one layer:
+    base_valid = np.zeros((rows, cols), dtype=bool)
+    rhs_moments = np.zeros((ndates, deramp_order + 1, deramp_order + 1))
+    for (idx, layer) in enumerate(stack):
+        layer[mask] = np.nan
+        valid = ~np.isnan(layer)
+        base_valid |= valid
+        rhs_moments[idx] = _rhs_moments(np.where(valid, layer, 0), deramp_order)
+    gram_inv = _gram_inverse(base_valid, deramp_order)
+    gram_moments = None
 
+    coeff_matrices = np.zeros((ndates, deramp_order + 1, deramp_order + 1))
+    # Layers using all the `base_valid` pixels share the same left-hand side
+    has_missing = np.zeros(ndates, dtype=bool)
+    for (idx, layer) in enumerate(stack):
+        missing = np.isnan(layer) & base_valid
+        if not missing.any():
+            continue
+        has_missing[idx] = True
+        if gram_moments is None:
+            gram_moments = _gram_moments(base_valid, deramp_order)
+        ys, xs = np.nonzero(missing)
+        missing_moments = _point_moments(ys, xs, 2 * deramp_order, (rows, cols))
+        gram = _gram_matrix(gram_moments - missing_moments, deramp_order)
+        coeff_matrices[idx] = _solve_terms(
+            np.linalg.pinv(gram), rhs_moments[idx], deramp_order
+        )
+    shared = np.flatnonzero(~has_missing)
+    if shared.size:
+        coeff_matrices[shared] = _solve_terms(
+            gram_inv, rhs_moments[shared], deramp_order
+        )
+    for layer, coeff_matrix in zip(stack, coeff_matrices):
+        subtract_ramp(layer, coeff_matrix)
+    return stack
 
-def estimate_ramp(z, deramp_order):
-    """Takes a 2D array an fits a linear plane to the data
 
-    Ignores pixels that have nan values
+def estimate_ramp(z, deramp_order, subsample=1, sample="stride", seed=0):
+    """Takes a 2D array an fits a polynomial surface to the data
+
+    Ignores pixels that have nan values.
+    The fit uses the normal equations, built from sums over the image
+    rather than a (pixels x terms) design matrix. The inverse of the
+    left-hand side only depends on which pixels are valid, so it's cached
+    and reused for images with the same shape and nan/mask pattern.
 
     Parameters
     ----------
@@ -72,46 +171,459 @@ def estimate_ramp(z, deramp_order):
         2D array, interpreted as heights
     deramp_order : int
         degree of surface estimation
-        deramp_order = 1 removes linear ramp, deramp_order = 2 fits quadratic surface
-    deramp_order : int
-        degree of surface estimation
-        deramp_order = 1 removes linear ramp, deramp_order = 2 fits quadratic surface
-        deramp_order (int)
+        deramp_order = 1 removes linear ramp, deramp_order = 2 fits quadratic surface,
+        higher orders fit all terms x**i * y**j with i + j <= deramp_order
+    subsample : int
+        Fit the surface using only 1 in `subsample`**2 pixels, then evaluate
+        it at full resolution (Default value = 1, uses all pixels)
+    sample : str
+        How to choose pixels when `subsample` > 1:
+        "stride" takes every `subsample`-th row and column,
+        "random" takes a random sample (the same pixels on every call)
+        (Default value = "stride")
+    seed : int
+        Random seed for `sample` = "random" (Default value = 0)
 
     Returns
     -------
     ndarray
-        the estimated coefficients of the surface
-        For deramp_order = 1, it will be 3 numbers, a, b, c from
+        the estimated surface, same shape as `z`
+        For deramp_order = 1, the surface is
         ax + by + c = z
-        For deramp_order = 2, it will be 6:
+        For deramp_order = 2, it is
         f + ax + by + cxy + dx^2 + ey^2
 
     """
-    if deramp_order > 2:
-        raise ValueError("Order only implemented for 1 and 2")
-    # Note: rows == ys, cols are xs
-    yidxs, xidxs = matrix_indices(z.shape, flatten=True)
-    # c_ stacks 1D arrays as columns into a 2D array
-    zflat = z.flatten()
-    good_idxs = ~np.isnan(zflat)
-    if deramp_order == 1:
-        A = np.c_[np.ones(xidxs.shape), xidxs, yidxs]
-        coeffs, _, _, _ = np.linalg.lstsq(A[good_idxs], zflat[good_idxs], rcond=None)
-        # coeffs will be a, b, c in the equation z = ax + by + c
-        c, a, b = coeffs
-        # We want full blocks, as opposed to matrix_index flattened
-        y_block, x_block = matrix_indices(z.shape, flatten=False)
-        z_fit = a * x_block + b * y_block + c
-
-    elif deramp_order == 2:
-        A = np.c_[
-            np.ones(xidxs.shape), xidxs, yidxs, xidxs * yidxs, xidxs**2, yidxs**2
-        ]
-        # coeffs will be 6 elements for the quadratic
-        coeffs, _, _, _ = np.linalg.lstsq(A[good_idxs], zflat[good_idxs], rcond=None)
-        yy, xx = matrix_indices(z.shape, flatten=True)
-        idx_matrix = np.c_[np.ones(xx.shape), xx, yy, xx * yy, xx**2, yy**2]
-        z_fit = np.dot(idx_matrix, coeffs).reshape(z.shape)
-
-    return z_fit
+    coeff_matrix = _fit_ramp(z, deramp_order, subsample, sample, seed)
+    return evaluate_ramp(coeff_matrix, z.shape)
+
+
+def _fit_ramp(z, deramp_order, subsample=1, sample="stride", seed=0):
+    """Coefficient matrix (as from `solve_ramp`) of the surface `estimate_ramp` fits"""
+    if subsample > 1:
+        gram_moments, rhs_moments = ramp_moments(
+            z, deramp_order, subsample=subsample, sample=sample, seed=seed
+        )
+        return solve_ramp(gram_moments, rhs_moments, deramp_order)
+
+    valid = ~np.isnan(z)
+    gram_inv = _gram_inverse(valid, deramp_order)
+    rhs_moments = _rhs_moments(np.where(valid, z, 0), deramp_order)
+    return _solve_terms(gram_inv, rhs_moments, deramp_order)
+
+
+def subsample_error(
+    z, deramp_order, subsample, sample="stride", mask=np.ma.nomask, block_rows=None
+):
+    """Compare the surface fit from a subsample to the full resolution fit
+
+    Use to pick a safe `subsample` factor for `estimate_ramp`.
+
+    Parameters
+    ----------
+    z : ndarray
+        2D array, or an array-like (e.g. a variable of an open file) read
+        `block_rows` rows at a time
+    deramp_order : int
+        degree of surface estimation
+    subsample : int
+        subsample factor to compare, as in `estimate_ramp`
+    sample : str
+        "stride" or "random", as in `estimate_ramp` (Default value = "stride")
+    mask : ndarray
+        2D boolean array, True for pixels to ignore in the fits (Default value = np.ma.nomask)
+    block_rows : int
+        Both fits are summed from the `ramp_moments` of blocks of this many rows,
+        and their difference is evaluated block by block, so only one block of
+        `z` is in memory at once (Default value = None, all rows at once)
+
+    Returns
+    -------
+    max_diff : float
+        maximum absolute difference between the two surfaces
+    rms_diff : float
+        root mean square difference between the two surfaces
+
+    Examples
+    --------
+    >>> z = np.add.outer(np.arange(6.0), np.arange(5.0))
+    >>> max_diff, rms_diff = subsample_error(z, 1, 2, block_rows=4)
+    >>> bool(max_diff < 1e-9)
+    True
+    """
+    rows, cols = shape = z.shape
+    if block_rows is None:
+        block_rows = rows
+    windows = [
+        ((start, min(start + block_rows, rows)), (0, cols))
+        for start in range(0, rows, block_rows)
+    ]
+    # (gram, rhs) sums for the full resolution fit, then the subsampled one
+    sums = [[0, 0], [0, 0]]
+    for window in windows:
+        (start, stop), _ = window
+        block = np.array(z[start:stop], dtype=np.float64)
+        if mask is not np.ma.nomask:
+            block[mask[start:stop]] = np.nan
+        for (fit_sums, factor) in zip(sums, (1, subsample)):
+            moments = ramp_moments(
+                block, deramp_order, window, shape, subsample=factor, sample=sample
+            )
+            fit_sums[0] += moments[0]
+            fit_sums[1] += moments[1]
+    full_fit, sub_fit = [solve_ramp(*fit_sums, deramp_order) for fit_sums in sums]
+
+    # The surfaces are linear in the coefficients, so evaluate their difference
+    max_diff, sum_sq = 0.0, 0.0
+    for window in windows:
+        diff = evaluate_ramp(sub_fit - full_fit, shape, window)
+        max_diff = max(max_diff, np.max(np.abs(diff)))
+        sum_sq += np.sum(diff**2)
+    return max_diff, np.sqrt(sum_sq / (rows * cols))
+
+
+@functools.lru_cache(maxsize=16)
+def sample_pixels(shape, subsample, sample="stride", seed=0):
+    """Choose about 1 in `subsample`**2 pixels of an image to fit a surface
+
+    Returns
+    -------
+    ys, xs : ndarray
+        row and column indices of the chosen pixels
+
+    Examples
+    --------
+    >>> ys, xs = sample_pixels((4, 5), 2)
+    >>> ys
+    array([0, 0, 0, 2, 2, 2])
+    >>> xs
+    array([0, 2, 4, 0, 2, 4])
+    """
+    rows, cols = shape
+    if sample == "stride":
+        ys, xs = np.meshgrid(
+            np.arange(0, rows, subsample), np.arange(0, cols, subsample), indexing="ij"
+        )
+        ys, xs = ys.ravel(), xs.ravel()
+    elif sample == "random":
+        rng = np.random.default_rng(seed)
+        npix = max(1, (rows * cols) // subsample**2)
+        flat_idxs = np.sort(rng.choice(rows * cols, size=npix, replace=False))
+        ys, xs = np.unravel_index(flat_idxs, shape)
+    else:
+        raise ValueError("`sample` must be 'stride' or 'random'")
+    ys.flags.writeable = xs.flags.writeable = False
+    return ys, xs
+
+
+def ramp_moments(
+    z, deramp_order, window=None, shape=None, subsample=1, sample="stride", seed=0
+):
+    """Accumulate the sums needed for a least squares ramp fit
+
+    Moments from separate windows of the same image can be added together,
+    so a whole-image ramp can be fit without loading the whole image.
+
+    Parameters
+    ----------
+    z : ndarray
+        2D array, interpreted as heights. Nan pixels are ignored
+    deramp_order : int
+        degree of surface estimation
+    window : tuple[tuple[int, int], tuple[int, int]]
+        ((row_start, row_stop), (col_start, col_stop)) position of `z`
+        within the full image (Default value = None, `z` is the full image)
+    shape : tuple[int, int]
+        (rows, cols) of the full image (Default value = None, `z.shape`)
+    subsample : int
+        Use only the pixels from `sample_pixels` of the full image (Default value = 1)
+    sample : str
+        "stride" or "random", passed to `sample_pixels` (Default value = "stride")
+    seed : int
+        passed to `sample_pixels` (Default value = 0)
+
+    Returns
+    -------
+    gram_moments : ndarray
+        sum of y**i * x**j over the valid pixels, shape (2*order + 1, 2*order + 1)
+    rhs_moments : ndarray
+        sum of z * y**i * x**j over the valid pixels, shape (order + 1, order + 1)
+    """
+    if subsample > 1:
+        if shape is None:
+            shape = z.shape
+        if window is None:
+            window = ((0, shape[0]), (0, shape[1]))
+        (row_start, row_stop), (col_start, col_stop) = window
+        if sample == "stride":
+            return _strided_fit_moments(z, subsample, deramp_order, shape, window)
+        ys, xs = sample_pixels(tuple(shape), subsample, sample=sample, seed=seed)
+        in_window = (
+            (ys >= row_start) & (ys < row_stop) & (xs >= col_start) & (xs < col_stop)
+        )
+        return _point_fit_moments(
+            z, ys[in_window], xs[in_window], deramp_order, shape, window
+        )
+
+    valid = ~np.isnan(z)
+    gram_moments = _gram_moments(valid, deramp_order, window, shape)
+    rhs_moments = _rhs_moments(np.where(valid, z, 0), deramp_order, window, shape)
+    return gram_moments, rhs_moments
+
+
+def solve_ramp(gram_moments, rhs_moments, deramp_order):
+    """Solve for the surface coefficients using the output of `ramp_moments`
+
+    Returns
+    -------
+    ndarray
+        coefficient matrix `C`, where the surface is sum(C[i, j] * y**i * x**j)
+    """
+    gram_inv = np.linalg.pinv(_gram_matrix(gram_moments, deramp_order))
+    return _solve_terms(gram_inv, rhs_moments, deramp_order)
+
+
+def evaluate_ramp(coeff_matrix, shape, window=None):
+    """Evaluate the surface from `solve_ramp` on the image (or a window of it)
+
+    The surface is separable into (rows x terms) @ (terms x terms) @ (terms x cols),
+    so no full-size coordinate grids are made.
+
+    Parameters
+    ----------
+    coeff_matrix : ndarray
+        output of `solve_ramp`
+    shape : tuple[int, int]
+        (rows, cols) of the full image
+    window : tuple[tuple[int, int], tuple[int, int]]
+        ((row_start, row_stop), (col_start, col_stop)) to evaluate
+        (Default value = None, the full image)
+
+    Returns
+    -------
+    ndarray
+        the surface, with shape of the window
+    """
+    if window is None:
+        window = ((0, shape[0]), (0, shape[1]))
+    (row_start, row_stop), (col_start, col_stop) = window
+    out_shape = (row_stop - row_start, col_stop - col_start)
+    ypow, xpow = _window_powers(
+        out_shape, len(coeff_matrix) - 1, _as_tuple(window), tuple(shape)
+    )
+    return ypow @ coeff_matrix @ xpow.T
+
+
+def subtract_ramp(
+    z, coeff_matrix, shape=None, window=None, block_rows=RAMP_BLOCK_ROWS
+):
+    """Subtract the surface from `solve_ramp` from `z`, in place
+
+    Like `z -= evaluate_ramp(coeff_matrix, shape, window)`, but the surface is
+    evaluated `block_rows` rows at a time into one small buffer, so no
+    full-size surface is made.
+
+    Parameters
+    ----------
+    z : ndarray
+        2D image, or the `window` of the full image
+    coeff_matrix : ndarray
+        output of `solve_ramp`
+    shape : tuple[int, int]
+        (rows, cols) of the full image (Default value = None, `z.shape`)
+    window : tuple[tuple[int, int], tuple[int, int]]
+        ((row_start, row_stop), (col_start, col_stop)) position of `z`
+        within the full image (Default value = None, `z` is the full image)
+    block_rows : int
+        rows of the surface to evaluate at once (Default value = RAMP_BLOCK_ROWS)
+
+    Returns
+    -------
+    ndarray
+        `z`, with the surface removed
+
+    Examples
+    --------
+    >>> z = np.arange(12, dtype=np.float32).reshape((3, 4))
+    >>> coeffs = _fit_ramp(z, 1)
+    >>> out = subtract_ramp(z.copy(), coeffs, block_rows=2)
+    >>> np.allclose(out, z - evaluate_ramp(coeffs, z.shape), atol=1e-5)
+    True
+    """
+    if shape is None:
+        shape = z.shape
+    if window is None:
+        window = ((0, shape[0]), (0, shape[1]))
+    rows, cols = z.shape
+    ypow, xpow = _window_powers(
+        (rows, cols), len(coeff_matrix) - 1, _as_tuple(window), tuple(shape)
+    )
+    # Same products as `evaluate_ramp`, split into blocks of rows
+    left = ypow @ coeff_matrix
+    buf = np.empty((min(block_rows, rows), cols))
+    for start in range(0, rows, block_rows):
+        stop = min(start + block_rows, rows)
+        surface = np.matmul(left[start:stop], xpow.T, out=buf[: stop - start])
+        np.subtract(z[start:stop], surface, out=z[start:stop])
+    return z
+
+
+# Number of (shape, valid pixel) patterns to keep inverted normal matrices for
+GRAM_CACHE_SIZE = 16
+_gram_cache = collections.OrderedDict()
+# Ramps are fit from worker threads (dask's threaded scheduler), so guard the cache
+_gram_cache_lock = threading.Lock()
+
+
+def _gram_inverse(valid, deramp_order):
+    """Inverse of the normal equations' matrix for the `valid` pixels, cached"""
+    key = (
+        valid.shape,
+        deramp_order,
+        hashlib.blake2b(np.packbits(valid).tobytes(), digest_size=16).digest(),
+    )
+    with _gram_cache_lock:
+        if key in _gram_cache:
+            _gram_cache.move_to_end(key)
+            return _gram_cache[key]
+
+    gram = _gram_matrix(_gram_moments(valid, deramp_order), deramp_order)
+    gram_inv = np.linalg.pinv(gram)
+    with _gram_cache_lock:
+        _gram_cache[key] = gram_inv
+        if len(_gram_cache) > GRAM_CACHE_SIZE:
+            _gram_cache.popitem(last=False)
+    return gram_inv
+
+
+def _gram_moments(valid, deramp_order, window=None, shape=None):
+    """sum(y**i * x**j) over the `valid` pixels, for i, j <= 2 * deramp_order"""
+    ypow, xpow = _window_powers(
+        valid.shape, 2 * deramp_order, _as_tuple(window), _as_tuple(shape)
+    )
+    return ypow.T @ (valid.astype(np.float64) @ xpow)
+
+
+def _rhs_moments(zfilled, deramp_order, window=None, shape=None):
+    """sum(z * y**i * x**j) for i, j <= deramp_order. `zfilled` has 0s for nans
+
+    `zfilled` may be a stack of images, where the last two dimensions are (rows, cols).
+    """
+    ypow, xpow = _window_powers(
+        zfilled.shape[-2:], deramp_order, _as_tuple(window), _as_tuple(shape)
+    )
+    return ypow.T @ (zfilled.astype(np.float64) @ xpow)
+
+
+def _gram_matrix(gram_moments, deramp_order):
+    """(terms x terms) left-hand side of the normal equations"""
+    terms = _ramp_terms(deramp_order)
+    return np.array(
+        [[gram_moments[yi + yj, xi + xj] for (yj, xj) in terms] for (yi, xi) in terms]
+    )
+
+
+def _solve_terms(gram_inv, rhs_moments, deramp_order):
+    """Solve the normal equations, returning the coefficients as a matrix
+
+    `rhs_moments` may have leading dimensions to solve for many right-hand sides.
+    """
+    terms = _ramp_terms(deramp_order)
+    yidxs, xidxs = map(list, zip(*terms))
+    rhs = rhs_moments[..., yidxs, xidxs]
+    coeffs = rhs @ gram_inv.T
+    coeff_matrix = np.zeros(rhs_moments.shape[:-2] + (deramp_order + 1,) * 2)
+    coeff_matrix[..., yidxs, xidxs] = coeffs
+    return coeff_matrix
+
+
+def _strided_fit_moments(z, subsample, deramp_order, shape, window):
+    """Same as `ramp_moments`, using every `subsample`-th row and col of the full image"""
+    idxs = []
+    for (start, stop) in window:
+        # First multiple of `subsample` inside the window
+        first = -(-start // subsample) * subsample
+        idxs.append(np.arange(first, stop, subsample))
+    ys, xs = idxs
+    zsub = z[np.ix_(ys - window[0][0], xs - window[1][0])]
+    valid = ~np.isnan(zsub)
+    ypow = _coord_powers(ys, shape[0], 2 * deramp_order)
+    xpow = _coord_powers(xs, shape[1], 2 * deramp_order)
+    gram_moments = ypow.T @ (valid.astype(np.float64) @ xpow)
+    nterms = deramp_order + 1
+    zfilled = np.where(valid, zsub, 0).astype(np.float64)
+    rhs_moments = ypow[:, :nterms].T @ (zfilled @ xpow[:, :nterms])
+    return gram_moments, rhs_moments
+
+
+def _point_fit_moments(z, ys, xs, deramp_order, shape=None, window=None):
+    """Same as `ramp_moments`, but only using the pixels at (`ys`, `xs`)
+
+    `ys`, `xs` are indices in the full image of `shape`, of which `z` is `window`.
+    """
+    if shape is None:
+        shape = z.shape
+    row_start, col_start = (0, 0) if window is None else (window[0][0], window[1][0])
+    vals = z[ys - row_start, xs - col_start].astype(np.float64)
+    good = ~np.isnan(vals)
+    ys, xs, vals = ys[good], xs[good], vals[good]
+    gram_moments = _point_moments(ys, xs, 2 * deramp_order, shape)
+    ypow = _coord_powers(ys, shape[0], deramp_order)
+    xpow = _coord_powers(xs, shape[1], deramp_order)
+    rhs_moments = (ypow * vals[:, np.newaxis]).T @ xpow
+    return gram_moments, rhs_moments
+
+
+def _point_moments(ys, xs, max_power, shape):
+    """sum(y**i * x**j) over a list of pixel coordinates, for i, j <= max_power"""
+    ypow = _coord_powers(ys, shape[0], max_power)
+    xpow = _coord_powers(xs, shape[1], max_power)
+    return ypow.T @ xpow
+
+
+def _ramp_terms(deramp_order):
+    """(y power, x power) of each term in a surface of order `deramp_order`"""
+    return [
+        (ypow, total - ypow)
+        for total in range(deramp_order + 1)
+        for ypow in range(total + 1)
+    ]
+
+
+def _as_tuple(window):
+    """Make a (possibly nested) window/shape hashable for caching"""
+    if window is None:
+        return None
+    return tuple(_as_tuple(w) if np.ndim(w) else int(w) for w in window)
+
+
+@functools.lru_cache(maxsize=128)
+def _window_powers(win_shape, max_power, window=None, shape=None):
+    """Powers of the scaled y and x coordinates of a window of the image
+
+    Coordinates are scaled to [-1, 1] across the full image so that the
+    sums in the fit stay well conditioned for large images.
+    """
+    if shape is None:
+        shape = win_shape
+    if window is None:
+        window = ((0, shape[0]), (0, shape[1]))
+    out = []
+    for (start, stop), total in zip(window, shape):
+        pows = _coord_powers(np.arange(start, stop), total, max_power)
+        # These are shared between calls, so don't allow changes
+        pows.flags.writeable = False
+        out.append(pows)
+    return tuple(out)
+
+
+def _coord_powers(idxs, total, max_power):
+    """(len(idxs), max_power + 1) powers of indices, scaled to [-1, 1] over `total`"""
+    half = max((total - 1) / 2, 1)
+    coords = (idxs - (total - 1) / 2) / half
+    # Repeated multiplication is much faster than `**` for the powers
+    pows = np.empty((len(coords), max_power + 1))
+    pows[:, 0] = 1
+    for p in range(1, max_power + 1):
+        np.multiply(pows[:, p - 1], coords, out=pows[:, p])
+    return pows
@@ -0,0 +1,265 @@
+"""
+Storage of the pixel level outlier labels made by `core.label_outliers`
+
+Labels are written either
+    "dense": one int8 per pixel per date (which xarray loads as bools)
+    "packed": 8 dates per byte, using `np.packbits` along the date axis
+    "sparse": only the (date, pixel) coordinates, data and threshold of
+        each outlier, so the size is proportional to the number of outliers
+Use `open_labels` (or `read_labels`) to read any of them: packed and sparse
+labels are only expanded for the dates/pixels which are indexed.
+"""
+import numpy as np
+import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+
+from . import backends
+
+LABEL_ENCODINGS = ("dense", "packed", "sparse")
+# Name of the packed labels variable, and its (packed) date dimension
+PACKED_NAME = "labels_packed"
+PACKED_DIM = "date_packed"
+# Dimension of the sparse outlier variables, and the variables along it
+OUTLIER_DIM = "outlier"
+OUTLIER_VARS = {
+    "outlier_date": "i4",  # index into the dates
+    "outlier_pixel": "i8",  # flat (row * cols + col) pixel index
+    "outlier_data": "f4",
+    "outlier_threshold": "f4",
+}
+
+
+def pack_labels(labels):
+    """Pack bool labels along the date axis (axis 0), 8 dates per byte
+
+    Examples
+    --------
+    >>> packed = pack_labels(np.array([[True], [False], [True]]))
+    >>> packed.tolist()
+    [[160]]
+    >>> unpack_labels(packed, 3)[:, 0].tolist()
+    [True, False, True]
+    """
+    return np.packbits(np.asarray(labels, dtype=bool), axis=0)
+
+
+def unpack_labels(packed, ndates):
+    """Inverse of `pack_labels` for a stack with `ndates` dates"""
+    return np.unpackbits(packed, axis=0, count=ndates).astype(bool)
+
+
+def packed_size(ndates):
+    """Length of the packed date axis holding `ndates` dates"""
+    return (ndates + 7) // 8
+
+
+def sparse_outliers(labels, data, threshold, window=None, date_idxs=None, cols=None):
+    """Coordinates and values of the outliers in a block of labels
+
+    Parameters
+    ----------
+    labels : ndarray
+        bool (dates, rows, cols) labels of the block
+    data : ndarray
+        (dates, rows, cols) data which was labeled
+    threshold : ndarray
+        (rows, cols) threshold used for the labels
+    window : tuple[tuple[int, int], tuple[int, int]]
+        ((row_start, row_stop), (col_start, col_stop)) of the block in the full
+        image (Default value = None, the block is the full image)
+    date_idxs : ndarray
+        date index of each layer of the block (Default value = None, 0, 1, ...)
+    cols : int
+        number of columns of the full image (Default value = None, the block's)
+
+    Returns
+    -------
+    dict
+        1D arrays for each of the `OUTLIER_VARS`
+
+    Examples
+    --------
+    >>> labels = np.array([[[False, True]], [[True, False]]])
+    >>> out = sparse_outliers(labels, labels * 5.0, np.ones((1, 2)), date_idxs=[3, 4])
+    >>> out["outlier_date"].tolist(), out["outlier_pixel"].tolist()
+    ([3, 4], [1, 0])
+    """
+    date_pos, rows, cols_in = np.nonzero(labels)
+    if window is None:
+        window = ((0, labels.shape[1]), (0, labels.shape[2]))
+    (row_start, _), (col_start, _) = window
+    if date_idxs is None:
+        date_idxs = np.arange(labels.shape[0])
+    if cols is None:
+        cols = labels.shape[2]
+    out = {
+        "outlier_date": np.asarray(date_idxs)[date_pos],
+        "outlier_pixel": (rows + row_start) * cols + (cols_in + col_start),
+        "outlier_data": data[date_pos, rows, cols_in],
+        "outlier_threshold": threshold[rows, cols_in],
+    }
+    return {name: out[name].astype(dtype) for name, dtype in OUTLIER_VARS.items()}
+
+
+class SparseLabelWriter:
+    """Appends the outliers of blocks of labels to an open (`backends`) file"""
+
+    def __init__(self, f, stack_dim, shape):
+        self.f = f
+        self.cols = shape[1]
+        f.createDimension(OUTLIER_DIM, None)
+        for name, dtype in OUTLIER_VARS.items():
+            f.createVariable(name, dtype, (OUTLIER_DIM,), chunksizes=(2**16,))
+        f["outlier_date"].setncattr("stack_dim", stack_dim)
+        f["outlier_pixel"].setncattr("shape", list(shape))
+
+    def add(self, labels, data, threshold, window=None, date_idxs=None):
+        """Append the outliers of one block. See `sparse_outliers` for arguments"""
+        outliers = sparse_outliers(
+            labels, data, threshold, window=window, date_idxs=date_idxs, cols=self.cols
+        )
+        start = self.f.dimensions[OUTLIER_DIM].size
+        stop = start + len(outliers["outlier_date"])
+        if stop == start:
+            return
+        self.f.resize_dimension(OUTLIER_DIM, stop)
+        for name, values in outliers.items():
+            self.f[name][start:stop] = values
+
+
+def open_labels(fname):
+    """Open a labels file made by `core.label_outliers`
+
+    Packed and sparse labels are presented as a lazy, bool "labels" variable,
+    so the file looks the same as one with dense labels.
+
+    Parameters
+    ----------
+    fname : str
+        labels file
+
+    Returns
+    -------
+    xr.Dataset
+        with "labels", "threshold" and "data" (for sparse labels, the data
+        is only kept for the outliers, in "outlier_data")
+    """
+    ds = backends.open_xarray(fname)
+    if PACKED_NAME in ds:
+        lazy_labels = PackedLabelsArray(fname)
+        ds = ds.drop_vars(PACKED_NAME)
+    elif "outlier_date" in ds:
+        lazy_labels = SparseLabelsArray(fname)
+    else:
+        return ds
+    dims = (lazy_labels.stack_dim,) + ds["threshold"].dims
+    labels = xr.Variable(dims, indexing.LazilyIndexedArray(lazy_labels))
+    return ds.assign(labels=labels)
+
+
+def read_labels(fname, dates=None, window=None):
+    """Load the dense, bool labels for some dates and pixels, for any encoding
+
+    Parameters
+    ----------
+    fname : str
+        labels file made by `core.label_outliers`
+    dates : int, slice, or list[int]
+        date index (or indices) to load (Default value = None, all dates)
+    window : tuple[tuple[int, int], tuple[int, int]]
+        ((row_start, row_stop), (col_start, col_stop)) of the pixels to load
+        (Default value = None, all pixels)
+
+    Returns
+    -------
+    ndarray
+        bool labels, (rows, cols) for one date, otherwise (dates, rows, cols)
+    """
+    if window is None:
+        window = ((None, None), (None, None))
+    (row_start, row_stop), (col_start, col_stop) = window
+    key = (
+        slice(None) if dates is None else dates,
+        slice(row_start, row_stop),
+        slice(col_start, col_stop),
+    )
+    with open_labels(fname) as ds:
+        labels = ds["labels"]
+        return labels[key].values
+
+
+class PackedLabelsArray(BackendArray):
+    """Bool (date, rows, cols) labels, read from the packed variable of `fname`
+
+    Indexing reads only the bytes holding the requested dates and pixels.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with backends.open_dataset(fname, "r") as f:
+            var = f[PACKED_NAME]
+            self.stack_dim = var.getncattr("stack_dim")
+            ndates = f.dimensions[self.stack_dim].size
+            self.shape = (ndates,) + var.shape[1:]
+        self.dtype = np.dtype(bool)
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.BASIC, self._getitem
+        )
+
+    def _getitem(self, key):
+        date_key, pixel_key = key[0], tuple(key[1:])
+        dates = np.arange(self.shape[0])[date_key]
+        if dates.size == 0:
+            # Nothing to read: get the (empty) output shape from a zero-stride view
+            return np.array(np.broadcast_to(False, self.shape)[key])
+        # Only read the bytes spanning the requested dates
+        start, stop = dates.min() // 8, dates.max() // 8 + 1
+        with backends.open_dataset(self.fname, "r") as f:
+            packed = f[PACKED_NAME][(slice(start, stop),) + pixel_key]
+        return np.unpackbits(packed, axis=0)[dates - 8 * start].astype(bool)
+
+
+class SparseLabelsArray(BackendArray):
+    """Bool (date, rows, cols) labels, rebuilt from the sparse outliers of `fname`
+
+    Indexing reads the coordinates of all outliers, then fills in the ones
+    in the requested dates and pixels.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with backends.open_dataset(fname, "r") as f:
+            self.stack_dim = f["outlier_date"].getncattr("stack_dim")
+            ndates = f.dimensions[self.stack_dim].size
+            self.shape = (ndates,) + tuple(f["outlier_pixel"].getncattr("shape"))
+        self.dtype = np.dtype(bool)
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.BASIC, self._getitem
+        )
+
+    def _getitem(self, key):
+        with backends.open_dataset(self.fname, "r") as f:
+            dates = f["outlier_date"][:]
+            rows, cols = np.divmod(f["outlier_pixel"][:], self.shape[2])
+        # Position of each date/row/col in the output (-1 if not requested)
+        positions = []
+        for size, k in zip(self.shape, key):
+            pos = np.full(size, -1)
+            idxs = np.atleast_1d(np.arange(size)[k])
+            pos[idxs] = np.arange(len(idxs))
+            positions.append(pos)
+        out_shape = tuple(int((pos >= 0).sum()) for pos in positions)
+        out = np.zeros(out_shape, dtype=bool)
+        date_pos, row_pos, col_pos = (
+            pos[coord] for pos, coord in zip(positions, (dates, rows, cols))
+        )
+        keep = (date_pos >= 0) & (row_pos >= 0) & (col_pos >= 0)
+        out[date_pos[keep], row_pos[keep], col_pos[keep]] = True
+        # Drop the axes indexed with an integer
+        squeeze = (0 if isinstance(k, (int, np.integer)) else slice(None) for k in key)
+        return out[tuple(squeeze)]
@@ -0,0 +1,474 @@
+"""
+Lazy, dask-backed averaging and labeling
+
+The interferograms are opened as a chunked, dask-backed stack, and the averages,
+deramping and pixel level labels are built as a graph of chunkwise operations.
+The graph runs on the local threaded or multiprocess scheduler, or on a
+`dask.distributed.LocalCluster`, so one mechanism gives both the parallelism and
+the out-of-core execution.
+
+Needs dask: `pip install trodi[dask]`
+"""
+
+import contextlib
+import functools
+import operator
+
+import numpy as np
+
+from . import sario
+from .logger import get_log
+
+log = get_log()
+SCHEDULERS = ("threads", "processes", "cluster")
+
+
+def _import_dask():
+    try:
+        import dask
+        import dask.array  # noqa
+    except ImportError:
+        raise ValueError("Need to `pip install dask` to use a dask `scheduler`")
+    return dask
+
+
+@contextlib.contextmanager
+def scheduler_context(scheduler="threads", workers=None):
+    """Run the dask computations within the `with` block on `scheduler`
+
+    Parameters
+    ----------
+    scheduler : str
+        "threads" or "processes" for the local schedulers, or "cluster" to start a
+        `dask.distributed.LocalCluster` (Default value = "threads")
+    workers : int
+        number of threads, processes, or cluster worker processes
+        (Default value = None, dask's default of one per core)
+    """
+    dask = _import_dask()
+    if scheduler == "cluster":
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError:
+            raise ValueError("Need to `pip install dask[distributed]` for a cluster")
+        with LocalCluster(n_workers=workers, threads_per_worker=1) as cluster:
+            with Client(cluster):
+                log.info("Running on {}".format(cluster))
+                yield
+    elif scheduler in ("threads", "processes"):
+        with dask.config.set(scheduler=scheduler, num_workers=workers):
+            yield
+    else:
+        raise ValueError("`scheduler` must be one of {}".format(SCHEDULERS))
+
+
+class IgramStack:
+    """Array-like (igram, rows, cols) stack of interferogram files, for dask
+
+    Indexing only reads the requested window of each requested file,
+    so each chunk of a dask array made from this reads just its own pixels.
+    """
+
+    def __init__(self, unw_file_list, rsc_file=None, band=2):
+        info = sario.get_info(unw_file_list[0], rsc_file=rsc_file, band=band)
+        self.unw_file_list = list(unw_file_list)
+        self.rsc_file = rsc_file
+        self.band = band
+        self.shape = (len(self.unw_file_list),) + tuple(info.shape)
+        self.dtype = np.dtype(info.dtype)
+        self.ndim = 3
+
+    def __getitem__(self, key):
+        # Read a block of slices, then drop the axes indexed with an integer
+        slices, squeeze = [], []
+        for size, k in zip(self.shape, key):
+            if isinstance(k, slice):
+                slices.append(k)
+                squeeze.append(slice(None))
+            else:
+                k = range(size)[k]
+                slices.append(slice(k, k + 1))
+                squeeze.append(0)
+        igram_key, row_key, col_key = slices
+        (row_start, row_stop, row_step), (col_start, col_stop, col_step) = (
+            row_key.indices(self.shape[1]),
+            col_key.indices(self.shape[2]),
+        )
+        window = ((row_start, row_stop), (col_start, col_stop))
+        idxs = range(self.shape[0])[igram_key]
+        out = np.empty(
+            (len(idxs), row_stop - row_start, col_stop - col_start), dtype=self.dtype
+        )
+        for out_idx, idx in enumerate(idxs):
+            out[out_idx] = sario.load(
+                self.unw_file_list[idx],
+                rsc_file=self.rsc_file,
+                band=self.band,
+                window=window,
+            )
+        return out[:, ::row_step, ::col_step][tuple(squeeze)]
+
+
+def open_igram_stack(unw_file_list, rsc_file=None, band=2, chunks=None):
+    """Open the interferograms as a lazy (igram, lat, lon) xr.DataArray
+
+    Parameters
+    ----------
+    unw_file_list : list[str]
+        interferogram files
+    rsc_file : str
+        .rsc file, if loading binary files like snaphu outputs (Default value = None)
+    band : int
+        if using gdal to load igrams, which image band to load (Default value = 2)
+    chunks : tuple[int, int, int]
+        (igrams, rows, cols) of each dask chunk (Default value = None,
+        `utils.stack_chunks`: one igram, in tiles of at most 512 x 512)
+
+    Returns
+    -------
+    xr.DataArray
+        dask-backed, with the filenames as the "igram" coordinate
+    """
+    import xarray as xr
+
+    from . import utils
+
+    da = _import_dask().array
+    stack = IgramStack(unw_file_list, rsc_file=rsc_file, band=band)
+    if chunks is None:
+        chunks = utils.stack_chunks(stack.shape[1:])
+    data = da.from_array(stack, chunks=chunks, lock=False, asarray=True)
+    return xr.DataArray(
+        data, dims=("igram", "lat", "lon"), coords={"igram": stack.unw_file_list}
+    )
+
+
+def _averages_and_fits(
+    igrams,
+    sar_date_list,
+    date_igrams,
+    do_flip=True,
+    deramp_order=2,
+    mask=None,
+    deramp_kwargs={},
+):
+    """The lazy average of each date (not deramped), and its delayed ramp (or mean)
+
+    The igrams of a date are added in the same order as `core._average_date`.
+    The averages keep the spatial chunks of `igrams`: like the tiled engine of
+    `core._average_single_pass`, each whole-image ramp (or mean) is fit from
+    sums collected chunk by chunk, then subtracted from each chunk by
+    `_remove_fit`, so no task holds a full image.
+
+    Parameters
+    ----------
+    igrams : xr.DataArray
+        stack from `open_igram_stack`
+    sar_date_list : list[datetime.date]
+        dates to average
+    date_igrams : list[list[tuple[str, int]]]
+        (filename, sign) of the igrams to average for each date, from
+        `utils.IgramIndex.date_igrams`
+    do_flip : bool
+        Flip the sign of interferograms to always go from (cur date, other date)
+        (Default value = True)
+    deramp_order : int
+        order of the surface to fit to each average (Default value = 2)
+    mask : ndarray
+        pixels to ignore when deramping (Default value = None)
+    deramp_kwargs : dict
+        `subsample`/`sample` options for `ramp_moments` (Default value = {})
+
+    Returns
+    -------
+    averages : list[dask.array.Array]
+        (rows, cols) average of each date
+    fits : list[dask.delayed.Delayed]
+        ramp coefficients (or mean) of each average, for `_remove_fit`. The fit
+        is None for a date without igrams, whose average is all nan.
+    """
+    dask = _import_dask()
+    da = dask.array
+
+    data = igrams.data
+    index = {fname: idx for (idx, fname) in enumerate(igrams["igram"].values)}
+    averages, fits = [], []
+    for cur_date, cur_unws in zip(sar_date_list, date_igrams):
+        if not cur_unws:
+            log.warning("No igrams to average for {}".format(cur_date))
+            averages.append(
+                da.full(
+                    data.shape[1:], np.nan, dtype=data.dtype, chunks=data.chunks[1:]
+                )
+            )
+            fits.append(None)
+            continue
+        terms = (
+            (sign if do_flip else 1) * data[index[unwf]] for unwf, sign in cur_unws
+        )
+        total = functools.reduce(operator.add, terms)
+        avg = total / len(cur_unws)
+        sums = [
+            dask.delayed(_chunk_sums)(
+                block,
+                window,
+                avg.shape,
+                deramp_order,
+                _mask_window(mask, window),
+                deramp_kwargs,
+            )
+            for (block, window) in _chunks_and_windows(avg)
+        ]
+        averages.append(avg)
+        fits.append(dask.delayed(_solve_fit)(sums, deramp_order))
+    return averages, fits
+
+
+def _chunks_and_windows(arr):
+    """(delayed chunk, window) of each chunk of a 2D dask array, in row-major order"""
+    blocks = arr.to_delayed()
+    row_bounds, col_bounds = (np.cumsum((0,) + c) for c in arr.chunks)
+    return [
+        (
+            blocks[i, j],
+            ((row_bounds[i], row_bounds[i + 1]), (col_bounds[j], col_bounds[j + 1])),
+        )
+        for i in range(blocks.shape[0])
+        for j in range(blocks.shape[1])
+    ]
+
+
+def _mask_window(mask, window):
+    """The `window` of `mask` (None for no mask)"""
+    if mask is None:
+        return None
+    (row_start, row_stop), (col_start, col_stop) = window
+    return mask[row_start:row_stop, col_start:col_stop]
+
+
+def _chunk_sums(block, window, shape, deramp_order, tile_mask, deramp_kwargs):
+    """Sums for the whole-image ramp fit (or mean) from one chunk of an average"""
+    from .deramp import ramp_moments
+
+    if deramp_order > 0:
+        # Copy, since the input chunk may be shared within the graph
+        block = np.array(block)
+        if tile_mask is not None:
+            block[tile_mask] = np.nan
+        return ramp_moments(block, deramp_order, window, shape, **deramp_kwargs)
+    return np.nansum(block), np.count_nonzero(~np.isnan(block))
+
+
+def _solve_fit(sums, deramp_order):
+    """The ramp coefficients (or mean) of a whole image from its `_chunk_sums`"""
+    from .deramp import solve_ramp
+
+    if deramp_order > 0:
+        nmom = 2 * deramp_order + 1
+        gram_moments = np.zeros((nmom, nmom))
+        rhs_moments = np.zeros((deramp_order + 1, deramp_order + 1))
+        for gm, rm in sums:
+            gram_moments += gm
+            rhs_moments += rm
+        return solve_ramp(gram_moments, rhs_moments, deramp_order)
+    total, count = np.zeros(()), np.zeros(())
+    for chunk_sum, chunk_count in sums:
+        total += chunk_sum
+        count += chunk_count
+    return total / count
+
+
+def _remove_fit(avg, fit, deramp_order, mask):
+    """Subtract `fit` (from `_solve_fit`) from each chunk of `avg`, then mask it"""
+    dask = _import_dask()
+    da = dask.array
+
+    if fit is None:
+        return avg
+    blocks = [
+        da.from_delayed(
+            dask.delayed(_remove_chunk_fit)(
+                block, fit, window, avg.shape, deramp_order, _mask_window(mask, window)
+            ),
+            shape=tuple(stop - start for (start, stop) in window),
+            dtype=avg.dtype,
+        )
+        for (block, window) in _chunks_and_windows(avg)
+    ]
+    ncols = len(avg.chunks[1])
+    return da.block(
+        [blocks[start : start + ncols] for start in range(0, len(blocks), ncols)]
+    )
+
+
+def _remove_chunk_fit(block, fit, window, shape, deramp_order, tile_mask):
+    """One chunk of `_remove_fit`"""
+    from .deramp import subtract_ramp
+
+    block = np.array(block)
+    if deramp_order > 0:
+        if tile_mask is not None:
+            block[tile_mask] = np.nan
+        return subtract_ramp(block, fit, shape, window)
+    block -= fit
+    if tile_mask is not None:
+        block[tile_mask] = np.nan
+    return block
+
+
+def write_averages(
+    ds,
+    sar_date_list,
+    date_igrams,
+    unw_file_list,
+    date_idxs,
+    on_finish,
+    progress=None,
+    scheduler="threads",
+    workers=None,
+    rsc_file=None,
+    band=2,
+    tile_shape=None,
+    deramp_order=2,
+    mask=None,
+    **kwargs,
+):
+    """Compute the averages of the dates `date_idxs` on a dask `scheduler`, into `ds`
+
+    Batches of `workers` dates are computed at once (sharing the reads of their
+    igrams). The ramps (or means) of a batch are fit first, reading each igram
+    chunk once. The deramped averages are then computed one chunk window at a
+    time and written by this process, so only a window of each date is in
+    memory. `on_finish` is then called with the batch's indices (and `progress`,
+    a `logger.Progress`, updated with their igrams). `tile_shape` is the
+    (rows, cols) of the chunks (Default value = None, see `open_igram_stack`).
+    `kwargs` (`do_flip`, `deramp_kwargs`) are passed to `_averages_and_fits`.
+    """
+    dask = _import_dask()
+    da = dask.array
+
+    chunks = None if tile_shape is None else (1,) + tuple(tile_shape)
+    igrams = open_igram_stack(
+        unw_file_list, rsc_file=rsc_file, band=band, chunks=chunks
+    )
+    averages, fits = _averages_and_fits(
+        igrams,
+        [sar_date_list[idx] for idx in date_idxs],
+        [date_igrams[idx] for idx in date_idxs],
+        deramp_order=deramp_order,
+        mask=mask,
+        **kwargs,
+    )
+    windows = [window for (_, window) in _chunks_and_windows(igrams.data[0])]
+    batch_size = workers or 1
+    log.info(
+        "Averaging {} dates in {} chunk(s) on the dask {} scheduler".format(
+            len(date_idxs), len(windows), scheduler
+        )
+    )
+    with scheduler_context(scheduler, workers):
+        for start in range(0, len(date_idxs), batch_size):
+            stop = min(start + batch_size, len(date_idxs))
+            batch_fits = dask.compute(*fits[start:stop])
+            avgs = da.stack(
+                [
+                    _remove_fit(avg, fit, deramp_order, mask)
+                    for (avg, fit) in zip(averages[start:stop], batch_fits)
+                ]
+            )
+            for window in windows:
+                (row_start, row_stop), (col_start, col_stop) = window
+                tile_key = np.s_[row_start:row_stop, col_start:col_stop]
+                layers = avgs[(slice(None),) + tile_key].compute()
+                for idx, layer in zip(date_idxs[start:stop], layers):
+                    ds[(idx,) + tile_key] = layer
+            on_finish(date_idxs[start:stop])
+            if progress is not None:
+                nigrams = sum(len(date_igrams[idx]) for idx in date_idxs[start:stop])
+                progress.update(nigrams)
+            log.info("Averaged {} out of {} dates".format(stop, len(date_idxs)))
+
+
+def label_pixels(
+    fname,
+    outfile,
+    nsigma=5,
+    min_spread=0.5,
+    tile_shape=None,
+    max_memory=4.0,
+    scheduler="threads",
+    workers=None,
+    storage=None,
+    label_encoding="dense",
+):
+    """Label each pixel of the average stack in `fname` with a lazy dask graph
+
+    Each chunk holds all dates for a tile of pixels, like `core._label_pixels_tiled`.
+    Batches of `workers` tiles are computed at once, then written to `outfile`
+    by this process (so any scheduler can be used).
+
+    Returns
+    -------
+        labels, threshold: xr.DataArrays loaded from `outfile` (see `core._load_labels`)
+    """
+    from . import backends, core, utils
+
+    dask = _import_dask()
+    with backends.open_dataarray(fname) as stack, backends.open_dataset(
+        fname, "r"
+    ) as f_in, backends.open_dataset(outfile, "w") as f_out:
+        ndates, rows, cols = stack.shape
+        if tile_shape is None:
+            tile_shape = core._label_tile_shape(stack.shape, stack.dtype, max_memory)
+        # Use all pixel absolute values here, shape: (ndates, rows, cols)
+        chunks = dict(zip(stack.dims, (ndates,) + tuple(tile_shape)))
+        data = abs(stack.chunk(chunks).data)
+        threshold = data.map_blocks(
+            _threshold_block,
+            nsigma=nsigma,
+            min_spread=min_spread,
+            drop_axis=0,
+            dtype=data.dtype,
+        )
+        labels = data > threshold
+
+        out_vars = core._create_label_vars(
+            f_in, f_out, core._get_stack_var(f_in), storage, label_encoding
+        )
+        windows = utils.block_windows((rows, cols), tile_shape)
+        log.info(
+            "Saving outlier labels, data and threshold to {} in {} tile(s) using "
+            "the dask {} scheduler".format(outfile, len(windows), scheduler)
+        )
+        batch_size = workers or 1
+        with scheduler_context(scheduler, workers):
+            for start in range(0, len(windows), batch_size):
+                batch = windows[start : start + batch_size]
+                tiles = dask.compute(
+                    *[_tile(labels, data, threshold, window) for window in batch]
+                )
+                for window, (tile_labels, tile_data, tile_threshold) in zip(
+                    batch, tiles
+                ):
+                    core._write_label_tile(
+                        out_vars, window, tile_labels, tile_data, tile_threshold
+                    )
+
+    return core._load_labels(outfile)
+
+
+def _tile(labels, data, threshold, window):
+    """The (labels, data, threshold) of all dates in one tile `window`"""
+    (row_start, row_stop), (col_start, col_stop) = window
+    tile_key = np.s_[row_start:row_stop, col_start:col_stop]
+    return (
+        labels[(slice(None),) + tile_key],
+        data[(slice(None),) + tile_key],
+        threshold[tile_key],
+    )
+
+
+def _threshold_block(block, nsigma=5, min_spread=0.5):
+    from .core import label
+
+    return label(block, nsigma=nsigma, min_spread=min_spread)[1]
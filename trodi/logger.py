@@ -15,7 +15,13 @@ Usage:
     logger.critical("Something just awful happened")
     logger.debug("Extra printing we often don't need to see.")
 """
+import contextlib
+import datetime
+import json
 import logging
+import os
+import sys
+import threading
 import time
 from functools import wraps
 from logging import Formatter
@@ -94,7 +100,8 @@ def log_runtime(f):
 
         """
         t1 = time.time()
-        result = f(*args, **kwargs)
+        with profiler.stage(f.__name__):
+            result = f(*args, **kwargs)
         t2 = time.time()
         elapsed_time = t2 - t1
 
@@ -107,3 +114,241 @@ def log_runtime(f):
         return result
 
     return wrapper
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, in MB (None if unknown)"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+class Profiler:
+    """Records the time, bytes and peak memory of each stage of a run
+
+    Stages are timed with `with profiler.stage(name, **args)`, where `args`
+    (e.g. the date, or "bytes_read") are saved with the event. The yielded
+    dict can be updated with args only known at the end of the stage.
+    Nothing is recorded unless `enabled`, so stages can wrap hot loops.
+
+    Examples
+    --------
+    >>> prof = Profiler()
+    >>> prof.enabled = True
+    >>> with prof.stage("io", date="20150101") as args:
+    ...     args["bytes_read"] = 16
+    >>> [(e["stage"], e["date"], e["bytes_read"]) for e in prof.events]
+    [('io', '20150101', 16)]
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        if not self.enabled:
+            yield args
+            return
+        # Wall clock times, so events from worker processes line up
+        start = time.time()
+        try:
+            yield args
+        finally:
+            event = dict(
+                stage=name,
+                start=start,
+                duration=time.time() - start,
+                pid=os.getpid(),
+                tid=threading.get_ident(),
+                peak_rss_mb=peak_rss_mb(),
+            )
+            event.update(args)
+            self.add([event])
+
+    def add(self, events):
+        """Add events recorded elsewhere (e.g. by `profiled` in a worker process)"""
+        with self._lock:
+            self.events.extend(events)
+
+    def summary(self):
+        """Log the total time and bytes of each stage"""
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event["stage"], dict(count=0, duration=0.0))
+            total["count"] += 1
+            total["duration"] += event["duration"]
+            for key in ("bytes_read", "bytes_written"):
+                if key in event:
+                    total[key] = total.get(key, 0) + event[key]
+        for name, total in totals.items():
+            sizes = "".join(
+                ", {:.1f} MB {}".format(total[key] / 1e6, key.split("_")[1])
+                for key in ("bytes_read", "bytes_written")
+                if key in total
+            )
+            logger.info(
+                "{}: {:.2f} seconds in {} call(s){}".format(
+                    name, total["duration"], total["count"], sizes
+                )
+            )
+        peaks = [e["peak_rss_mb"] for e in self.events if e["peak_rss_mb"] is not None]
+        if peaks:
+            logger.info("Peak RSS: {:.1f} MB".format(max(peaks)))
+
+    def write(self, fname, fmt="jsonl"):
+        """Save the events to `fname`
+
+        Parameters
+        ----------
+        fname : str
+            output file
+        fmt : str
+            "jsonl" for one JSON object per event, or "chrome" for the Chrome
+            trace format (open in chrome://tracing or https://ui.perfetto.dev)
+            (Default value = "jsonl")
+        """
+        if fmt == "jsonl":
+            with open(fname, "w") as f:
+                for event in self.events:
+                    f.write(json.dumps(event, default=str) + "\n")
+        elif fmt == "chrome":
+            t0 = min((e["start"] for e in self.events), default=0.0)
+            trace = []
+            for event in self.events:
+                args = {
+                    k: v
+                    for k, v in event.items()
+                    if k not in ("stage", "start", "duration", "pid", "tid")
+                }
+                trace.append(
+                    dict(
+                        name=event["stage"],
+                        cat=event["stage"],
+                        ph="X",
+                        ts=1e6 * (event["start"] - t0),
+                        dur=1e6 * event["duration"],
+                        pid=event["pid"],
+                        tid=event["tid"],
+                        args=args,
+                    )
+                )
+            with open(fname, "w") as f:
+                json.dump(dict(traceEvents=trace), f, default=str)
+        else:
+            raise ValueError("`fmt` must be 'jsonl' or 'chrome'")
+
+
+# Shared by all modules. Enabled by the `--profile` command line option
+profiler = Profiler()
+
+
+def profiled(func, *args, **kwargs):
+    """Run `func` (e.g. in a worker process), returning (result, profiler events)
+
+    Add the events to the parent's profiler with `profiler.add`.
+    """
+    # A forked worker starts with a copy of the parent's events
+    profiler.events = []
+    profiler.enabled = True
+    result = func(*args, **kwargs)
+    events, profiler.events = profiler.events, []
+    return result, events
+
+
+class Progress:
+    """Throughput and ETA of a long loop, for batch jobs or an interactive terminal
+
+    Call `update` as work finishes (from any thread). On a TTY, one status line
+    is redrawn in place; otherwise a log line is written every `interval` seconds.
+
+    Parameters
+    ----------
+    total : int
+        total number of items (e.g. interferogram reads) expected
+    desc : str
+        name of the items (Default value = "igrams")
+    item_nbytes : int
+        bytes read per item, for `update` calls without `nbytes` (Default value = 0)
+    interval : float
+        seconds between log lines when not on a TTY (Default value = 10.0)
+    stream :
+        where TTY status lines go (Default value = None, sys.stderr)
+
+    Examples
+    --------
+    >>> import io
+    >>> progress = Progress(4, stream=io.StringIO())
+    >>> progress.update(2, nbytes=2e6)
+    >>> progress.format().split(",")[0]
+    '2/4 igrams (50%)'
+    """
+
+    def __init__(self, total, desc="igrams", item_nbytes=0, interval=10.0, stream=None):
+        self.total = total
+        self.desc = desc
+        self.item_nbytes = item_nbytes
+        self.interval = interval
+        self.stream = sys.stderr if stream is None else stream
+        self.tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.count = 0
+        self.nbytes = 0
+        self._shown = None
+        self._start = self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, count=1, nbytes=None):
+        """Add `count` finished items, which read `nbytes` bytes
+
+        (Default `nbytes` = None, `count` * `item_nbytes`)
+        """
+        with self._lock:
+            self.count += count
+            self.nbytes += count * self.item_nbytes if nbytes is None else nbytes
+            now = time.monotonic()
+            # Redraw a TTY often, but keep log files short
+            if now - self._last < (0.5 if self.tty else self.interval):
+                return
+            self._last = now
+            self._show()
+
+    def format(self):
+        """Current status: count, percent done, items/s, MB/s and ETA"""
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        rate = self.count / elapsed
+        if rate > 0:
+            eta = datetime.timedelta(seconds=int((self.total - self.count) / rate))
+        else:
+            eta = "?"
+        return "{}/{} {} ({:.0f}%), {:.1f} {}/s, {:.1f} MB/s, ETA {}".format(
+            self.count,
+            self.total,
+            self.desc,
+            100 * self.count / max(self.total, 1),
+            rate,
+            self.desc,
+            self.nbytes / 1e6 / elapsed,
+            eta,
+        )
+
+    def close(self):
+        """Show the final status (ending the TTY line)"""
+        with self._lock:
+            if self._shown != self.count:
+                self._show()
+            if self.tty:
+                self.stream.write("\n")
+                self.stream.flush()
+
+    def _show(self):
+        self._shown = self.count
+        if self.tty:
+            self.stream.write("\r" + self.format() + "\033[K")
+            self.stream.flush()
+        else:
+            logger.info(self.format())
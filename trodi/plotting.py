@@ -21,11 +21,11 @@ def plot_avgs(fname="average_slcs.nc", stack=None, cmap=None, nimg=9):
     -------
 
     """
-    import xarray as xr
+    from . import backends
 
     # import matplotlib.pyplot as plt
     if stack is None:
-        with xr.open_dataarray(fname) as ds:
+        with backends.open_dataarray(fname) as ds:
             stack = ds[:nimg]
     else:
         stack = stack[:nimg]
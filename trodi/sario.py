@@ -1,5 +1,8 @@
 import collections
-from multiprocessing.sharedctypes import Value
+import contextlib
+import functools
+import os
+import threading
 
 import numpy as np
 
@@ -17,6 +20,21 @@ RSC_KEY_TYPES = [
     ("z_scale", int),
     ("projection", str),
 ]
+# Max number of GDAL datasets to keep open at once
+GDAL_POOL_SIZE = 64
+# Default number of images `prefetch` reads ahead
+PREFETCH_DEPTH = 4
+
+RasterInfo = collections.namedtuple(
+    "RasterInfo", ["shape", "dtype", "nodata", "geotransform"]
+)
+RasterInfo.__doc__ = """Header info of a raster, parsed once and shared by all loads
+
+shape : (rows, cols)
+dtype : numpy dtype of the loaded band
+nodata : nodata value (None if not set)
+geotransform : GDAL-style (x_first, x_step, 0, y_first, 0, y_step)
+"""
 
 
 def load(
@@ -26,6 +44,8 @@ def load(
     cols=None,
     band=1,
     mask_nodata=True,
+    window=None,
+    out=None,
     **kwargs,
 ):
     """Load a file, either using numpy or rasterio
@@ -44,36 +64,253 @@ def load(
         For gdal, specify the band of the image to load (Default value = 1)
     mask_nodata : bool
         If True, convert out gdal-indicated nodata values as nans (Default value = True)
+    window : tuple[tuple[int, int], tuple[int, int]]
+        ((row_start, row_stop), (col_start, col_stop)) to read only a subset
+        of the image (Default value = None, reads the full image)
+    out : ndarray
+        array of the image (or `window`) shape to read into, instead of
+        allocating a new one (Default value = None)
     **kwargs :
         
 
     Returns
     -------
-    ndarray : image data
+    ndarray : image data (`out`, if given)
     """
     if rsc_file:
         rsc_data = load_rsc(rsc_file)
-        return load_stacked_img(filename, rsc_data=rsc_data, rows=rows, cols=cols)
+        return load_stacked_img(
+            filename, rsc_data=rsc_data, rows=rows, cols=cols, window=window, out=out
+        )
     else:
-        try:
-            from osgeo import gdal
-            gdal.UseExceptions()
-        except ImportError:
-            raise ValueError("Need to `conda install gdal` to load gdal-readable")
-
-        ds = gdal.Open(filename)
-        image = ds.GetRasterBand(band).ReadAsArray()
+        with _gdal_pool.open(filename) as ds:
+            if window is None:
+                image = ds.GetRasterBand(band).ReadAsArray(buf_obj=out)
+            else:
+                (row_start, row_stop), (col_start, col_stop) = window
+                image = ds.GetRasterBand(band).ReadAsArray(
+                    col_start,
+                    row_start,
+                    col_stop - col_start,
+                    row_stop - row_start,
+                    buf_obj=out,
+                )
         # Get the nodata value, and set it to nan
-        nodata = ds.GetRasterBand(band).GetNoDataValue()
+        nodata = get_info(filename, band=band).nodata
         if nodata is not None:
             try:
                 image[image == nodata] = np.nan
             except ValueError:  # non-float image type, dont mask
                 pass
-        ds = None
         return image
 
 
+def prefetch(
+    filenames, depth=PREFETCH_DEPTH, max_memory=None, reuse_buffers=False, **kwargs
+):
+    """Load each of `filenames` in order, reading the next ones in background threads
+
+    While the caller uses one image, up to `depth` of the following ones are
+    read by a pool of `depth` threads (GDAL and numpy release the GIL while
+    reading), so reading overlaps with computing. Each image is read by one
+    thread, and GDAL datasets are never shared between threads (see `_GdalPool`).
+
+    Parameters
+    ----------
+    filenames : Iterable[str]
+        files to load with `load`
+    depth : int
+        max number of images to read ahead of the one in use. 0 loads each
+        image only when it's needed (Default value = PREFETCH_DEPTH)
+    max_memory : float
+        Cap (in GB) on the memory of the images read ahead, which lowers `depth`
+        to fit (Default value = None, no cap)
+    reuse_buffers : bool
+        Load the images into `depth + 1` arrays which are allocated once and
+        reused, instead of a new array per image. Each image is then only valid
+        until the next one is requested (Default value = False)
+    **kwargs :
+        passed to `load` (e.g. `rsc_file`, `band`, `window`)
+
+    Yields
+    ------
+    (str, ndarray) : each filename and its image, in the order of `filenames`.
+        An error loading a file is raised when its image is reached.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from trodi import synthetic
+    >>> with tempfile.TemporaryDirectory() as outdir:
+    ...     stack = synthetic.make_stack(outdir, shape=(4, 5), ndates=4)
+    ...     images = prefetch(stack.unw_file_list, depth=2, rsc_file=stack.rsc_file)
+    ...     names = [fname for (fname, img) in images]
+    >>> names == stack.unw_file_list
+    True
+    """
+    filenames = list(filenames)
+    if not filenames:
+        return
+    if reuse_buffers or (depth > 0 and max_memory is not None):
+        info = get_info(
+            filenames[0], rsc_file=kwargs.get("rsc_file"), band=kwargs.get("band", 1)
+        )
+        shape = info.shape
+        window = kwargs.get("window")
+        if window is not None:
+            (row_start, row_stop), (col_start, col_stop) = window
+            shape = (row_stop - row_start, col_stop - col_start)
+        nbytes = max(1, shape[0] * shape[1] * info.dtype.itemsize)
+        if max_memory is not None:
+            depth = min(depth, int(max_memory * 1e9 // nbytes))
+    # Arrays free to load the next images into
+    buffers = []
+
+    def next_buffer():
+        if not reuse_buffers:
+            return None
+        return buffers.pop() if buffers else np.empty(shape, dtype=info.dtype)
+
+    if depth < 1:
+        for fname in filenames:
+            img = load(fname, out=next_buffer(), **kwargs)
+            yield fname, img
+            # The caller asked for the next image, so this one is free again
+            if reuse_buffers:
+                buffers.append(img)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = ThreadPoolExecutor(max_workers=depth, thread_name_prefix="prefetch")
+    pending = collections.deque()
+    try:
+        for (num, fname) in enumerate(filenames):
+            fut = pool.submit(load, fname, out=next_buffer(), **kwargs)
+            pending.append((fname, fut))
+            # Keep `depth` reads going while the caller has the oldest image
+            is_last = num == len(filenames) - 1
+            while len(pending) > depth or (pending and is_last):
+                cur_fname, fut = pending.popleft()
+                img = fut.result()
+                yield cur_fname, img
+                if reuse_buffers:
+                    buffers.append(img)
+    finally:
+        # Also runs if the caller stops early: drop the reads not yet started
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def get_info(filename, rsc_file=None, band=1):
+    """Get the shape, dtype, nodata value and geotransform of a raster
+
+    The header is only parsed the first time a file is seen; later calls
+    (for the same file, unchanged on disk) use the cached result.
+
+    Parameters
+    ----------
+    filename : str
+        Name of raster file
+    rsc_file : str
+        If given, the ROI_PAC .rsc file describing `filename` (Default value = None)
+    band : int
+        For gdal, the band of the image to describe (Default value = 1)
+
+    Returns
+    -------
+    RasterInfo
+    """
+    if rsc_file:
+        return _rsc_info(*_file_key(rsc_file))
+    return _gdal_info(*_file_key(filename), band)
+
+
+def _file_key(filename):
+    """Cache key for a file's header: changes if the file is modified"""
+    return os.path.abspath(filename), os.stat(filename).st_mtime_ns
+
+
+@functools.lru_cache(maxsize=None)
+def _rsc_info(path, mtime_ns):
+    rsc_data = _parse_rsc(path, mtime_ns)
+    geotransform = (
+        rsc_data.get("x_first"),
+        rsc_data.get("x_step"),
+        0.0,
+        rsc_data.get("y_first"),
+        0.0,
+        rsc_data.get("y_step"),
+    )
+    shape = (rsc_data["file_length"], rsc_data["width"])
+    return RasterInfo(shape, FLOAT_32_LE, None, geotransform)
+
+
+@functools.lru_cache(maxsize=None)
+def _gdal_info(path, mtime_ns, band):
+    try:
+        from osgeo import gdal_array
+    except ImportError:
+        raise ValueError("Need to `conda install gdal` to load gdal-readable")
+
+    with _gdal_pool.open(path) as ds:
+        bnd = ds.GetRasterBand(band)
+        dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(bnd.DataType))
+        shape = (ds.RasterYSize, ds.RasterXSize)
+        return RasterInfo(shape, dtype, bnd.GetNoDataValue(), ds.GetGeoTransform())
+
+
+class _GdalPool:
+    """Bounded LRU pool of open GDAL datasets, shared by all loads
+
+    `open` hands out a dataset for the length of a `with` block.
+    Datasets in use are never closed, and no dataset is used by two threads at once.
+    """
+
+    def __init__(self, maxsize=GDAL_POOL_SIZE):
+        self.maxsize = maxsize
+        self._datasets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def open(self, filename):
+        path = os.path.abspath(filename)
+        ds = self._checkout(path)
+        try:
+            yield ds
+        finally:
+            self._checkin(path, ds)
+
+    def _checkout(self, path):
+        with self._lock:
+            free = self._datasets.get(path)
+            if free:
+                return free.pop()
+        try:
+            from osgeo import gdal
+
+            gdal.UseExceptions()
+        except ImportError:
+            raise ValueError("Need to `conda install gdal` to load gdal-readable")
+        return gdal.Open(path)
+
+    def _checkin(self, path, ds):
+        with self._lock:
+            self._datasets.setdefault(path, []).append(ds)
+            self._datasets.move_to_end(path)
+            while len(self._datasets) > self.maxsize:
+                # Dropping the last reference closes the dataset
+                self._datasets.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._datasets.clear()
+
+
+_gdal_pool = _GdalPool()
+# Open GDAL handles can't be shared with forked (e.g. process pool) children
+os.register_at_fork(after_in_child=_gdal_pool.clear)
+
+
 def load_rsc(filename, lower=False, **kwargs):
     """Loads and parses the .rsc file
 
@@ -105,21 +342,31 @@ def load_rsc(filename, lower=False, **kwargs):
 
     """
 
-    # Use OrderedDict so that upsample_dem_rsc creates with same ordering as old
-    output_data = collections.OrderedDict()
-    # Second part in tuple is used to cast string to correct type
-
-    with open(filename, "r") as f:
-        for line in f.readlines():
-            for field, num_type in RSC_KEY_TYPES:
-                if line.startswith(field.upper()):
-                    output_data[field] = num_type(line.split()[1])
+    # Copy so that callers can't modify the cached version
+    output_data = collections.OrderedDict(_parse_rsc(*_file_key(filename)))
 
     if lower:
         output_data = {k.lower(): d for k, d in output_data.items()}
     return output_data
 
 
+@functools.lru_cache(maxsize=None)
+def _parse_rsc(path, mtime_ns):
+    """Parse a .rsc file once (per modification time)"""
+    # Second part in tuple is used to cast string to correct type
+    key_types = {field.upper(): (field, num_type) for field, num_type in RSC_KEY_TYPES}
+    # Use OrderedDict so that upsample_dem_rsc creates with same ordering as old
+    output_data = collections.OrderedDict()
+    with open(path, "r") as f:
+        for line in f:
+            words = line.split()
+            if len(words) < 2 or words[0] not in key_types:
+                continue
+            field, num_type = key_types[words[0]]
+            output_data[field] = num_type(words[1])
+    return output_data
+
+
 def load_stacked_img(
     filename,
     rows=None,
@@ -127,6 +374,8 @@ def load_stacked_img(
     rsc_data=None,
     return_amp=False,
     dtype=FLOAT_32_LE,
+    window=None,
+    out=None,
     **kwargs,
 ):
     """Helper function to load .unw and .cor files from snaphu output
@@ -155,6 +404,12 @@ def load_stacked_img(
         bool (Default value = False)
     dtype :
          (Default value = FLOAT_32_LE)
+    window :
+        ((row_start, row_stop), (col_start, col_stop)) to load.
+        The file is memory mapped, so only the bytes of the requested
+        band within the window are read from disk (Default value = None)
+    out :
+        array to copy the loaded data into, instead of a new one (Default value = None)
     **kwargs :
         
 
@@ -163,19 +418,28 @@ def load_stacked_img(
     type
         ndarray: dtype=float32, the second matrix (height, correlation, ...) parsed
         if return_amp == True, returns two ndarrays stacked along axis=0
+        The output is always a contiguous copy (not a view of the file),
+        which is `out` if given.
 
     """
     if rows is None or cols is None:
         rows, cols = rsc_data["file_length"], rsc_data["width"]
 
-    data = np.fromfile(filename, dtype)
-
-    first = data.reshape((rows, 2 * cols))[:, :cols]
-    second = data.reshape((rows, 2 * cols))[:, cols:]
+    if window is None:
+        window = ((0, rows), (0, cols))
+    (row_start, row_stop), (col_start, col_stop) = window
+    # View the file as (line, band, col) without reading anything yet
+    data = np.memmap(filename, dtype=dtype, mode="r", shape=(rows, 2, cols))
     if return_amp:
-        return np.stack((first, second), axis=0)
+        view = data[row_start:row_stop, :, col_start:col_stop].transpose(1, 0, 2)
     else:
-        return second
+        # Only pages of the second band in the window get read from disk
+        view = data[row_start:row_stop, 1, col_start:col_stop]
+    # Copy into a contiguous, in-memory array so the file gets closed
+    if out is None:
+        return np.array(view, order="C")
+    np.copyto(out, view)
+    return out
 
 
 def load_mask(mask_files, rsc_file=None, mask_is_zero=False):
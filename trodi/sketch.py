@@ -0,0 +1,200 @@
+"""
+Fixed-size, per-pixel histograms to approximate the median and MAD of a stack
+
+The memory used is (rows x cols x (nbins + 1)) counts, no matter how many
+date layers are added, so pixel-level labels can be made for very long stacks
+by reading one layer at a time. The quantiles are computed over blocks of
+rows, so their temporaries fit in a `max_memory` budget.
+"""
+import numpy as np
+
+from .logger import get_log
+from .utils import block_windows
+
+log = get_log()
+
+
+class HistogramSketch:
+    """Binned histogram of the (non-negative) values seen at each pixel
+
+    Values in [0, `max_value`] go into `nbins` equal-width bins, and larger values
+    go into one extra overflow bin. Quantiles are found by linear interpolation
+    of the cumulative counts within a bin, so for values up to `max_value`:
+
+        - the median is within one bin width (`max_value` / `nbins`)
+          of a median of the values
+        - the (unscaled) MAD is within two bin widths of a MAD of the values
+
+    (For an even number of values, any point between the two middle values is a
+    median, so the difference from `np.median` can also include half that gap.
+    This matters for short stacks, not long ones where sketches are useful.)
+
+    Nan values are not counted. A warning is logged by `median_mad` for pixels
+    whose median or MAD reaches into the overflow bin, where these bounds don't
+    hold (pass the largest value of the stack as `max_value` to avoid this).
+
+    Parameters
+    ----------
+    shape : tuple[int, int]
+        (rows, cols) of each layer
+    nbins : int
+        number of bins below `max_value` (Default value = 64)
+    max_value : float
+        upper edge of the last (non-overflow) bin. (Default value = None, which
+        uses 10 times the 99th percentile of the first layer with any values
+        passed to `update`)
+    dtype :
+        dtype of the counts. uint16 allows up to 65535 layers (Default value = np.uint16)
+    max_memory : float
+        Memory budget (in GB) for the temporaries of `update`, `quantile` and
+        `median_mad`, which work on blocks of rows (Default value = 1.0)
+
+    Examples
+    --------
+    >>> sketch = HistogramSketch((1, 1), nbins=100, max_value=10.0)
+    >>> for val in [1.0, 2.0, 3.0, 4.0, 9.0]:
+    ...     sketch.update(np.array([[val]]))
+    >>> med, mad = sketch.median_mad(scale=1)
+    >>> bool(abs(med[0, 0] - 3.0) <= sketch.bin_width)
+    True
+    >>> bool(abs(mad[0, 0] - 1.0) <= 2 * sketch.bin_width)
+    True
+    """
+
+    def __init__(
+        self, shape, nbins=64, max_value=None, dtype=np.uint16, max_memory=1.0
+    ):
+        self.shape = tuple(shape)
+        self.nbins = nbins
+        self.max_value = max_value
+        self.max_memory = max_memory
+        self.counts = np.zeros((int(np.prod(shape)), nbins + 1), dtype=dtype)
+
+    @property
+    def bin_width(self):
+        return self.max_value / self.nbins
+
+    def update(self, layer):
+        """Add one (rows, cols) layer of values to the histograms"""
+        layer = np.asarray(layer)
+        if self.max_value is None:
+            values = layer.astype(np.float64)
+            if np.isnan(values).all():
+                # Nothing to count, or to pick the bins from
+                return
+            self.max_value = 10 * float(np.nanpercentile(values, 99)) or 1.0
+        for pixels in self._blocks():
+            values = layer.ravel()[pixels].astype(np.float64)
+            good = ~np.isnan(values)
+            values = values[good]
+            bins = np.minimum(values / self.bin_width, self.nbins - 1).astype(np.intp)
+            bins[values > self.max_value] = self.nbins
+            # Each pixel appears once per layer, so fancy-index increments are safe
+            counts = self.counts[pixels]
+            counts[np.flatnonzero(good), bins] += 1
+
+    def quantile(self, q):
+        """Approximate `q`-th quantile (0 <= q <= 1) at each pixel"""
+        out = np.empty(len(self.counts))
+        for pixels in self._blocks():
+            counts = self.counts[pixels]
+            cum = np.cumsum(counts, axis=1, dtype=np.float64)
+            out[pixels] = self._quantile(cum, counts, q)
+        return out.reshape(self.shape)
+
+    def median_mad(self, scale=1.4826):
+        """Approximate median and scaled median absolute deviation at each pixel
+
+        Returns
+        -------
+        med : ndarray
+        mad : ndarray
+            nan where no values were added, same as `core.median_mad`
+        """
+        med = np.empty(len(self.counts))
+        mad = np.empty(len(self.counts))
+        noverflow = 0
+        for pixels in self._blocks():
+            counts = self.counts[pixels]
+            cum = np.cumsum(counts, axis=1, dtype=np.float64)
+            med[pixels], mad[pixels] = self._median_mad(cum, counts)
+            noverflow += self._count_overflow(cum, counts, med[pixels])
+        if noverflow:
+            log.warning(
+                "{} pixel(s) have a median or MAD past the histograms' max value "
+                "{:.3g}, so they are underestimated".format(noverflow, self.max_value)
+            )
+        return med.reshape(self.shape), (scale * mad).reshape(self.shape)
+
+    def _blocks(self):
+        """Slices of the (flattened) pixels in each block of rows within `max_memory`"""
+        rows, cols = self.shape
+        # float64 cumulative counts and a comparison mask for each bin,
+        # plus a few float64 temporaries per pixel
+        bytes_per_row = cols * ((self.nbins + 1) * 9 + 200)
+        block_rows = int(max(1, min(rows, self.max_memory * 1e9 // bytes_per_row)))
+        return [
+            slice(row_start * cols, row_stop * cols)
+            for ((row_start, row_stop), _) in block_windows(
+                (rows, cols), (block_rows, cols)
+            )
+        ]
+
+    def _median_mad(self, cum, counts):
+        """Unscaled median and MAD of the pixels with cumulative counts `cum`"""
+        total = cum[:, -1]
+        med = self._quantile(cum, counts, 0.5)
+
+        # Find the half width `t` where [med - t, med + t] holds half the values
+        lo = np.zeros_like(med)
+        hi = np.full_like(med, self.max_value)
+        target = 0.5 * total
+        # Bisect to well under a bin width
+        niter = int(np.ceil(np.log2(4 * self.nbins)))
+        for _ in range(niter):
+            mid = (lo + hi) / 2
+            inside = self._interp_cdf(cum, counts, med + mid) - self._interp_cdf(
+                cum, counts, med - mid
+            )
+            enough = inside >= target
+            hi = np.where(enough, mid, hi)
+            lo = np.where(enough, lo, mid)
+        mad = (lo + hi) / 2
+        mad[np.isnan(med)] = np.nan
+        return med, mad
+
+    def _count_overflow(self, cum, counts, med):
+        """Number of pixels where [med - t, med + t] needs the overflow bin to
+        hold half the values, so neither `med` nor the MAD `t` is bounded"""
+        edge = np.full_like(med, self.max_value)
+        inside = self._interp_cdf(cum, counts, edge) - self._interp_cdf(
+            cum, counts, 2 * med - edge
+        )
+        return int(np.count_nonzero(inside < 0.5 * cum[:, -1]))
+
+    def _quantile(self, cum, counts, q):
+        total = cum[:, -1]
+        target = q * total
+        # First bin where the cumulative count reaches the target
+        idx = np.minimum(
+            (cum < target[:, np.newaxis]).sum(axis=1), self.nbins
+        ).astype(np.intp)
+        rows = np.arange(len(cum))
+        below = np.where(idx > 0, cum[rows, np.maximum(idx - 1, 0)], 0)
+        in_bin = counts[rows, idx].astype(np.float64)
+        frac = np.divide(
+            target - below, in_bin, out=np.zeros_like(target), where=in_bin > 0
+        )
+        out = (idx + frac) * self.bin_width
+        # Quantiles in the overflow bin are only known to be >= `max_value`
+        out[idx == self.nbins] = self.max_value
+        out[total == 0] = np.nan
+        return out
+
+    def _interp_cdf(self, cum, counts, values):
+        """Interpolated count of values <= `values` (one per pixel)"""
+        pos = np.clip(values / self.bin_width, 0, self.nbins)
+        idx = np.minimum(pos.astype(np.intp), self.nbins)
+        rows = np.arange(len(cum))
+        below = np.where(idx > 0, cum[rows, np.maximum(idx - 1, 0)], 0)
+        return below + (pos - idx) * counts[rows, idx]
@@ -0,0 +1,194 @@
+"""
+Synthetic interferogram stacks with known outliers, for benchmarks and testing
+
+`make_stack` simulates a phase image for each SAR date (noise plus a random
+ramp, with outlier pixels injected), then writes the interferograms of a
+network where each date is paired with its next `connectivity` dates.
+"""
+import collections
+import datetime
+import os
+
+import numpy as np
+
+from . import sario
+from .logger import get_log
+
+log = get_log()
+
+SyntheticStack = collections.namedtuple(
+    "SyntheticStack", ["unw_file_list", "date_list", "rsc_file", "outliers"]
+)
+SyntheticStack.__doc__ = """Files and truth of a stack written by `make_stack`
+
+unw_file_list : list[str] of the interferogram files
+date_list : list[datetime.date] of the SAR dates
+rsc_file : the .rsc file describing them (None for GeoTIFFs)
+outliers : bool (dates, rows, cols) array of the injected outlier pixels
+"""
+
+
+def make_stack(
+    outdir,
+    shape=(100, 100),
+    ndates=10,
+    connectivity=3,
+    start_date=datetime.date(2015, 1, 1),
+    date_spacing=12,
+    noise_scale=1.0,
+    ramp_scale=5.0,
+    outlier_fraction=0.001,
+    outlier_scale=20.0,
+    nan_fraction=0.0,
+    file_format="unw",
+    seed=0,
+):
+    """Write a synthetic stack of interferograms to `outdir`
+
+    Parameters
+    ----------
+    outdir : str
+        directory to write the interferograms (created if missing)
+    shape : tuple[int, int]
+        (rows, cols) of each interferogram (Default value = (100, 100))
+    ndates : int
+        number of SAR dates (Default value = 10)
+    connectivity : int
+        each date is paired with (up to) this many following dates,
+        so there are about `ndates * connectivity` interferograms (Default value = 3)
+    start_date : datetime.date
+        first SAR date (Default value = datetime.date(2015, 1, 1))
+    date_spacing : int
+        days between SAR dates (Default value = 12)
+    noise_scale : float
+        standard deviation of the phase noise of each date (Default value = 1.0)
+    ramp_scale : float
+        size of the random linear ramp of each date, across the image
+        (Default value = 5.0)
+    outlier_fraction : float
+        fraction of the pixels of each date to make outliers (Default value = 0.001)
+    outlier_scale : float
+        phase added to an outlier pixel, in units of `noise_scale`
+        (Default value = 20.0)
+    nan_fraction : float
+        fraction of the pixels of each interferogram to set to nan (Default value = 0.0)
+    file_format : str
+        "unw" for ROI_PAC .unw files (amplitude and phase, band interleaved by line)
+        with one dem.rsc, or "tif" for 2-band (amplitude, phase) GeoTIFFs, which
+        needs GDAL (Default value = "unw")
+    seed : int
+        seed of the random generator (Default value = 0)
+
+    Returns
+    -------
+    SyntheticStack
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as outdir:
+    ...     stack = make_stack(outdir, shape=(4, 5), ndates=4, connectivity=2)
+    ...     img = sario.load(stack.unw_file_list[0], rsc_file=stack.rsc_file)
+    >>> len(stack.unw_file_list), img.shape
+    (5, (4, 5))
+    """
+    if file_format not in ("unw", "tif"):
+        raise ValueError("`file_format` must be 'unw' or 'tif'")
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    rows, cols = shape
+    date_list = [
+        start_date + datetime.timedelta(days=date_spacing * idx)
+        for idx in range(ndates)
+    ]
+    rsc_data = dict(
+        width=cols,
+        file_length=rows,
+        x_first=-100.0,
+        y_first=30.0,
+        x_step=0.001,
+        y_step=-0.001,
+        x_unit="degrees",
+        y_unit="degrees",
+        z_offset=0,
+        z_scale=1,
+        projection="LL",
+    )
+
+    yy, xx = np.meshgrid(
+        np.linspace(-0.5, 0.5, rows), np.linspace(-0.5, 0.5, cols), indexing="ij"
+    )
+    phases = np.empty((ndates, rows, cols), dtype=np.float32)
+    for idx in range(ndates):
+        ramp_y, ramp_x = rng.normal(scale=ramp_scale, size=2)
+        phases[idx] = rng.normal(scale=noise_scale, size=shape)
+        phases[idx] += ramp_y * yy + ramp_x * xx
+    outliers = rng.random(phases.shape) < outlier_fraction
+    phases[outliers] += outlier_scale * noise_scale
+
+    amplitude = np.ones(shape, dtype=np.float32)
+    unw_file_list = []
+    for early in range(ndates):
+        for late in range(early + 1, min(ndates, early + connectivity + 1)):
+            ifg = phases[late] - phases[early]
+            ifg[rng.random(shape) < nan_fraction] = np.nan
+            name = "{}_{}.{}".format(
+                date_list[early].strftime("%Y%m%d"),
+                date_list[late].strftime("%Y%m%d"),
+                file_format,
+            )
+            fname = os.path.join(outdir, name)
+            if file_format == "unw":
+                _save_unw(fname, amplitude, ifg)
+            else:
+                _save_geotiff(fname, amplitude, ifg, rsc_data)
+            unw_file_list.append(fname)
+
+    rsc_file = None
+    if file_format == "unw":
+        rsc_file = os.path.join(outdir, "dem.rsc")
+        _save_rsc(rsc_file, rsc_data)
+    log.info(
+        "Wrote {} {}x{} interferograms of {} dates to {}".format(
+            len(unw_file_list), rows, cols, ndates, outdir
+        )
+    )
+    return SyntheticStack(unw_file_list, date_list, rsc_file, outliers)
+
+
+def _save_unw(fname, amplitude, phase):
+    """Write amplitude and phase interleaved by line, as `sario.load_stacked_img` reads"""
+    np.stack((amplitude, phase), axis=1).astype(sario.FLOAT_32_LE).tofile(fname)
+
+
+def _save_rsc(fname, rsc_data):
+    with open(fname, "w") as f:
+        for field, _ in sario.RSC_KEY_TYPES:
+            f.write("{} {}\n".format(field.upper(), rsc_data[field]))
+
+
+def _save_geotiff(fname, amplitude, phase, rsc_data):
+    try:
+        from osgeo import gdal, osr
+    except ImportError:
+        raise ValueError("Need to `conda install gdal` to write GeoTIFFs")
+
+    rows, cols = phase.shape
+    ds = gdal.GetDriverByName("GTiff").Create(fname, cols, rows, 2, gdal.GDT_Float32)
+    ds.SetGeoTransform(
+        (
+            rsc_data["x_first"],
+            rsc_data["x_step"],
+            0.0,
+            rsc_data["y_first"],
+            0.0,
+            rsc_data["y_step"],
+        )
+    )
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(amplitude)
+    ds.GetRasterBand(2).WriteArray(phase)
+    ds.FlushCache()
+    ds = None
@@ -5,8 +5,6 @@ import time
 from collections.abc import Iterable
 from glob import glob
 
-import cftime
-import h5netcdf.legacyapi as nc
 import numpy as np
 
 from . import sario
@@ -14,6 +12,16 @@ from .logger import get_log
 
 log = get_log()
 DATE_FMT = "%Y%m%d"
+# Chunking/compression layouts for (date, lat, lon) stacks. See `storage_options`
+STORAGE_PRESETS = {
+    # One date per chunk, with a fast codec: date layers are written independently
+    "write-optimized": dict(chunks=None, codec="lzf", complevel=None, shuffle=False),
+    # Many dates of a small window per chunk: a pixel's time series is one chunk read
+    "time-series-read-optimized": dict(
+        chunks=(128, 32, 32), codec="zlib", complevel=4, shuffle=True
+    ),
+}
+DEFAULT_STORAGE = dict(chunks=None, codec="zlib", complevel=4, shuffle=True)
 
 
 def find_igrams(directory=".", ext=".int", parse=True, filename=None):
@@ -99,6 +107,150 @@ def _parse(datestr):
     return datetime.datetime.strptime(datestr, DATE_FMT).date()
 
 
+def scan_igrams(directory=".", ext=".int", filename=None):
+    """List igram files with one pass over `directory` (or read them from `filename`)
+
+    Matches `find_igrams(..., parse=False)`: files are sorted, and names
+    starting with "." are skipped.
+
+    Parameters
+    ----------
+    directory : str
+        path to the igram directory (Default value = ".")
+    ext : str
+        file extension when searching a directory (Default value = ".int")
+    filename : str
+        name of a file with igram filenames separated by newlines (Default value = None)
+
+    Returns
+    -------
+    list[str]
+    """
+    if filename is not None:
+        return find_igrams(filename=filename, parse=False)
+    with os.scandir(directory) as entries:
+        names = sorted(
+            entry.name
+            for entry in entries
+            if entry.name.endswith(ext) and not entry.name.startswith(".")
+        )
+    return [os.path.join(directory, name) for name in names]
+
+
+def parse_date_pairs(igram_file_list):
+    """Parse the (early, late) dates of "YYYYmmdd_YYYYmmdd*" igram names at once
+
+    Parameters
+    ----------
+    igram_file_list : list[str]
+        igram filenames (or paths)
+
+    Returns
+    -------
+    ndarray
+        datetime64[D], shape (nigrams, 2)
+
+    Examples
+    --------
+    >>> parse_date_pairs(["a/20150101_20150113.unw", "20150113_20150220_filt.unw"])
+    array([['2015-01-01', '2015-01-13'],
+           ['2015-01-13', '2015-02-20']], dtype='datetime64[D]')
+    >>> parse_date_pairs(["20150101_20151301.unw"])
+    Traceback (most recent call last):
+    ...
+    ValueError: unconverted data remains: 1
+    """
+    names = np.array([os.path.basename(f) for f in igram_file_list], dtype="U17")
+    # View each name as its characters, to pull out the 8 digit dates
+    chars = names.view("U1").reshape(len(names), 17)
+    digits = np.concatenate((chars[:, :8], chars[:, 9:17]), axis=1)
+    ymd = np.ascontiguousarray(digits).view("U8").astype(int)
+    year, month, day = ymd // 10000, ymd // 100 % 100, ymd % 100
+    months = (year - 1970).astype("M8[Y]").astype("M8[M]") + (month - 1)
+    dates = months.astype("M8[D]") + (day - 1)
+    # An impossible month or day (e.g. 20151301) would roll over into another date
+    valid = (month >= 1) & (month <= 12) & (day >= 1)
+    valid &= dates.astype("M8[M]") == months
+    for name in names[~valid.all(axis=1)]:
+        # Raises the same ValueError as parsing the name one date at a time
+        _parse(name[:8]), _parse(name[9:17])
+    return dates
+
+
+class IgramIndex:
+    """Lookup from each SAR date to the igrams which are averaged for it
+
+    The igrams of date `i` are `igram_idxs[offsets[i]:offsets[i + 1]]`
+    (compressed sparse row layout), in file order. Each has a `sign` of -1
+    if the date is the igram's early date, and +1 if it's the late date
+    (an igram is late phase - early phase). Igrams longer than
+    `max_temporal_baseline` days are left out of the lookup, but their dates
+    are still SAR dates.
+
+    Parameters
+    ----------
+    igram_file_list : list[str]
+        igram filenames, named "YYYYmmdd_YYYYmmdd*"
+    max_temporal_baseline : int
+        longest igram (in days) to use for averaging (Default value = None, all)
+
+    Examples
+    --------
+    >>> index = IgramIndex(["20150101_20150113.unw", "20150101_20150125.unw",
+    ...                     "20150113_20150125.unw"], max_temporal_baseline=12)
+    >>> index.sar_date_list[1], index.date_igrams(1)
+    (datetime.date(2015, 1, 13), [('20150101_20150113.unw', 1), ('20150113_20150125.unw', -1)])
+    >>> index.baselines.tolist()
+    [12, 24, 12]
+    """
+
+    def __init__(self, igram_file_list, max_temporal_baseline=None):
+        self.unw_file_list = list(igram_file_list)
+        self.date_pairs = parse_date_pairs(self.unw_file_list)
+        self.dates = np.unique(self.date_pairs)
+        self.baselines = (self.date_pairs[:, 1] - self.date_pairs[:, 0]).astype(int)
+
+        used = np.ones(len(self.unw_file_list), dtype=bool)
+        if max_temporal_baseline is not None:
+            used = np.abs(self.baselines) <= max_temporal_baseline
+        # One (date, igram, sign) entry for each end of each used igram
+        used_idxs = np.flatnonzero(used)
+        date_idxs = np.searchsorted(self.dates, self.date_pairs[used]).ravel()
+        # Stable, so each date's igrams stay in file order
+        order = np.argsort(date_idxs, kind="stable")
+        self.igram_idxs = np.repeat(used_idxs, 2)[order]
+        self.signs = np.tile(np.array([-1, 1], dtype=np.int8), len(used_idxs))[order]
+        counts = np.bincount(date_idxs, minlength=len(self.dates))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    @classmethod
+    def from_directory(cls, directory=".", ext=".int", filename=None, **kwargs):
+        """Index the igrams found by `scan_igrams`"""
+        return cls(scan_igrams(directory, ext=ext, filename=filename), **kwargs)
+
+    @property
+    def sar_date_list(self):
+        """The SAR dates as a list of datetime.date"""
+        return self.dates.tolist()
+
+    @property
+    def ifg_date_list(self):
+        """The (early, late) datetime.date of each igram"""
+        return [tuple(pair) for pair in self.date_pairs.tolist()]
+
+    def date_slice(self, date_idx):
+        """Slice of `igram_idxs`/`signs` for the igrams of the date `date_idx`"""
+        return slice(self.offsets[date_idx], self.offsets[date_idx + 1])
+
+    def date_igrams(self, date_idx):
+        """List the (filename, sign) of the igrams to average for `date_idx`"""
+        key = self.date_slice(date_idx)
+        return [
+            (self.unw_file_list[igram_idx], int(sign))
+            for (igram_idx, sign) in zip(self.igram_idxs[key], self.signs[key])
+        ]
+
+
 def get_latlon_arrs(h5_filename=None, rsc_file=None, gdal_file=None):
     """
 
@@ -193,19 +345,10 @@ def grid(
         x = np.linspace(x_first, x_first + (cols - 1) * x_step, cols).reshape((1, cols))
         y = np.linspace(y_first, y_first + (rows - 1) * y_step, rows).reshape((rows, 1))
     else:
-        try:
-            from osgeo import gdal
-        except ImportError:
-            raise ValueError(
-                "Need to `conda install gdal` to pass gdal-readable files to `grid`"
-            )
-
-        # get size of the raster
-        ds = gdal.Open(fname)
-        cols = ds.RasterXSize
-        rows = ds.RasterYSize
-        ulx, xres, _, uly, _, yres  = ds.GetGeoTransform()
-        ds = None
+        # get size of the raster (header is cached by `sario`)
+        info = sario.get_info(fname)
+        rows, cols = info.shape
+        ulx, xres, _, uly, _, yres = info.geotransform
 
         # lon_list, lat_list = src.xy(np.arange(max_len), np.arange(max_len))
         x = ulx + np.arange(cols) * xres
@@ -214,6 +357,35 @@ def grid(
     return np.meshgrid(x, y, sparse=sparse)
 
 
+def block_windows(shape, block_shape):
+    """Split an image into windows of (at most) `block_shape`
+
+    Parameters
+    ----------
+    shape : tuple[int, int]
+        (rows, cols) of the full image
+    block_shape : tuple[int, int]
+        (rows, cols) of each block
+
+    Returns
+    -------
+    list[tuple[tuple[int, int], tuple[int, int]]]
+        ((row_start, row_stop), (col_start, col_stop)) for each block
+
+    Examples
+    --------
+    >>> block_windows((5, 4), (3, 4))
+    [((0, 3), (0, 4)), ((3, 5), (0, 4))]
+    """
+    rows, cols = shape
+    block_rows, block_cols = block_shape
+    return [
+        ((r, min(r + block_rows, rows)), (c, min(c + block_cols, cols)))
+        for r in range(0, rows, block_rows)
+        for c in range(0, cols, block_cols)
+    ]
+
+
 def create_empty_nc_stack(
     outname,
     date_list=None,
@@ -225,13 +397,15 @@ def create_empty_nc_stack(
     lat_units="degrees north",
     lon_units="degrees east",
     overwrite=False,
+    storage=None,
 ):
-    """Creates skeleton of .nc stack without writing stack data
+    """Creates skeleton of a stack without writing stack data
 
     Parameters
     ----------
     outname : str
-        name of .nc output file to save
+        name of output file to save: .nc for NetCDF, .zarr or .bin
+        (flat binary files), see `backends`
     date_list : list[datetime.date]
         if layers of stack correspond to dates of SAR images (Default value = None)
     rsc_file : str
@@ -251,13 +425,24 @@ def create_empty_nc_stack(
         default = "degrees east",
     overwrite : bool
         default = False, will overwrite file if true
+    storage : str or dict
+        chunking and compression of the stack data, see `storage_options`
+        (Default value = None, zlib compressed chunks of one date)
 
     Returns
     -------
 
     """
-    if not outname.endswith(".nc"):
-        raise ValueError("{} must be an .nc filename".format(outname))
+    import cftime
+
+    from . import backends
+
+    if not outname.rstrip("/").endswith(tuple(backends.EXTENSIONS)):
+        raise ValueError(
+            "{} must be a {} filename".format(
+                outname, ", ".join(backends.EXTENSIONS)
+            )
+        )
 
     # TODO: allow for radar coordinates and just "x, y" generic?
     lon_arr, lat_arr = get_latlon_arrs(
@@ -274,27 +459,30 @@ def create_empty_nc_stack(
 
     log.info("Making dimensions and variables")
     mode = "w" if overwrite else "x"
-    with nc.Dataset(outname, mode) as f:
-        f.history = "Created " + time.ctime(time.time())
+    with backends.open_dataset(outname, mode) as f:
+        f.setncattr("history", "Created " + time.ctime(time.time()))
 
         f.createDimension("lat", rows)
         f.createDimension("lon", cols)
-        # Could make this unlimited to add to it later?
         latitudes = f.createVariable("lat", "f4", ("lat",), zlib=True)
         longitudes = f.createVariable("lon", "f4", ("lon",), zlib=True)
-        latitudes.units = lat_units
-        longitudes.units = lon_units
+        latitudes.setncattr("units", lat_units)
+        longitudes.setncattr("units", lon_units)
 
-        f.createDimension(stack_dim_name, depth)
+        # Unlimited, so that new dates can be appended later (see `append_nc_dates`)
+        f.createDimension(stack_dim_name, None)
         stack_dim_variable = f.createVariable(
             stack_dim_name, "f4", (stack_dim_name,), zlib=True
         )
-        stack_dim_variable.units = "days since {}".format(date_list[0])
+        stack_dim_variable.setncattr("units", "days since {}".format(date_list[0]))
 
         # Write data
         latitudes[:] = lat_arr
         longitudes[:] = lon_arr
-        d2n = cftime.date2num(stack_dim_arr, units=stack_dim_variable.units)
+        f.resize_dimension(stack_dim_name, depth)
+        d2n = cftime.date2num(
+            stack_dim_arr, units=stack_dim_variable.getncattr("units")
+        )
         stack_dim_variable[:] = d2n
 
         # Finally, the actual stack
@@ -303,13 +491,176 @@ def create_empty_nc_stack(
         dt = np.dtype(dtype)
         fill_value = 0
 
-        f.createVariable(
+        f.create_variable(
             stack_data_name,
-            dt,
             (stack_dim_name, "lat", "lon"),
-            fill_value=fill_value,
-            zlib=True,
+            dt,
+            fillvalue=fill_value,
+            **storage_options((rows, cols), storage),
+        )
+
+
+def stack_chunks(shape, max_size=512):
+    """Chunk shape for a (date, rows, cols) stack with an unlimited date dimension
+
+    Each chunk holds one date, so writing a date layer doesn't touch the others
+
+    Examples
+    --------
+    >>> stack_chunks((600, 80))
+    (1, 512, 80)
+    """
+    rows, cols = shape
+    return (1, min(rows, max_size), min(cols, max_size))
+
+
+def storage_options(shape, storage=None):
+    """Chunking and compression keywords for a (date, rows, cols) stack variable
+
+    Parameters
+    ----------
+    shape : tuple[int, int]
+        (rows, cols) of each date layer
+    storage : str or dict
+        Name of one of the `STORAGE_PRESETS`, or a dict with any of the keys
+            "preset": name of a preset to start from (default uses `DEFAULT_STORAGE`)
+            "chunks": (dates, rows, cols) of each chunk (None uses `stack_chunks`)
+            "codec": "zlib", "lzf", "blosc" (needs `hdf5plugin`) or "none".
+                Only zlib compressed files can be read by the netCDF-C library
+            "complevel": compression level, for zlib (0-9) or blosc
+            "shuffle": use the byte shuffle filter before compressing
+        (Default value = None, `DEFAULT_STORAGE`)
+
+    Returns
+    -------
+    dict
+        keywords for `create_variable` of an `h5netcdf` file/group.
+        Drop the first dimension of "chunks" for a (rows, cols) variable.
+
+    Examples
+    --------
+    >>> storage_options((60, 80), "time-series-read-optimized")["chunks"]
+    (128, 32, 32)
+    >>> storage_options((60, 80), {"codec": "none"})
+    {'chunks': (1, 60, 80), 'compression': None, 'compression_opts': None, 'shuffle': False}
+    >>> storage_options((60, 80), {"complvl": 9})
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown storage option(s) ['complvl'], choices: ['preset', 'chunks', 'codec', 'complevel', 'shuffle']
+    """
+    if isinstance(storage, str):
+        storage = {"preset": storage}
+    storage = dict(storage or {})
+    unknown = set(storage) - {"preset"} - set(DEFAULT_STORAGE)
+    if unknown:
+        raise ValueError(
+            "Unknown storage option(s) {}, choices: {}".format(
+                sorted(unknown), ["preset"] + list(DEFAULT_STORAGE)
+            )
+        )
+    preset = storage.pop("preset", None)
+    if preset is not None and preset not in STORAGE_PRESETS:
+        raise ValueError(
+            "Unknown storage preset {}, choices: {}".format(
+                preset, list(STORAGE_PRESETS)
+            )
+        )
+    opts = dict(STORAGE_PRESETS[preset] if preset else DEFAULT_STORAGE)
+    opts.update({k: v for k, v in storage.items() if v is not None})
+
+    rows, cols = shape
+    chunks = opts["chunks"] or stack_chunks(shape)
+    chunks = (chunks[0], min(chunks[1], rows), min(chunks[2], cols))
+    codec, complevel, shuffle = opts["codec"], opts["complevel"], opts["shuffle"]
+    if codec == "zlib":
+        out = dict(compression="gzip", compression_opts=complevel, shuffle=shuffle)
+    elif codec == "lzf":
+        out = dict(compression="lzf", compression_opts=None, shuffle=shuffle)
+    elif codec == "blosc":
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ValueError("Need to `pip install hdf5plugin` to use blosc")
+        blosc = hdf5plugin.Blosc(
+            cname="lz4",
+            clevel=5 if complevel is None else complevel,
+            shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE,
         )
+        # Blosc does its own shuffling
+        out = dict(blosc, shuffle=False)
+    elif codec in ("none", None):
+        out = dict(compression=None, compression_opts=None, shuffle=False)
+    else:
+        raise ValueError("Unknown codec {}".format(codec))
+    return dict(chunks=chunks, **out)
+
+
+def load_filter_plugins():
+    """Register extra HDF5 compression filters (e.g. blosc), if `hdf5plugin` is installed
+
+    Needed before reading a stack written with `storage_options(codec="blosc")`
+    """
+    try:
+        import hdf5plugin  # noqa: F401
+    except ImportError:
+        pass
+
+
+def get_nc_dates(f, stack_dim_name="date"):
+    """Read the dates of the stack dimension from an opened .nc file
+
+    Parameters
+    ----------
+    f : h5netcdf.legacyapi.Dataset (or another `backends.open_dataset` dataset)
+        opened stack file, made by `create_empty_nc_stack`
+    stack_dim_name : str
+        default = "date". Name of the 3rd dimension of the stack
+
+    Returns
+    -------
+    list[datetime.date]
+    """
+    import cftime
+
+    dim_variable = f[stack_dim_name]
+    datetimes = cftime.num2date(
+        dim_variable[:],
+        units=dim_variable.getncattr("units"),
+        only_use_cftime_datetimes=False,
+        only_use_python_datetimes=True,
+    )
+    return [d.date() for d in datetimes]
+
+
+def append_nc_dates(f, date_list, stack_dim_name="date"):
+    """Grow the stack dimension of an opened .nc file to hold `date_list`
+
+    The dates already in `f` must be the start of `date_list`.
+    All variables using the dimension are resized, with the new layers empty.
+
+    Parameters
+    ----------
+    f : h5netcdf.legacyapi.Dataset (or another `backends.open_dataset` dataset)
+        stack file, opened for writing
+    date_list : list[datetime.date]
+        all dates of the stack, the current ones followed by the new ones
+    stack_dim_name : str
+        default = "date". Name of the 3rd dimension of the stack
+    """
+    import cftime
+
+    cur_dates = get_nc_dates(f, stack_dim_name=stack_dim_name)
+    if list(date_list[: len(cur_dates)]) != cur_dates:
+        raise ValueError("New dates can only be added after the existing dates")
+    depth = len(cur_dates)
+    if len(date_list) == depth:
+        return
+    log.info("Adding {} dates to the stack".format(len(date_list) - depth))
+    dim_variable = f[stack_dim_name]
+    f.resize_dimension(stack_dim_name, len(date_list))
+    dim_variable[depth:] = cftime.date2num(
+        to_datetimes(date_list[depth:]), units=dim_variable.getncattr("units")
+    )
 
 
 def to_datetimes(date_list):